@@ -12,5 +12,26 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'botx.settings')
+# Serve the chatbridge webhook and send views natively on the event loop
+os.environ.setdefault('CHATBRIDGE_ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Send replies left in the outbox, and process webhook deliveries left in
+# the inbox, by a previous process
+from chatbridge.inbox import start_inbox_sweeper  # noqa: E402
+from chatbridge.outbox import start_outbox_dispatcher  # noqa: E402
+
+start_outbox_dispatcher()
+start_inbox_sweeper()
+
+
+async def application(scope, receive, send):
+    # Django only serves HTTP; lifespan events let pending webhook batches
+    # finish before the server exits
+    if scope['type'] == 'lifespan':
+        from chatbridge.async_views import lifespan
+
+        await lifespan(scope, receive, send)
+        return
+    await django_application(scope, receive, send)
@@ -89,6 +89,37 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# The firm routing cache maps display_phone_number to firm routing data.
+# Firm saves invalidate it, but only in the backend the saving process
+# sees: set FIRM_ROUTING_CACHE_BACKEND (and LOCATION) to a shared backend,
+# e.g. Redis or Memcached, so every worker sees the same entries and
+# invalidations. Without one, each process keeps its own LocMemCache and
+# entries only live a few seconds, so other processes pick up firm changes
+# (status, flow version, phone number) quickly.
+
+FIRM_ROUTING_CACHE_BACKEND = os.environ.get('FIRM_ROUTING_CACHE_BACKEND', '')
+FIRM_ROUTING_CACHE_SHARED = bool(FIRM_ROUTING_CACHE_BACKEND)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'firm_routing': {
+        'BACKEND': FIRM_ROUTING_CACHE_BACKEND or 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': os.environ.get('FIRM_ROUTING_CACHE_LOCATION', 'firm-routing'),
+        'TIMEOUT': int(os.environ.get('FIRM_ROUTING_CACHE_TIMEOUT', '300' if FIRM_ROUTING_CACHE_SHARED else '5')),
+    },
+}
+
+# Seconds to remember that a display_phone_number has no active firm
+FIRM_ROUTING_NEGATIVE_TIMEOUT = int(
+    os.environ.get('FIRM_ROUTING_NEGATIVE_TIMEOUT', '60' if FIRM_ROUTING_CACHE_SHARED else '5')
+)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -133,3 +164,133 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # WhatsApp Business API configuration
 WHATSAPP_API_URL = os.environ.get('WHATSAPP_API_URL', 'http://localhost:5005/v1/messages')
 WHATSAPP_API_TOKEN = os.environ.get('WHATSAPP_API_TOKEN', 'your-api-token')
+
+# Webhook processing: events are acknowledged immediately and handled by a
+# pool of worker threads. Set CHATBRIDGE_WEBHOOK_WORKERS to 0 to process
+# events inline in the request.
+CHATBRIDGE_WEBHOOK_WORKERS = int(os.environ.get('CHATBRIDGE_WEBHOOK_WORKERS', '4'))
+CHATBRIDGE_WEBHOOK_QUEUE_SIZE = int(os.environ.get('CHATBRIDGE_WEBHOOK_QUEUE_SIZE', '1000'))
+CHATBRIDGE_WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get('CHATBRIDGE_WEBHOOK_DRAIN_TIMEOUT', '10'))
+
+# Before a delivery is acknowledged its events are written to the webhook
+# inbox table, leased to the process for INBOX_LEASE seconds, and deleted
+# once processed; a delivery that cannot be written is answered with 503.
+# Every process sweeps the inbox every INBOX_SWEEP_INTERVAL seconds, from
+# startup on, for deliveries whose lease ran out (their process died or
+# failed to process them) and processes up to INBOX_BATCH_SIZE at a time,
+# giving each up after INBOX_MAX_ATTEMPTS sweeps.
+CHATBRIDGE_WEBHOOK_INBOX_LEASE = float(os.environ.get('CHATBRIDGE_WEBHOOK_INBOX_LEASE', '120'))
+CHATBRIDGE_WEBHOOK_INBOX_SWEEP_INTERVAL = float(os.environ.get('CHATBRIDGE_WEBHOOK_INBOX_SWEEP_INTERVAL', '30'))
+CHATBRIDGE_WEBHOOK_INBOX_BATCH_SIZE = int(os.environ.get('CHATBRIDGE_WEBHOOK_INBOX_BATCH_SIZE', '100'))
+CHATBRIDGE_WEBHOOK_INBOX_MAX_ATTEMPTS = int(os.environ.get('CHATBRIDGE_WEBHOOK_INBOX_MAX_ATTEMPTS', '5'))
+
+# Outbound WhatsApp client: keep-alive pool, timeouts, concurrency and retries
+WHATSAPP_API_CONNECT_TIMEOUT = float(os.environ.get('WHATSAPP_API_CONNECT_TIMEOUT', '3.05'))
+WHATSAPP_API_READ_TIMEOUT = float(os.environ.get('WHATSAPP_API_READ_TIMEOUT', '10'))
+WHATSAPP_API_POOL_SIZE = int(os.environ.get('WHATSAPP_API_POOL_SIZE', '20'))
+WHATSAPP_API_MAX_CONCURRENCY = int(os.environ.get('WHATSAPP_API_MAX_CONCURRENCY', '20'))
+WHATSAPP_API_MAX_RETRIES = int(os.environ.get('WHATSAPP_API_MAX_RETRIES', '3'))
+WHATSAPP_API_BACKOFF_BASE = float(os.environ.get('WHATSAPP_API_BACKOFF_BASE', '0.5'))
+WHATSAPP_API_BACKOFF_MAX = float(os.environ.get('WHATSAPP_API_BACKOFF_MAX', '8'))
+
+# Outbound scheduling: each firm number may send FIRM_RATE messages per
+# second in bursts of up to FIRM_BURST, and the whole account ACCOUNT_RATE
+# (0 for no limit); at most WHATSAPP_API_MAX_CONCURRENCY sends run at once.
+# Waiting replies go before bulk sends, and firms share the capacity in
+# proportion to their weight ("number:weight,...", default 1). A send that
+# waits longer than MAX_WAIT seconds fails.
+WHATSAPP_OUTBOUND_FIRM_RATE = float(os.environ.get('WHATSAPP_OUTBOUND_FIRM_RATE', '20'))
+WHATSAPP_OUTBOUND_FIRM_BURST = float(os.environ.get('WHATSAPP_OUTBOUND_FIRM_BURST', '40'))
+WHATSAPP_OUTBOUND_ACCOUNT_RATE = float(os.environ.get('WHATSAPP_OUTBOUND_ACCOUNT_RATE', '0'))
+WHATSAPP_OUTBOUND_FIRM_WEIGHTS = os.environ.get('WHATSAPP_OUTBOUND_FIRM_WEIGHTS', '')
+WHATSAPP_OUTBOUND_MAX_WAIT = float(os.environ.get('WHATSAPP_OUTBOUND_MAX_WAIT', '30'))
+
+# Broadcasts send over CONCURRENCY threads per job at bulk priority, and
+# record progress every CHUNK_SIZE recipients. Jobs run on a thread of the
+# process that accepted them; with IN_PROCESS off they wait for the
+# run_broadcasts management command instead.
+CHATBRIDGE_BROADCAST_CONCURRENCY = int(os.environ.get('CHATBRIDGE_BROADCAST_CONCURRENCY', '8'))
+CHATBRIDGE_BROADCAST_CHUNK_SIZE = int(os.environ.get('CHATBRIDGE_BROADCAST_CHUNK_SIZE', '200'))
+CHATBRIDGE_BROADCAST_MAX_RECIPIENTS = int(os.environ.get('CHATBRIDGE_BROADCAST_MAX_RECIPIENTS', '100000'))
+CHATBRIDGE_BROADCAST_IN_PROCESS = os.environ.get('CHATBRIDGE_BROADCAST_IN_PROCESS', '1') == '1'
+
+# Bot replies are written to an outbox table in the same transaction as the
+# conversation step change and sent by a dispatcher: a thread of the process
+# that wrote them, or with IN_PROCESS off the dispatch_outbox management
+# command. A dispatcher claims up to BATCH_SIZE due replies at a time and
+# leases them for LEASE seconds (replies of a dispatcher that dies are sent
+# again after that), sends over CONCURRENCY threads, and polls every
+# POLL_INTERVAL seconds when idle. A reply is given up after MAX_ATTEMPTS
+# failed sends; sent rows are pruned after RETENTION_DAYS by
+# messagelog_partitions. Set CHATBRIDGE_OUTBOX to 0 to send replies from the
+# webhook handler instead.
+CHATBRIDGE_OUTBOX = os.environ.get('CHATBRIDGE_OUTBOX', '1') == '1'
+CHATBRIDGE_OUTBOX_IN_PROCESS = os.environ.get('CHATBRIDGE_OUTBOX_IN_PROCESS', '1') == '1'
+CHATBRIDGE_OUTBOX_BATCH_SIZE = int(os.environ.get('CHATBRIDGE_OUTBOX_BATCH_SIZE', '100'))
+CHATBRIDGE_OUTBOX_CONCURRENCY = int(os.environ.get('CHATBRIDGE_OUTBOX_CONCURRENCY', '8'))
+CHATBRIDGE_OUTBOX_POLL_INTERVAL = float(os.environ.get('CHATBRIDGE_OUTBOX_POLL_INTERVAL', '0.5'))
+CHATBRIDGE_OUTBOX_LEASE = float(os.environ.get('CHATBRIDGE_OUTBOX_LEASE', '60'))
+CHATBRIDGE_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('CHATBRIDGE_OUTBOX_MAX_ATTEMPTS', '10'))
+CHATBRIDGE_OUTBOX_RETENTION_DAYS = int(os.environ.get('CHATBRIDGE_OUTBOX_RETENTION_DAYS', '7'))
+
+# MessageLog rows are buffered and inserted in batches once a batch fills up
+# or its oldest row reaches the max age (seconds). Rows that cannot be
+# written are spooled to disk and replayed on the next start. A batch size
+# of 1 disables buffering.
+CHATBRIDGE_MESSAGELOG_BATCH_SIZE = int(os.environ.get('CHATBRIDGE_MESSAGELOG_BATCH_SIZE', '500'))
+CHATBRIDGE_MESSAGELOG_MAX_AGE = float(os.environ.get('CHATBRIDGE_MESSAGELOG_MAX_AGE', '1.0'))
+CHATBRIDGE_MESSAGELOG_SPOOL = Path(os.environ.get('CHATBRIDGE_MESSAGELOG_SPOOL', BASE_DIR / 'var' / 'messagelog.spool.ndjson'))
+
+# Number of recently seen WhatsApp message ids kept in memory per process to
+# drop provider redeliveries without a database round trip
+CHATBRIDGE_DEDUP_CACHE_SIZE = int(os.environ.get('CHATBRIDGE_DEDUP_CACHE_SIZE', '100000'))
+
+# In-process cache of active conversations' ChatUser rows. When deliveries
+# for one conversation reach several processes, a save from an outdated entry
+# is refused and the batch retried with the row reloaded, so a long TTL costs
+# retries rather than lost step changes.
+CONVERSATION_STATE_CACHE_SIZE = int(os.environ.get('CONVERSATION_STATE_CACHE_SIZE', '50000'))
+CONVERSATION_STATE_CACHE_TTL = float(os.environ.get('CONVERSATION_STATE_CACHE_TTL', '60'))
+
+# Use the async chatbridge views (async ORM, httpx client). botx.asgi turns
+# this on; WSGI deployments keep the threaded worker pool.
+CHATBRIDGE_ASYNC_VIEWS = os.environ.get('CHATBRIDGE_ASYNC_VIEWS', '0') == '1'
+# Webhook batches the async view keeps in flight before answering 503 so
+# the provider redelivers. Pending batches are awaited at ASGI lifespan
+# shutdown, up to CHATBRIDGE_WEBHOOK_DRAIN_TIMEOUT seconds.
+CHATBRIDGE_ASYNC_MAX_IN_FLIGHT = int(os.environ.get('CHATBRIDGE_ASYNC_MAX_IN_FLIGHT', '1000'))
+
+# Webhook stage timings and counters are served in the Prometheus text
+# format on /chatbridge/metrics/, and queue and buffer snapshots as JSON on
+# /chatbridge/webhook/status/. Both require this token as a bearer token and
+# answer 404 while it is unset.
+CHATBRIDGE_METRICS_TOKEN = os.environ.get('CHATBRIDGE_METRICS_TOKEN', '')
+
+# Fraction of webhook deliveries whose raw payload is logged to the
+# chatbridge.payloads logger at DEBUG (that logger must be enabled for DEBUG
+# too). 0 turns payload capture off.
+CHATBRIDGE_PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get('CHATBRIDGE_PAYLOAD_LOG_SAMPLE_RATE', '0'))
+
+# Flow route patterns are matched against at most this many characters of a
+# message (WhatsApp's text body limit). When a flow is saved, every pattern
+# is probed with inputs of this length and rejected if it needs more than
+# the time budget (seconds).
+FLOW_MAX_INPUT_LENGTH = int(os.environ.get('FLOW_MAX_INPUT_LENGTH', '4096'))
+FLOW_PATTERN_TIME_BUDGET = float(os.environ.get('FLOW_PATTERN_TIME_BUDGET', '0.1'))
+
+# On MySQL, MessageLog is range-partitioned on timestamp, one partition per
+# interval ('day' or 'month'). The messagelog_partitions command creates
+# partitions ahead of time and archives partitions older than the retention
+# period to gzipped NDJSON files in the archive directory before dropping
+# them. Other databases fall back to archiving and deleting in chunks.
+CHATBRIDGE_MESSAGELOG_PARTITION_INTERVAL = os.environ.get('CHATBRIDGE_MESSAGELOG_PARTITION_INTERVAL', 'month')
+CHATBRIDGE_MESSAGELOG_PARTITIONS_AHEAD = int(os.environ.get('CHATBRIDGE_MESSAGELOG_PARTITIONS_AHEAD', '2'))
+CHATBRIDGE_MESSAGELOG_RETENTION_DAYS = int(os.environ.get('CHATBRIDGE_MESSAGELOG_RETENTION_DAYS', '180'))
+CHATBRIDGE_MESSAGELOG_ARCHIVE_DIR = Path(os.environ.get('CHATBRIDGE_MESSAGELOG_ARCHIVE_DIR', BASE_DIR / 'var' / 'messagelog-archive'))
+
+# Accepted inbound message ids are kept this long to drop redeliveries
+CHATBRIDGE_DEDUP_RETENTION_DAYS = int(os.environ.get('CHATBRIDGE_DEDUP_RETENTION_DAYS', '7'))
+
+# Seconds between flushes of the in-memory analytics counters to the
+# FirmHourlyStats and StepTransitionStats rollup tables
+FIRM_ROLLUP_FLUSH_INTERVAL = float(os.environ.get('FIRM_ROLLUP_FLUSH_INTERVAL', '5'))
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'botx.settings')
 
 application = get_wsgi_application()
+
+# Send replies left in the outbox, and process webhook deliveries left in
+# the inbox, by a previous process
+from chatbridge.inbox import start_inbox_sweeper  # noqa: E402
+from chatbridge.outbox import start_outbox_dispatcher  # noqa: E402
+
+start_outbox_dispatcher()
+start_inbox_sweeper()
@@ -0,0 +1,297 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import MessageLog
+from .writer import SPOOL_FIELDS
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = ['id'] + SPOOL_FIELDS
+MANIFEST_NAME = 'manifest.json'
+# Archives are written as a series of gzip members of BLOCK_ROWS rows each.
+# A file's index records where each member starts and which members hold
+# each conversation, so reading one conversation only decompresses those.
+BLOCK_ROWS = 1000
+
+_manifest_lock = threading.Lock()
+
+
+def archive_dir() -> Path:
+    return Path(settings.CHATBRIDGE_MESSAGELOG_ARCHIVE_DIR)
+
+
+def read_manifest() -> List[dict]:
+    """
+    Read the archive manifest.
+
+    Each entry describes one archive file: its name, the time window it
+    covers, the number of rows and the first and last row timestamps.
+
+    Returns:
+        List[dict]: The manifest entries, oldest first
+    """
+    path = archive_dir() / MANIFEST_NAME
+    if not path.exists():
+        return []
+    with open(path, encoding='utf-8') as manifest:
+        return json.load(manifest)
+
+
+def _write_json(path: Path, data, indent: Optional[int] = None) -> None:
+    temporary = path.with_name(f'{path.name}.tmp')
+    with open(temporary, 'w', encoding='utf-8') as output:
+        json.dump(data, output, indent=indent)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temporary, path)
+
+
+def _write_manifest(entries: List[dict]) -> None:
+    _write_json(archive_dir() / MANIFEST_NAME, entries, indent=2)
+
+
+def index_path(file: str) -> Path:
+    return archive_dir() / f'{file}.index.json'
+
+
+def conversation_key(firm_phone_number: str, phone_number: str) -> str:
+    return f'{firm_phone_number}\t{phone_number}'
+
+
+def _available_path(name: str) -> Path:
+    # Rows can reach a window after it was archived (e.g. spool replays),
+    # so a window may be archived more than once
+    path = archive_dir() / f'messagelog-{name}.ndjson.gz'
+    suffix = 1
+    while path.exists():
+        path = archive_dir() / f'messagelog-{name}-{suffix}.ndjson.gz'
+        suffix += 1
+    return path
+
+
+def window_rows(lower: Optional[datetime.datetime], upper: datetime.datetime, chunk_size: int) -> Iterator[dict]:
+    """
+    Stream the MessageLog rows of a time window in id order, in chunks.
+
+    Args:
+        lower (Optional[datetime.datetime]): Inclusive lower bound, or None for no bound
+        upper (datetime.datetime): Exclusive upper bound
+        chunk_size (int): Rows fetched per query
+
+    Yields:
+        dict: The rows, with ARCHIVE_FIELDS
+    """
+    queryset = MessageLog.objects.filter(timestamp__lt=upper)
+    if lower is not None:
+        queryset = queryset.filter(timestamp__gte=lower)
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).order_by('id').values(*ARCHIVE_FIELDS)[:chunk_size])
+        if not chunk:
+            return
+        yield from chunk
+        last_id = chunk[-1]['id']
+
+
+def archive_window(
+    name: str,
+    lower: Optional[datetime.datetime],
+    upper: datetime.datetime,
+    chunk_size: int = 5000,
+) -> Optional[dict]:
+    """
+    Write the rows of a time window to a gzipped NDJSON file, with its
+    conversation index next to it, and record it in the manifest. The rows
+    are left in the database.
+
+    Args:
+        name (str): The window's name, e.g. its partition name
+        lower (Optional[datetime.datetime]): Inclusive lower bound (aware), or None for no bound
+        upper (datetime.datetime): Exclusive upper bound (aware)
+        chunk_size (int): Rows fetched per query
+
+    Returns:
+        Optional[dict]: The manifest entry, or None if the window is empty
+    """
+    directory = archive_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = _available_path(name)
+    temporary = path.with_name(f'{path.name}.tmp')
+    rows = 0
+    first = last = None
+    max_id = 0
+    # Byte offset of each block, then the end of the file
+    offsets: List[int] = []
+    conversations: Dict[str, List[int]] = {}
+    archive = None
+    with open(temporary, 'wb') as raw:
+        for row in window_rows(lower, upper, chunk_size):
+            if rows % BLOCK_ROWS == 0:
+                if archive is not None:
+                    archive.close()
+                offsets.append(raw.tell())
+                archive = gzip.GzipFile(fileobj=raw, mode='wb')
+            block = len(offsets) - 1
+            blocks = conversations.setdefault(conversation_key(row['firm_phone_number'], row['phone_number']), [])
+            if not blocks or blocks[-1] != block:
+                blocks.append(block)
+            timestamp = row['timestamp']
+            first = timestamp if first is None or timestamp < first else first
+            last = timestamp if last is None or timestamp > last else last
+            max_id = max(max_id, row['id'])
+            row['timestamp'] = timestamp.isoformat()
+            archive.write(json.dumps(row).encode('utf-8') + b'\n')
+            rows += 1
+        if archive is not None:
+            archive.close()
+        offsets.append(raw.tell())
+        raw.flush()
+        os.fsync(raw.fileno())
+    if not rows:
+        temporary.unlink()
+        return None
+    _write_json(index_path(path.name), {'offsets': offsets, 'conversations': conversations})
+    os.replace(temporary, path)
+    entry = {
+        'name': name,
+        'file': path.name,
+        'lower': lower.isoformat() if lower else None,
+        'upper': upper.isoformat(),
+        'rows': rows,
+        'max_id': max_id,
+        'first_timestamp': first.isoformat(),
+        'last_timestamp': last.isoformat(),
+        'archived_at': timezone.now().isoformat(),
+    }
+    with _manifest_lock:
+        entries = read_manifest()
+        entries.append(entry)
+        _write_manifest(entries)
+    logger.info('Archived %d MessageLog rows from %s to %s', rows, name, path)
+    return entry
+
+
+def discard_archive(entry: dict) -> None:
+    """Remove an archive file and its manifest entry."""
+    with _manifest_lock:
+        _write_manifest([other for other in read_manifest() if other['file'] != entry['file']])
+    (archive_dir() / entry['file']).unlink(missing_ok=True)
+    index_path(entry['file']).unlink(missing_ok=True)
+    _read_index.cache_clear()
+    _archived_conversation.cache_clear()
+
+
+def read_archive(entry: dict) -> Iterator[dict]:
+    """
+    Stream the rows of an archive file, with timestamps parsed.
+
+    Args:
+        entry (dict): A manifest entry
+
+    Yields:
+        dict: The archived rows
+    """
+    with gzip.open(archive_dir() / entry['file'], 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            if line.strip():
+                yield _parse_row(line)
+
+
+def _parse_row(line) -> dict:
+    row = json.loads(line)
+    row['timestamp'] = parse_datetime(row['timestamp'])
+    return row
+
+
+@lru_cache(maxsize=8)
+def _read_index(file: str) -> Optional[dict]:
+    # Files archived before indexes were written have none
+    path = index_path(file)
+    if not path.exists():
+        return None
+    with open(path, encoding='utf-8') as index:
+        return json.load(index)
+
+
+def _read_blocks(file: str, offsets: List[int], blocks: List[int]) -> Iterator[dict]:
+    with open(archive_dir() / file, 'rb') as raw:
+        for block in blocks:
+            raw.seek(offsets[block])
+            data = gzip.decompress(raw.read(offsets[block + 1] - offsets[block]))
+            for line in data.splitlines():
+                if line.strip():
+                    yield _parse_row(line)
+
+
+@lru_cache(maxsize=64)
+def _archived_conversation(file: str, firm_phone_number: str, phone_number: str) -> Tuple[dict, ...]:
+    index = _read_index(file)
+    if index is None:
+        candidates = read_archive({'file': file})
+    else:
+        blocks = index['conversations'].get(conversation_key(firm_phone_number, phone_number), [])
+        candidates = _read_blocks(file, index['offsets'], blocks)
+    rows = [
+        row for row in candidates
+        if row['firm_phone_number'] == firm_phone_number and row['phone_number'] == phone_number
+    ]
+    rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+    return tuple(rows)
+
+
+def archived_conversation_rows(
+    firm_phone_number: str,
+    phone_number: str,
+    limit: int,
+    before: Optional[Tuple[datetime.datetime, int]] = None,
+    after: Optional[Tuple[datetime.datetime, int]] = None,
+) -> List[dict]:
+    """
+    Get archived messages of a conversation, newest first.
+
+    Archive files are visited newest first and skipped when their time range
+    cannot contain matching rows. Only the blocks a file's index lists for
+    the conversation are read, and each file's rows for a conversation are
+    cached, so paging through an archived conversation reads them once.
+
+    Args:
+        firm_phone_number (str): The firm's display phone number
+        phone_number (str): The user's WhatsApp id
+        limit (int): The maximum number of rows to return
+        before (Optional[Tuple[datetime.datetime, int]]): Only rows before this (timestamp, id)
+        after (Optional[Tuple[datetime.datetime, int]]): Only rows after this (timestamp, id)
+
+    Returns:
+        List[dict]: The rows, with ARCHIVE_FIELDS
+    """
+    entries = sorted(read_manifest(), key=lambda entry: entry['last_timestamp'], reverse=True)
+    rows: List[dict] = []
+    for entry in entries:
+        if before is not None and parse_datetime(entry['first_timestamp']) > before[0]:
+            continue
+        last_timestamp = parse_datetime(entry['last_timestamp'])
+        if after is not None and last_timestamp < after[0]:
+            break
+        # Entries are ordered by their newest row, so once enough rows newer
+        # than this file's newest row are collected the rest cannot matter
+        if len(rows) >= limit:
+            rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+            if rows[limit - 1]['timestamp'] > last_timestamp:
+                break
+        for row in _archived_conversation(entry['file'], firm_phone_number, phone_number):
+            position = (row['timestamp'], row['id'])
+            if (before is None or position < before) and (after is None or position > after):
+                rows.append(dict(row))
+    rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+    return rows[:limit]
@@ -0,0 +1,174 @@
+from typing import Dict, Hashable, List
+import asyncio
+import json
+import logging
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from .inbox import acomplete_delivery, apersist_delivery
+from .metrics import WEBHOOK_REQUESTS, stage
+from .outbound import asend_whatsapp_message
+from .scheduler import PRIORITIES, REPLY
+from .webhook import ahandle_webhook_events, decode_webhook_body, log_webhook_payload, parse_webhook_events
+from .writer import alog_message
+
+logger = logging.getLogger(__name__)
+
+# Async counterparts of the views in chatbridge.views, used when the project
+# is served through botx.asgi (see CHATBRIDGE_ASYNC_VIEWS).
+
+
+class OrderedTaskRunner:
+    """
+    Runs webhook batches as background tasks on the event loop.
+
+    A batch waits for the previous batch touching any of its conversations
+    before it starts, so each conversation is still handled in order while
+    unrelated conversations proceed concurrently. At most max_in_flight
+    batches are kept at once. A batch that was processed is removed from the
+    webhook inbox; one that failed is left there for the inbox sweep.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self._tails: Dict[Hashable, asyncio.Task] = {}
+        self._tasks = set()
+
+    def submit(self, keys: List[Hashable], events: List[dict], delivery_id: int) -> bool:
+        """
+        Start processing a batch.
+
+        Args:
+            keys (List[Hashable]): The batch's conversations
+            events (List[dict]): Message events built by parse_webhook_events
+            delivery_id (int): The batch's webhook inbox row
+
+        Returns:
+            bool: True if the batch was started, False if too many are in flight
+        """
+        if len(self._tasks) >= self.max_in_flight:
+            return False
+        previous = {self._tails[key] for key in keys if key in self._tails}
+        task = asyncio.get_running_loop().create_task(self._run(previous, events, delivery_id))
+        for key in keys:
+            self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._finished(done, keys))
+        return True
+
+    async def _run(self, previous, events: List[dict], delivery_id: int) -> None:
+        if previous:
+            await asyncio.wait(previous)
+        try:
+            await ahandle_webhook_events(events)
+            await acomplete_delivery(delivery_id)
+        except Exception:
+            logger.exception('Error processing webhook delivery %d', delivery_id)
+
+    def _finished(self, task: asyncio.Task, keys: List[Hashable]) -> None:
+        self._tasks.discard(task)
+        for key in keys:
+            if self._tails.get(key) is task:
+                del self._tails[key]
+
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Wait for the batches in flight to finish.
+
+        Args:
+            timeout (float): Seconds to wait before giving up on them
+        """
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning('%d webhook batches still running at shutdown', len(pending))
+
+
+webhook_runner = OrderedTaskRunner(settings.CHATBRIDGE_ASYNC_MAX_IN_FLIGHT)
+
+
+async def lifespan(scope, receive, send) -> None:
+    """
+    ASGI lifespan handler; at shutdown it waits for the webhook batches in
+    flight, up to CHATBRIDGE_WEBHOOK_DRAIN_TIMEOUT seconds.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await webhook_runner.drain(settings.CHATBRIDGE_WEBHOOK_DRAIN_TIMEOUT)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+@csrf_exempt
+async def whatsapp_webhook(request):
+    if request.method == 'POST':
+        with stage('decode'):
+            try:
+                data = decode_webhook_body(request.body)
+            except ValueError as e:
+                logger.warning('Rejecting webhook delivery that is not valid JSON: %s', e)
+                WEBHOOK_REQUESTS.inc('400')
+                return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        log_webhook_payload(request.body)
+        # Acknowledge once the events are in the inbox; they are processed
+        # on the event loop
+        events = parse_webhook_events(data)
+        logger.debug('Received webhook delivery with %d messages', len(events))
+        if events:
+            delivery_id = await apersist_delivery(events)
+            if delivery_id is None:
+                logger.warning('Webhook delivery not persisted, asking the provider to redeliver.')
+                WEBHOOK_REQUESTS.inc('503')
+                return JsonResponse({'status': 'busy'}, status=503)
+            keys = list(dict.fromkeys((event['firm_phone_number'], event['wa_id']) for event in events))
+            if not webhook_runner.submit(keys, events, delivery_id):
+                await acomplete_delivery(delivery_id)
+                logger.warning('Too many webhook batches in flight, asking the provider to redeliver.')
+                WEBHOOK_REQUESTS.inc('503')
+                return JsonResponse({'status': 'busy'}, status=503)
+        WEBHOOK_REQUESTS.inc('200')
+        return JsonResponse({'status': 'received'}, status=200)
+    return JsonResponse({'error': 'Invalid method'}, status=405)
+
+
+@csrf_exempt
+async def send_message(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+            recipient = data.get('recipient')
+            message = data.get('message')
+            if not recipient or not message:
+                return JsonResponse({'error': 'recipient and message are required'}, status=400)
+            priority = data.get('priority', REPLY)
+            if priority not in PRIORITIES:
+                return JsonResponse({'error': f'priority must be one of {", ".join(PRIORITIES)}'}, status=400)
+
+            # Send message via WhatsApp API
+            success = await asend_whatsapp_message(recipient, message, data.get('firm_phone_number') or '', priority)
+
+            if success:
+                # Log the message
+                await alog_message(
+                    direction='OUT',
+                    phone_number=recipient,
+                    message=message,
+                    status='sent',
+                )
+                return JsonResponse({'status': 'message sent'}, status=200)
+            else:
+                return JsonResponse({'error': 'Failed to send message'}, status=500)
+
+        except Exception as e:
+            logger.error('Error in send_message: %s', e)
+            return JsonResponse({'error': 'Invalid request'}, status=400)
+    return JsonResponse({'error': 'Invalid method'}, status=405)
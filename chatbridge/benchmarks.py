@@ -0,0 +1,185 @@
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+import json
+import threading
+import time
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Helpers shared by the benchmark management commands.
+
+
+def percentile(values: Sequence[float], pct: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of a list of values.
+
+    Args:
+        values (Sequence[float]): The samples
+        pct (float): The percentile, between 0 and 100
+
+    Returns:
+        Optional[float]: The percentile, or None if there are no samples
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(seconds: Sequence[float]) -> dict:
+    """Summarise latencies in milliseconds."""
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+    return {
+        'count': len(seconds),
+        'p50_ms': ms(percentile(seconds, 50)),
+        'p95_ms': ms(percentile(seconds, 95)),
+        'p99_ms': ms(percentile(seconds, 99)),
+        'max_ms': ms(max(seconds) if seconds else None),
+    }
+
+
+def build_webhook_payload(firm_number: str, messages: List[Tuple[str, str, str, str]], waba_id: str = 'WABA_ID_BENCH') -> dict:
+    """
+    Build a WhatsApp Business webhook delivery, in the shape mock_whatsapp sends.
+
+    Args:
+        firm_number (str): The firm's display phone number
+        messages (List[Tuple[str, str, str, str]]): (wa_id, profile_name, body, message_id) tuples
+        waba_id (str): The WhatsApp Business Account id
+
+    Returns:
+        dict: The webhook payload
+    """
+    contacts = {}
+    for wa_id, profile_name, _, _ in messages:
+        contacts.setdefault(wa_id, {'profile': {'name': profile_name}, 'wa_id': wa_id})
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [
+            {
+                'id': waba_id,
+                'changes': [
+                    {
+                        'value': {
+                            'messaging_product': 'whatsapp',
+                            'metadata': {
+                                'display_phone_number': firm_number,
+                                'phone_number_id': '123456789012345',
+                            },
+                            'contacts': list(contacts.values()),
+                            'messages': [
+                                {
+                                    'from': wa_id,
+                                    'id': message_id,
+                                    'timestamp': str(int(time.time())),
+                                    'type': 'text',
+                                    'text': {'body': body},
+                                }
+                                for wa_id, _, body, message_id in messages
+                            ],
+                        },
+                        'field': 'messages',
+                    }
+                ],
+            }
+        ],
+    }
+
+
+class ProviderSink:
+    """
+    A local stand-in for the WhatsApp send API.
+
+    Answers every POST with 200, counts the calls and matches each reply
+    to the oldest message still waiting for one from the same recipient.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.calls = 0
+        self.reply_latencies: List[float] = []
+        self._pending: Dict[str, deque] = defaultdict(deque)
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    data = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    data = {}
+                sink.record(data.get('to', ''))
+                body = b'{"messages": [{"id": "bench-message-id", "status": "sent"}]}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}/v1/messages'
+        self._thread = threading.Thread(target=self.server.serve_forever, name='provider-sink', daemon=True)
+
+    def start(self) -> 'ProviderSink':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expect_reply(self, wa_id: str, sent_at: float) -> None:
+        with self._lock:
+            self._pending[wa_id].append(sent_at)
+
+    def record(self, wa_id: str) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            self.calls += 1
+            pending = self._pending.get(wa_id)
+            if pending:
+                self.reply_latencies.append(now - pending.popleft())
+
+
+class QueryCounter:
+    """
+    Counts SQL queries on every database connection, in every thread.
+
+    Connections opened after start() get the counter when they connect;
+    the current thread's existing connections get it right away.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, connection) -> None:
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def _on_connect(self, sender, connection, **kwargs) -> None:
+        self._install(connection)
+
+    def start(self) -> 'QueryCounter':
+        connection_created.connect(self._on_connect, weak=False)
+        for connection in connections.all():
+            self._install(connection)
+        return self
+
+    def stop(self) -> None:
+        connection_created.disconnect(self._on_connect)
@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, QuerySet
+from django.utils import timezone
+
+from firms.models import ChatUser
+from firms.rollups import get_rollups
+from firms.utils import get_firm_by_phone
+from .export import InvalidExportRange, parse_bound
+from .models import BroadcastJob, MessageLog
+from .outbound import send_whatsapp_message
+from .scheduler import BULK
+
+logger = logging.getLogger(__name__)
+
+# Broadcast filter -> ChatUser lookup. current_step takes a step id or a
+# list of them, the others an ISO date or datetime (UTC if naive).
+RECIPIENT_FILTERS = {
+    'current_step': 'current_step__in',
+    'active_since': 'last_active_at__gte',
+    'active_before': 'last_active_at__lt',
+    'created_since': 'created_at__gte',
+    'created_before': 'created_at__lt',
+}
+
+
+class InvalidBroadcast(ValueError):
+    pass
+
+
+def recipient_queryset(firm_id: int, filters: dict) -> QuerySet:
+    """
+    Get a firm's chat users matching broadcast filters.
+
+    Args:
+        firm_id (int): The firm's primary key
+        filters (dict): Filter name -> value, see RECIPIENT_FILTERS
+
+    Returns:
+        QuerySet: The matching ChatUser rows
+
+    Raises:
+        InvalidBroadcast: If a filter is unknown or its value is invalid
+    """
+    lookups = {}
+    for name, value in filters.items():
+        if name not in RECIPIENT_FILTERS:
+            raise InvalidBroadcast(f"Unknown filter {name}, use: {', '.join(RECIPIENT_FILTERS)}")
+        if name == 'current_step':
+            value = [value] if isinstance(value, str) else value
+            if not isinstance(value, list) or not all(isinstance(step, str) for step in value):
+                raise InvalidBroadcast('current_step must be a step id or a list of step ids')
+        else:
+            try:
+                value = parse_bound(value if isinstance(value, str) else None)
+            except InvalidExportRange as e:
+                raise InvalidBroadcast(f'{name}: {e}')
+            if value is None:
+                raise InvalidBroadcast(f'{name} must be an ISO date or datetime')
+        lookups[RECIPIENT_FILTERS[name]] = value
+    return ChatUser.objects.filter(firm_id=firm_id, **lookups)
+
+
+def create_broadcast(
+    firm_phone_number: str,
+    message: str,
+    recipients: Optional[List[str]] = None,
+    filters: Optional[dict] = None,
+) -> BroadcastJob:
+    """
+    Validate and save a broadcast job. Without recipients, the message goes
+    to the firm's chat users matching the filters (all of them if there
+    are none).
+
+    Args:
+        firm_phone_number (str): The sending firm's phone number
+        message (str): The message to send
+        recipients (Optional[List[str]]): Phone numbers to send to
+        filters (Optional[dict]): ChatUser filters, see RECIPIENT_FILTERS
+
+    Returns:
+        BroadcastJob: The queued job
+
+    Raises:
+        InvalidBroadcast: If the request is invalid
+    """
+    if not isinstance(message, str) or not message.strip():
+        raise InvalidBroadcast('message is required')
+    if not isinstance(firm_phone_number, str) or not firm_phone_number:
+        raise InvalidBroadcast('firm_phone_number is required')
+    firm = get_firm_by_phone(firm_phone_number)
+    if firm is None:
+        raise InvalidBroadcast(f'No active firm with phone number {firm_phone_number}')
+    if recipients is not None and filters is not None:
+        raise InvalidBroadcast('Give either recipients or filter, not both')
+
+    if recipients is not None:
+        if not isinstance(recipients, list) or not all(isinstance(number, (str, int)) for number in recipients):
+            raise InvalidBroadcast('recipients must be a list of phone numbers')
+        # Keep the order, drop blanks and repeats
+        recipients = list(dict.fromkeys(filter(None, (str(number).strip() for number in recipients))))
+        if not recipients:
+            raise InvalidBroadcast('recipients is empty')
+        total = len(recipients)
+    else:
+        filters = filters or {}
+        if not isinstance(filters, dict):
+            raise InvalidBroadcast('filter must be an object')
+        total = recipient_queryset(firm.pk, filters).count()
+    if total > settings.CHATBRIDGE_BROADCAST_MAX_RECIPIENTS:
+        raise InvalidBroadcast(
+            f'{total} recipients, at most {settings.CHATBRIDGE_BROADCAST_MAX_RECIPIENTS} are allowed per broadcast'
+        )
+    return BroadcastJob.objects.create(
+        firm_phone_number=firm_phone_number,
+        message=message,
+        recipients=recipients,
+        filters=filters,
+        total=total,
+    )
+
+
+def iter_recipient_chunks(job: BroadcastJob, firm_id: int, chunk_size: int) -> Iterator[Tuple[List[Tuple[str, str]], int]]:
+    """
+    Yield a job's remaining recipients in chunks, starting at job.position.
+
+    Filtered recipients are read with keyset pagination on the ChatUser id,
+    so users who join while the job runs are included if they match.
+
+    Yields:
+        Tuple[List[Tuple[str, str]], int]: (phone number, profile name) pairs
+        and the job position after the chunk
+    """
+    if job.recipients is not None:
+        for start in range(job.position, len(job.recipients), chunk_size):
+            chunk = job.recipients[start:start + chunk_size]
+            yield [(number, '') for number in chunk], start + len(chunk)
+        return
+    queryset = recipient_queryset(firm_id, job.filters).order_by('id').values_list('id', 'phone_number', 'profile_name')
+    position = job.position
+    while True:
+        rows = list(queryset.filter(id__gt=position)[:chunk_size])
+        if not rows:
+            return
+        position = rows[-1][0]
+        yield [(number, name) for _, number, name in rows], position
+
+
+def run_broadcast(job_id: int, resume: bool = False) -> Optional[BroadcastJob]:
+    """
+    Send a queued broadcast, and with resume one left running by a process
+    that died, picking up after the last chunk it recorded.
+
+    Sends fan out over CHATBRIDGE_BROADCAST_CONCURRENCY threads at bulk
+    priority, so the outbound scheduler's per-firm limits apply and replies
+    to conversations go first. After each chunk the MessageLog rows are
+    inserted in one bulk_create and the job's counters and position saved.
+
+    Args:
+        job_id (int): The job's primary key
+        resume (bool): Also run the job if it is marked as running
+
+    Returns:
+        Optional[BroadcastJob]: The finished job, None if it was not claimed
+    """
+    statuses = ['queued', 'running'] if resume else ['queued']
+    # Claim the job, so concurrent runners never send it twice
+    claimed = BroadcastJob.objects.filter(pk=job_id, status__in=statuses).update(
+        status='running', started_at=timezone.now(),
+    )
+    if not claimed:
+        return None
+    job = BroadcastJob.objects.get(pk=job_id)
+    logger.info('Running broadcast %d to %d recipients', job.pk, job.total)
+    rollups = get_rollups()
+
+    def send(recipient: Tuple[str, str]) -> bool:
+        return send_whatsapp_message(recipient[0], job.message, job.firm_phone_number, BULK)
+
+    try:
+        firm = get_firm_by_phone(job.firm_phone_number)
+        if firm is None:
+            raise InvalidBroadcast(f'No active firm with phone number {job.firm_phone_number}')
+        with ThreadPoolExecutor(settings.CHATBRIDGE_BROADCAST_CONCURRENCY, thread_name_prefix=f'broadcast-{job.pk}') as executor:
+            for chunk, position in iter_recipient_chunks(job, firm.pk, settings.CHATBRIDGE_BROADCAST_CHUNK_SIZE):
+                results = list(executor.map(send, chunk))
+                now = timezone.now()
+                MessageLog.objects.bulk_create([
+                    MessageLog(
+                        direction='OUT',
+                        phone_number=number,
+                        message=job.message,
+                        timestamp=now,
+                        status='sent' if sent else 'failed',
+                        firm_phone_number=job.firm_phone_number,
+                        user_name=name,
+                    )
+                    for (number, name), sent in zip(chunk, results)
+                ])
+                sent = results.count(True)
+                for _ in range(sent):
+                    rollups.record_outbound(firm.pk, now)
+                BroadcastJob.objects.filter(pk=job.pk).update(
+                    sent=F('sent') + sent, failed=F('failed') + len(results) - sent, position=position,
+                )
+    except Exception as e:
+        logger.exception('Broadcast %d failed', job.pk)
+        BroadcastJob.objects.filter(pk=job.pk).update(status='failed', error=str(e), finished_at=timezone.now())
+    else:
+        BroadcastJob.objects.filter(pk=job.pk).update(status='done', finished_at=timezone.now())
+    job.refresh_from_db()
+    logger.info('Broadcast %d %s: %d sent, %d failed', job.pk, job.status, job.sent, job.failed)
+    return job
+
+
+def start_broadcast(job: BroadcastJob) -> None:
+    """
+    Run a broadcast on a background thread of this process, unless
+    CHATBRIDGE_BROADCAST_IN_PROCESS is off, in which case it waits for the
+    run_broadcasts command.
+
+    Args:
+        job (BroadcastJob): The queued job
+    """
+    if not settings.CHATBRIDGE_BROADCAST_IN_PROCESS:
+        return
+
+    def run():
+        try:
+            run_broadcast(job.pk)
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, name=f'broadcast-{job.pk}', daemon=True).start()
+
+
+def broadcast_progress(job: BroadcastJob) -> dict:
+    """
+    Describe a broadcast job's progress.
+
+    Returns:
+        dict: The job's id, status, counters, 'pending' and 'progress' (the
+        fraction of recipients handled) and its timestamps
+    """
+    handled = job.sent + job.failed
+    return {
+        'job_id': job.pk,
+        'firm_phone_number': job.firm_phone_number,
+        'status': job.status,
+        'total': job.total,
+        'sent': job.sent,
+        'failed': job.failed,
+        # Filtered recipients are counted when the job is created, so users
+        # joining later can push the handled count past the total
+        'pending': max(job.total - handled, 0) if job.status in ('queued', 'running') else 0,
+        'progress': round(min(handled / job.total, 1.0), 4) if job.total else 1.0,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
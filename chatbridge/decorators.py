@@ -0,0 +1,34 @@
+from functools import wraps
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
+
+
+def api_login_required(view_func):
+    """
+    Like login_required, but answers anonymous API calls with a JSON 401
+    instead of redirecting to the login page.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required'}, status=401)
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def metrics_token_required(view_func):
+    """
+    Serves an operational endpoint only to callers sending
+    CHATBRIDGE_METRICS_TOKEN as a bearer token. Without a token configured
+    the endpoint does not exist.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        token = settings.CHATBRIDGE_METRICS_TOKEN
+        if not token:
+            raise Http404('Metrics are disabled')
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+        return view_func(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from typing import Iterable, List, Set
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import ProcessedMessage
+
+
+class ConcurrentDelivery(Exception):
+    """Another delivery of a message in the batch was processed first."""
+
+
+class RecentMessageIds:
+    """
+    A bounded, thread-safe LRU set of recently processed WhatsApp message ids.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._ids: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, message_id: str) -> bool:
+        """
+        Check for a message id, marking it as recently used.
+
+        Args:
+            message_id (str): The WhatsApp message id
+
+        Returns:
+            bool: True if the id has been added
+        """
+        with self._lock:
+            if message_id in self._ids:
+                self._ids.move_to_end(message_id)
+                return True
+            return False
+
+    def add_many(self, message_ids: Iterable[str]) -> None:
+        with self._lock:
+            for message_id in message_ids:
+                self._ids[message_id] = None
+                self._ids.move_to_end(message_id)
+            while len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+recent_message_ids = RecentMessageIds(settings.CHATBRIDGE_DEDUP_CACHE_SIZE)
+
+dedup_stats = {'checked': 0, 'duplicates': 0}
+_stats_lock = threading.Lock()
+
+
+def _first_deliveries(events: List[dict]) -> List[dict]:
+    # Drop ids processed recently by this process or repeated in the batch
+    kept, batch_ids = [], set()
+    for event in events:
+        message_id = event['msg_id']
+        if message_id:
+            if message_id in batch_ids or recent_message_ids.seen(message_id):
+                continue
+            batch_ids.add(message_id)
+        kept.append(event)
+    return kept
+
+
+def _without(events: List[dict], processed: Set[str]) -> List[dict]:
+    return [event for event in events if not event['msg_id'] or event['msg_id'] not in processed]
+
+
+def _count(checked: int, duplicates: int) -> None:
+    with _stats_lock:
+        dedup_stats['checked'] += checked
+        dedup_stats['duplicates'] += duplicates
+
+
+def drop_duplicate_events(events: List[dict]) -> List[dict]:
+    """
+    Remove provider redeliveries from a batch of webhook events.
+
+    Ids are checked against the in-memory LRU first, then against the
+    ProcessedMessage ledger. Nothing is recorded here: the kept events'
+    ids are written with record_processed in the transaction that saves
+    their outcome, so a batch that fails is handled again when redelivered.
+
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+
+    Returns:
+        List[dict]: The events whose message id has not been processed yet
+    """
+    fresh = _first_deliveries(events)
+    unseen = [event['msg_id'] for event in fresh if event['msg_id']]
+    if unseen:
+        processed = set(ProcessedMessage.objects.filter(message_id__in=unseen).values_list('message_id', flat=True))
+        fresh = _without(fresh, processed)
+    _count(len(events), len(events) - len(fresh))
+    return fresh
+
+
+async def adrop_duplicate_events(events: List[dict]) -> List[dict]:
+    """
+    Async version of drop_duplicate_events.
+
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+
+    Returns:
+        List[dict]: The events whose message id has not been processed yet
+    """
+    fresh = _first_deliveries(events)
+    unseen = [event['msg_id'] for event in fresh if event['msg_id']]
+    if unseen:
+        processed = {
+            message_id
+            async for message_id in ProcessedMessage.objects.filter(message_id__in=unseen).values_list('message_id', flat=True)
+        }
+        fresh = _without(fresh, processed)
+    _count(len(events), len(events) - len(fresh))
+    return fresh
+
+
+def record_processed(events: List[dict]) -> None:
+    """
+    Insert the events' message ids into the ledger. Call inside the
+    transaction that saves the events' outcome; the ids are added to the
+    in-memory LRU once it commits.
+
+    If another delivery of one of the messages committed since
+    drop_duplicate_events, its ledger row makes the insert fail (waiting
+    for that transaction first if it is still open) and the caller's
+    transaction must be rolled back.
+
+    Args:
+        events (List[dict]): Message events kept by drop_duplicate_events
+
+    Raises:
+        ConcurrentDelivery: If one of the ids is already in the ledger
+    """
+    message_ids = [event['msg_id'] for event in events if event['msg_id']]
+    if not message_ids:
+        return
+    try:
+        with transaction.atomic():
+            ProcessedMessage.objects.bulk_create([ProcessedMessage(message_id=message_id) for message_id in message_ids])
+    except IntegrityError as e:
+        raise ConcurrentDelivery(f'One of {len(message_ids)} messages was processed by another delivery') from e
+    transaction.on_commit(lambda: recent_message_ids.add_many(message_ids))
+
+
+def dedup_snapshot() -> dict:
+    with _stats_lock:
+        checked, duplicates = dedup_stats['checked'], dedup_stats['duplicates']
+    return {
+        'checked': checked,
+        'duplicates': duplicates,
+        'duplicate_rate': duplicates / checked if checked else 0.0,
+        'recent_ids': len(recent_message_ids),
+    }
+
+
+def prune_processed_messages(older_than, chunk_size: int = 5000) -> int:
+    """
+    Delete ledger rows received before a cutoff, in chunks.
+
+    Args:
+        older_than (datetime.datetime): The cutoff
+        chunk_size (int): Rows deleted per query
+
+    Returns:
+        int: The number of rows deleted
+    """
+    deleted = 0
+    while True:
+        ids = list(
+            ProcessedMessage.objects.filter(received_at__lt=older_than)
+            .values_list('message_id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        deleted += ProcessedMessage.objects.filter(message_id__in=ids).delete()[0]
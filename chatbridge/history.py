@@ -0,0 +1,87 @@
+from typing import List, Optional, Tuple
+import base64
+import binascii
+import datetime
+
+from django.utils.dateparse import parse_datetime
+
+from .archive import archived_conversation_rows
+from .models import MessageLog
+
+HISTORY_FIELDS = ['id', 'direction', 'phone_number', 'message', 'timestamp', 'status', 'user_name', 'message_id']
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp: datetime.datetime, pk: int) -> str:
+    raw = f'{timestamp.isoformat()}|{pk}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, pk = raw.rsplit('|', 1)
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError(timestamp)
+        return parsed, int(pk)
+    except (ValueError, UnicodeError, binascii.Error) as e:
+        raise InvalidCursor(f'Invalid cursor: {cursor}') from e
+
+
+def get_conversation_page(
+    firm_phone_number: str,
+    phone_number: str,
+    limit: int,
+    cursor: Optional[str] = None,
+    include_archived: bool = False,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Get one page of a conversation, newest message first.
+
+    Pages are addressed with a keyset cursor on (timestamp, id) rather than
+    an offset, so every page is a range scan on messagelog_conversation_idx
+    and deep pages cost the same as the first one. With include_archived,
+    rows from archived partitions are merged in under the same ordering, so
+    cursors keep working across the boundary.
+
+    Args:
+        firm_phone_number (str): The firm's display phone number
+        phone_number (str): The user's WhatsApp id
+        limit (int): The maximum number of messages to return
+        cursor (Optional[str]): The next_cursor of the previous page
+        include_archived (bool): Also read archived messages
+
+    Returns:
+        Tuple[List[dict], Optional[str]]: The messages and the cursor of the next page, if any
+    """
+    queryset = MessageLog.objects.filter(firm_phone_number=firm_phone_number, phone_number=phone_number)
+    before = None
+    if cursor:
+        before = decode_cursor(cursor)
+        timestamp, pk = before
+        queryset = queryset.filter(timestamp__lte=timestamp).exclude(timestamp=timestamp, id__gte=pk)
+    rows = list(queryset.order_by('-timestamp', '-id').values(*HISTORY_FIELDS)[:limit + 1])
+    if include_archived:
+        # When the live rows fill the page, only archived rows newer than
+        # the last of them can make it onto the page
+        after = (rows[-1]['timestamp'], rows[-1]['id']) if len(rows) > limit else None
+        archived = archived_conversation_rows(firm_phone_number, phone_number, limit + 1, before, after)
+        if archived:
+            rows += [{field: row[field] for field in HISTORY_FIELDS} for row in archived]
+            rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+            rows = rows[:limit + 1]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+    return rows, next_cursor
@@ -0,0 +1,218 @@
+from typing import Callable, List, Optional
+import datetime
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import WebhookDelivery
+
+logger = logging.getLogger(__name__)
+
+
+def _lease_end() -> datetime.datetime:
+    return timezone.now() + datetime.timedelta(seconds=settings.CHATBRIDGE_WEBHOOK_INBOX_LEASE)
+
+
+def persist_delivery(events: List[dict]) -> Optional[int]:
+    """
+    Write a delivery's events to the inbox before it is acknowledged.
+
+    The row is leased to this process for CHATBRIDGE_WEBHOOK_INBOX_LEASE
+    seconds; the inbox sweep only handles it after that.
+
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+
+    Returns:
+        Optional[int]: The inbox row's id, None if it could not be written
+    """
+    try:
+        return WebhookDelivery.objects.create(events=events, available_at=_lease_end()).pk
+    except DatabaseError:
+        logger.exception('Error writing webhook delivery with %d events to the inbox', len(events))
+        return None
+
+
+async def apersist_delivery(events: List[dict]) -> Optional[int]:
+    """
+    Async version of persist_delivery.
+
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+
+    Returns:
+        Optional[int]: The inbox row's id, None if it could not be written
+    """
+    try:
+        return (await WebhookDelivery.objects.acreate(events=events, available_at=_lease_end())).pk
+    except DatabaseError:
+        logger.exception('Error writing webhook delivery with %d events to the inbox', len(events))
+        return None
+
+
+def complete_delivery(delivery_id: int) -> None:
+    """
+    Remove a delivery from the inbox once its events were processed, or when
+    it was refused and the provider will redeliver it.
+
+    Args:
+        delivery_id (int): The inbox row's id
+    """
+    WebhookDelivery.objects.filter(pk=delivery_id).delete()
+
+
+async def acomplete_delivery(delivery_id: int) -> None:
+    """
+    Async version of complete_delivery.
+
+    Args:
+        delivery_id (int): The inbox row's id
+    """
+    await WebhookDelivery.objects.filter(pk=delivery_id).adelete()
+
+
+class InboxSweeper:
+    """
+    Processes inbox rows whose lease ran out: deliveries of a process that
+    died before handling them, and deliveries whose processing failed.
+
+    Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased
+    again, in a short transaction, so several processes can sweep side by
+    side. Claimed deliveries are handled one after the other, oldest first;
+    events that were processed before are dropped by the dedup ledger. A
+    delivery is given up after max_attempts sweeps.
+    """
+
+    def __init__(self, handler: Callable[[List[dict]], None], batch_size: int, interval: float, max_attempts: int):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._closed = False
+        self.stats = {
+            'recovered': 0,
+            'failed': 0,
+            'given_up': 0,
+        }
+
+    def claim(self) -> List[WebhookDelivery]:
+        """
+        Lease the next batch of inbox rows whose lease ran out.
+
+        Returns:
+            List[WebhookDelivery]: The claimed rows, oldest first
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            rows = list(
+                WebhookDelivery.objects.select_for_update(skip_locked=True)
+                .filter(available_at__lte=now)
+                .order_by('id')[:self.batch_size]
+            )
+            if rows:
+                WebhookDelivery.objects.filter(pk__in=[row.pk for row in rows]).update(
+                    available_at=_lease_end(), attempts=F('attempts') + 1,
+                )
+        for row in rows:
+            row.attempts += 1
+        return rows
+
+    def sweep(self) -> int:
+        """
+        Claim a batch of inbox rows and process their events.
+
+        Returns:
+            int: The number of rows claimed
+        """
+        rows = self.claim()
+        for row in rows:
+            if row.attempts > self.max_attempts:
+                logger.error('Giving up on webhook delivery %d after %d attempts', row.pk, row.attempts - 1)
+                complete_delivery(row.pk)
+                self.stats['given_up'] += 1
+                continue
+            try:
+                self.handler(row.events)
+            except Exception:
+                logger.exception('Error processing webhook delivery %d from the inbox', row.pk)
+                self.stats['failed'] += 1
+                continue
+            complete_delivery(row.pk)
+            self.stats['recovered'] += 1
+        return len(rows)
+
+    def run(self) -> None:
+        """Sweep the inbox until closed, every interval seconds once it is drained."""
+        while not self._closed:
+            try:
+                claimed = self.sweep()
+            except Exception:
+                logger.exception('Error sweeping the webhook inbox')
+                claimed = 0
+            finally:
+                close_old_connections()
+            if claimed < self.batch_size:
+                self._wakeup.wait(self.interval)
+
+    def start(self) -> None:
+        # A forked worker inherits the thread object but not the thread
+        if (self._thread is not None and self._pid == os.getpid()) or self._closed:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name='webhook-inbox', daemon=True)
+            self._thread.start()
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, running=self._thread is not None and not self._closed)
+
+    def close(self) -> None:
+        """Stop sweeping once the current batch is done."""
+        self._closed = True
+        self._wakeup.set()
+
+
+_sweeper: Optional[InboxSweeper] = None
+_sweeper_lock = threading.Lock()
+
+
+def get_inbox_sweeper() -> InboxSweeper:
+    """
+    Get the process-wide inbox sweeper configured from settings.
+
+    Returns:
+        InboxSweeper: The shared sweeper
+    """
+    global _sweeper
+    if _sweeper is None:
+        with _sweeper_lock:
+            if _sweeper is None:
+                from .webhook import handle_webhook_events
+
+                _sweeper = InboxSweeper(
+                    handle_webhook_events,
+                    batch_size=settings.CHATBRIDGE_WEBHOOK_INBOX_BATCH_SIZE,
+                    interval=settings.CHATBRIDGE_WEBHOOK_INBOX_SWEEP_INTERVAL,
+                    max_attempts=settings.CHATBRIDGE_WEBHOOK_INBOX_MAX_ATTEMPTS,
+                )
+    return _sweeper
+
+
+def start_inbox_sweeper() -> None:
+    """
+    Start this process's inbox sweep thread, so deliveries left behind by
+    a previous process are handled once their lease runs out. Called by the
+    WSGI and ASGI entry points.
+    """
+    get_inbox_sweeper().start()
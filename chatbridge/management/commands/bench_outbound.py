@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import requests
+
+from chatbridge.outbound import WhatsAppClient, client_options
+
+
+def naive_send(to_number: str, message: str) -> bool:
+    # The pre-pooling behaviour: a fresh connection for every message
+    response = requests.post(
+        settings.WHATSAPP_API_URL,
+        json={'to': to_number, 'message': message},
+        headers={'Authorization': f'Bearer {settings.WHATSAPP_API_TOKEN}'},
+    )
+    return response.status_code == 200
+
+
+class Command(BaseCommand):
+    help = "Measure outbound send throughput against WHATSAPP_API_URL (e.g. mock_whatsapp.py's /v1/messages)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='Messages to send per mode')
+        parser.add_argument('--concurrency', type=int, default=16, help='Concurrent senders')
+        parser.add_argument('--mode', choices=['naive', 'pooled', 'both'], default='both')
+        parser.add_argument('--to', default='15550000000', help='Recipient number')
+
+    def handle(self, *args, **options):
+        modes = ['naive', 'pooled'] if options['mode'] == 'both' else [options['mode']]
+        for mode in modes:
+            if mode == 'naive':
+                send = naive_send
+            else:
+                send = WhatsAppClient(**dict(client_options(), max_concurrency=options['concurrency'],
+                                             pool_size=options['concurrency'])).send
+            self.run(mode, send, options['count'], options['concurrency'], options['to'])
+
+    def run(self, mode, send, count, concurrency, to_number):
+        def timed(index):
+            start = time.perf_counter()
+            try:
+                ok = send(to_number, f'bench message {index}')
+            except requests.RequestException:
+                ok = False
+            return ok, time.perf_counter() - start
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(timed, range(count)))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for _, latency in results)
+        failures = sum(1 for ok, _ in results if not ok)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f'{mode}: {count} messages in {elapsed:.2f}s '
+            f'({count / elapsed:.1f} msg/s), '
+            f'p50 {statistics.median(latencies) * 1000:.1f}ms, '
+            f'p95 {p95 * 1000:.1f}ms, '
+            f'{failures} failed'
+        )
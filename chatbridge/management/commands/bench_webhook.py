@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import itertools
+import json
+import random
+import subprocess
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+import requests
+
+from chatbridge.benchmarks import ProviderSink, QueryCounter, build_webhook_payload, latency_summary
+from chatbridge.models import MessageLog, OutboxMessage, ProcessedMessage
+from chatbridge.worker import get_webhook_pool
+from chatbridge.writer import get_message_log_writer
+from firms.flow import set_flow
+from firms.models import Firm
+
+BENCH_PREFIX = 'bench-'
+BENCH_MESSAGE_PREFIX = 'wamid.bench.'
+
+# A small menu-driven flow: every input gets a reply, so each inbound
+# message should cause exactly one outbound call.
+BENCH_FLOW = {
+    'steps': [
+        {
+            'id': 'start',
+            'message': 'Welcome! Reply 1 for orders, 2 for support, 3 for opening hours.',
+            'next': [
+                {'pattern': '^1$', 'next': 'orders'},
+                {'pattern': '^2$', 'next': 'support'},
+                {'pattern': '^3$', 'next': 'hours'},
+                {'pattern': '.*', 'next': 'start'},
+            ],
+        },
+        {
+            'id': 'orders',
+            'message': 'Please send your order number.',
+            'next': [
+                {'pattern': r'^\d{4,}$', 'next': 'order_status'},
+                {'pattern': '.*', 'next': 'orders'},
+            ],
+        },
+        {'id': 'order_status', 'message': 'Your order is on its way.', 'next': 'start'},
+        {'id': 'support', 'message': 'An agent will contact you shortly.', 'next': 'start'},
+        {'id': 'hours', 'message': 'We are open 9am to 6pm.', 'next': 'start'},
+    ]
+}
+
+INPUTS = ['hi', '1', '12345', '2', '3', 'hello', '1', 'abc']
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test /chatbridge/webhook/ with generated WhatsApp Business payloads '
+        'against a local provider sink and write the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--firms', type=int, default=5, help='Number of benchmark firms')
+        parser.add_argument('--users', type=int, default=200, help='Number of simulated users')
+        parser.add_argument('--messages', type=int, default=2000, help='Total inbound messages')
+        parser.add_argument('--batch', type=int, default=1, help='Messages per webhook delivery')
+        parser.add_argument('--rate', type=float, default=0, help='Deliveries per second (0 = as fast as possible)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent webhook callers')
+        parser.add_argument('--drain-timeout', type=float, default=60, help='Seconds to wait for replies')
+        parser.add_argument('--output', default='bench_webhook.json', help='Where to write the JSON results')
+        parser.add_argument('--label', default='', help='Free-form label stored with the results')
+        parser.add_argument(
+            '--url',
+            help='Drive a running server at this webhook URL instead of calling the view in-process. '
+                 'Point its WHATSAPP_API_URL at the sink (see --sink-port); DB queries are not counted.',
+        )
+        parser.add_argument('--sink-port', type=int, default=0, help='Port for the local provider sink')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark firms and logs')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        firm_numbers = self.setup_firms(options['firms'])
+        users = [(f'9990{index:07d}', f'Bench User {index}') for index in range(options['users'])]
+        user_firms = {wa_id: rng.choice(firm_numbers) for wa_id, _ in users}
+        deliveries = self.build_deliveries(users, user_firms, options, rng)
+
+        sink = ProviderSink(port=options['sink_port']).start()
+        self.stdout.write(f'Provider sink listening on {sink.url}')
+        counter = QueryCounter()
+        try:
+            # The test client sends Host: testserver
+            with override_settings(
+                WHATSAPP_API_URL=sink.url, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            ):
+                results = self.run(deliveries, sink, counter, options)
+        finally:
+            sink.stop()
+            if not options['keep']:
+                self.cleanup(firm_numbers)
+
+        results.update({
+            'revision': git_revision(),
+            'label': options['label'],
+            'config': {
+                key: options[key]
+                for key in ('firms', 'users', 'messages', 'batch', 'rate', 'concurrency', 'seed')
+            },
+            'webhook_workers': settings.CHATBRIDGE_WEBHOOK_WORKERS,
+            'async_views': settings.CHATBRIDGE_ASYNC_VIEWS,
+            'outbox': settings.CHATBRIDGE_OUTBOX,
+        })
+        Path(options['output']).write_text(json.dumps(results, indent=2))
+        self.stdout.write(json.dumps(results, indent=2))
+        if results['errors']:
+            raise CommandError(
+                f"{results['errors']} of {results['deliveries']} deliveries were not acknowledged "
+                f"with 200, results written to {options['output']}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def setup_firms(self, count):
+        numbers = []
+        for index in range(count):
+            number = f'{BENCH_PREFIX}{index:04d}'
+            firm, _ = Firm.objects.update_or_create(
+                name=f'{BENCH_PREFIX}firm-{index}',
+                defaults={'phone_number': number, 'status': True, 'first_step': 'start'},
+            )
+            set_flow(firm, BENCH_FLOW)
+            firm.save()
+            numbers.append(number)
+        return numbers
+
+    def build_deliveries(self, users, user_firms, options, rng):
+        deliveries = []
+        remaining = options['messages']
+        while remaining > 0:
+            size = min(options['batch'], remaining)
+            # One delivery carries messages for a single firm number
+            firm_number = user_firms[rng.choice(users)[0]]
+            candidates = [user for user in users if user_firms[user[0]] == firm_number]
+            messages = [
+                (wa_id, name, rng.choice(INPUTS), f'{BENCH_MESSAGE_PREFIX}{uuid.uuid4().hex}')
+                for wa_id, name in (rng.choice(candidates) for _ in range(size))
+            ]
+            deliveries.append((firm_number, messages))
+            remaining -= size
+        return deliveries
+
+    def run(self, deliveries, sink, counter, options):
+        ack_latencies = []
+        errors = 0
+        lock = threading.Lock()
+        local = threading.local()
+        sequence = itertools.count()
+        interval = 1 / options['rate'] if options['rate'] > 0 else 0
+
+        def post(delivery):
+            nonlocal errors
+            index = next(sequence)
+            if interval:
+                delay = started + index * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            firm_number, messages = delivery
+            body = json.dumps(build_webhook_payload(firm_number, messages))
+            sent_at = time.perf_counter()
+            for wa_id, _, _, _ in messages:
+                sink.expect_reply(wa_id, sent_at)
+            if options['url']:
+                if not hasattr(local, 'session'):
+                    local.session = requests.Session()
+                response = local.session.post(
+                    options['url'], data=body, headers={'Content-Type': 'application/json'}
+                )
+            else:
+                if not hasattr(local, 'client'):
+                    local.client = Client()
+                response = local.client.post('/chatbridge/webhook/', body, content_type='application/json')
+            elapsed = time.perf_counter() - sent_at
+            with lock:
+                ack_latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors += 1
+
+        counter.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(post, deliveries))
+        acked = time.perf_counter() - started
+
+        total = sum(len(messages) for _, messages in deliveries)
+        deadline = time.perf_counter() + options['drain_timeout']
+        while time.perf_counter() < deadline:
+            if sink.calls >= total and (options['url'] or get_webhook_pool().depth() == 0):
+                break
+            time.sleep(0.05)
+        if not options['url']:
+            get_message_log_writer().flush()
+        processed = time.perf_counter() - started
+        counter.stop()
+        queries = None if options['url'] else counter.count
+
+        return {
+            'deliveries': len(deliveries),
+            'messages': total,
+            'errors': errors,
+            'ack_seconds': round(acked, 3),
+            'processed_seconds': round(processed, 3),
+            'ack_throughput_per_second': round(total / acked, 1) if acked else None,
+            'processed_throughput_per_second': round(total / processed, 1) if processed else None,
+            'ack_latency': latency_summary(ack_latencies),
+            'reply_latency': latency_summary(sink.reply_latencies),
+            'db_queries': queries,
+            'db_queries_per_message': round(queries / total, 3) if total and queries is not None else None,
+            'outbound_calls': sink.calls,
+            'outbound_calls_per_message': round(sink.calls / total, 3) if total else None,
+        }
+
+    def cleanup(self, firm_numbers):
+        MessageLog.objects.filter(firm_phone_number__in=firm_numbers).delete()
+        OutboxMessage.objects.filter(firm_phone_number__in=firm_numbers).delete()
+        ProcessedMessage.objects.filter(message_id__startswith=BENCH_MESSAGE_PREFIX).delete()
+        Firm.objects.filter(name__startswith=BENCH_PREFIX).delete()
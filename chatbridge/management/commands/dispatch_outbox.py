@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from chatbridge.outbox import get_outbox_dispatcher, outbox_backlog
+
+
+class Command(BaseCommand):
+    help = (
+        'Send the bot replies waiting in the outbox. Runs until interrupted; several '
+        'dispatchers can run side by side. Use with CHATBRIDGE_OUTBOX_IN_PROCESS off.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send the replies due now and exit')
+
+    def handle(self, *args, **options):
+        dispatcher = get_outbox_dispatcher()
+        if options['once']:
+            sent = 0
+            while True:
+                claimed = dispatcher.dispatch_batch()
+                sent += claimed
+                if claimed < dispatcher.batch_size:
+                    break
+            self.stdout.write(f'Dispatched {sent} replies, {outbox_backlog()} still pending.')
+            return
+        self.stdout.write(f'Dispatching the outbox ({outbox_backlog()} replies pending).')
+        try:
+            dispatcher.run()
+        except KeyboardInterrupt:
+            dispatcher.close()
+        stats = dispatcher.snapshot()
+        self.stdout.write(f"Sent {stats['sent']} replies, retried {stats['retried']}, gave up on {stats['failed']}.")
@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbridge.export import EXPORT_FORMATS, InvalidExportRange, iter_message_logs, parse_bound
+
+
+class Command(BaseCommand):
+    help = 'Stream MessageLog rows as CSV or NDJSON, optionally filtered by firm and time range.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--firm', dest='firm_phone_number', help="Only this firm's display phone number")
+        parser.add_argument('--start', help='Inclusive start, ISO date or datetime (UTC if naive)')
+        parser.add_argument('--end', help='Exclusive end, ISO date or datetime (UTC if naive)')
+        parser.add_argument('--format', default='csv', choices=sorted(EXPORT_FORMATS))
+        parser.add_argument('--output', default='-', help='File to write, - for stdout')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows fetched per query')
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_bound(options['start'])
+            end = parse_bound(options['end'])
+        except InvalidExportRange as e:
+            raise CommandError(str(e))
+        lines, _ = EXPORT_FORMATS[options['format']]
+        rows = iter_message_logs(options['firm_phone_number'], start, end, options['chunk_size'])
+        output = sys.stdout if options['output'] == '-' else open(options['output'], 'w', encoding='utf-8', newline='')
+        try:
+            for line in lines(rows):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
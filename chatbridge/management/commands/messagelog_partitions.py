@@ -0,0 +1,129 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chatbridge.archive import archive_dir, archive_window, discard_archive
+from chatbridge.dedup import prune_processed_messages
+from chatbridge.models import MessageLog
+from chatbridge.outbox import prune_outbox
+from chatbridge.partitions import (
+    drop_partition, ensure_partitions, list_partitions, next_window, partition_name,
+    supports_partitioning, window_start,
+)
+
+
+def aware(moment):
+    return moment.replace(tzinfo=datetime.timezone.utc) if moment is not None else None
+
+
+class Command(BaseCommand):
+    help = (
+        'Maintain MessageLog time partitions. "ensure" creates partitions for upcoming '
+        'windows; "archive" also writes partitions past the retention period to gzipped '
+        'NDJSON files, drops them and prunes the dedup ledger and the outbox; "status" lists partitions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', default='archive', choices=['status', 'ensure', 'archive'])
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be done')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows read or deleted per query')
+
+    def handle(self, *args, **options):
+        self.interval = settings.CHATBRIDGE_MESSAGELOG_PARTITION_INTERVAL
+        self.dry_run = options['dry_run']
+        self.chunk_size = options['chunk_size']
+        now = timezone.now()
+
+        if options['action'] == 'status':
+            self.status()
+            return
+        if supports_partitioning():
+            created = ensure_partitions(now, self.interval, settings.CHATBRIDGE_MESSAGELOG_PARTITIONS_AHEAD, self.dry_run)
+            self.stdout.write(f"{'Would create' if self.dry_run else 'Created'} partitions: {', '.join(created) or 'none'}")
+        if options['action'] == 'ensure':
+            return
+
+        cutoff = aware(window_start(now - datetime.timedelta(days=settings.CHATBRIDGE_MESSAGELOG_RETENTION_DAYS), self.interval))
+        if supports_partitioning():
+            self.archive_partitions(cutoff)
+        else:
+            self.archive_windows(cutoff)
+
+        ledger_cutoff = now - datetime.timedelta(days=settings.CHATBRIDGE_DEDUP_RETENTION_DAYS)
+        if not self.dry_run:
+            pruned = prune_processed_messages(ledger_cutoff, self.chunk_size)
+            self.stdout.write(f'Pruned {pruned} processed message ids.')
+            outbox_cutoff = now - datetime.timedelta(days=settings.CHATBRIDGE_OUTBOX_RETENTION_DAYS)
+            pruned = prune_outbox(outbox_cutoff, self.chunk_size)
+            self.stdout.write(f'Pruned {pruned} outbox rows.')
+
+    def status(self):
+        if not supports_partitioning():
+            self.stdout.write('MessageLog is not partitioned on this database.')
+            return
+        for partition in list_partitions():
+            upper = f'< {partition.upper:%Y-%m-%d}' if partition.upper else '(catch-all)'
+            self.stdout.write(f'{partition.name:<12} {upper:<14} ~{partition.rows} rows')
+        self.stdout.write(f'Archives in {archive_dir()}')
+
+    def archive_partitions(self, cutoff):
+        lower = None
+        for partition in list_partitions():
+            if partition.upper is None or aware(partition.upper) > cutoff:
+                break
+            upper = aware(partition.upper)
+            if self.dry_run:
+                self.stdout.write(f'Would archive and drop {partition.name} (~{partition.rows} rows)')
+            else:
+                self.archive(partition.name, lower, upper)
+                drop_partition(partition.name)
+                self.stdout.write(f'Dropped partition {partition.name}')
+            lower = upper
+
+    def archive_windows(self, cutoff):
+        # Without partitioning, archive window by window and delete in chunks
+        oldest = MessageLog.objects.filter(timestamp__lt=cutoff).order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            self.stdout.write('Nothing to archive.')
+            return
+        lower = aware(window_start(oldest, self.interval))
+        while lower < cutoff:
+            upper = aware(next_window(lower.replace(tzinfo=None), self.interval))
+            name = partition_name(upper.replace(tzinfo=None))
+            if self.dry_run:
+                rows = MessageLog.objects.filter(timestamp__gte=lower, timestamp__lt=upper).count()
+                self.stdout.write(f'Would archive and delete {name} ({rows} rows)')
+            else:
+                self.archive(name, lower, upper)
+                deleted = self.delete_window(lower, upper)
+                self.stdout.write(f'Deleted {deleted} rows of {name}')
+            lower = upper
+
+    def archive(self, name, lower, upper):
+        entry = archive_window(name, lower, upper, self.chunk_size)
+        window = MessageLog.objects.filter(timestamp__lt=upper)
+        if lower is not None:
+            window = window.filter(timestamp__gte=lower)
+        # Refuse to drop rows that reached the window while it was archived
+        archived = entry['rows'] if entry else 0
+        remaining = window.count()
+        if remaining != archived:
+            if entry:
+                discard_archive(entry)
+            raise CommandError(
+                f'{name}: archived {archived} rows but {remaining} are in the database; not dropping it. '
+                f'Run the command again once writes to the window have stopped.'
+            )
+        if entry:
+            self.stdout.write(f"Archived {archived} rows of {name} to {entry['file']}")
+
+    def delete_window(self, lower, upper):
+        window = MessageLog.objects.filter(timestamp__gte=lower, timestamp__lt=upper)
+        deleted = 0
+        while True:
+            ids = list(window.values_list('id', flat=True)[:self.chunk_size])
+            if not ids:
+                return deleted
+            deleted += MessageLog.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chatbridge.writer import get_message_log_writer
+
+
+class Command(BaseCommand):
+    help = 'Insert MessageLog rows left in the spool file by failed buffered writes.'
+
+    def handle(self, *args, **options):
+        count = get_message_log_writer().replay_spool()
+        self.stdout.write(f'Replayed {count} MessageLog rows.')
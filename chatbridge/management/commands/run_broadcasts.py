@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from chatbridge.broadcast import run_broadcast
+from chatbridge.models import BroadcastJob
+
+
+class Command(BaseCommand):
+    help = 'Send queued broadcast jobs, for deployments that set CHATBRIDGE_BROADCAST_IN_PROCESS off.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_ids', nargs='*', type=int, help='Only these jobs (default: every queued job)')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Also resume jobs marked as running, whose process died. Make sure no other process is running them.',
+        )
+
+    def handle(self, *args, **options):
+        statuses = ['queued', 'running'] if options['resume'] else ['queued']
+        jobs = BroadcastJob.objects.filter(status__in=statuses).order_by('id')
+        if options['job_ids']:
+            jobs = jobs.filter(pk__in=options['job_ids'])
+        for job_id in list(jobs.values_list('id', flat=True)):
+            job = run_broadcast(job_id, resume=options['resume'])
+            if job is None:
+                self.stdout.write(f'Broadcast {job_id} was claimed by another runner.')
+                continue
+            self.stdout.write(f'Broadcast {job.pk} {job.status}: {job.sent} sent, {job.failed} failed of {job.total}.')
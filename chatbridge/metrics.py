@@ -0,0 +1,302 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+import bisect
+import math
+import threading
+import time
+
+# In-process metrics for the webhook hot path, rendered in the Prometheus
+# text exposition format by the chatbridge metrics view. Every process keeps
+# its own counters, so with several worker processes each scrape sees the
+# process that answered it; run one scrape target per process (or a single
+# process) when the numbers need to add up.
+
+# Upper bounds, in seconds, of the stage duration buckets
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds, in seconds, of the outbound scheduling wait buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Sample(NamedTuple):
+    suffix: str
+    labels: Dict[str, str]
+    value: float
+
+
+class MetricFamily(NamedTuple):
+    name: str
+    type: str
+    documentation: str
+    samples: List[Sample]
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def collect(self) -> MetricFamily:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A monotonically increasing count per label set."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            values = list(self._values.items())
+        return MetricFamily(
+            self.name, self.type, self.documentation,
+            [Sample('', self._labels(key), value) for key, value in values],
+        )
+
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets per label set, with their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append(Sample('_bucket', dict(labels, le=format_value(bound)), cumulative))
+            samples.append(Sample('_sum', labels, total))
+            samples.append(Sample('_count', labels, count))
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+
+class Registry:
+    """
+    The metrics of a process, and collectors that read gauges (queue
+    depths, buffer sizes, ...) from the running components at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], Iterable[MetricFamily]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]) -> None:
+        self._collectors.append(collector)
+
+    def collect(self) -> Iterator[MetricFamily]:
+        for metric in self._metrics:
+            yield metric.collect()
+        for collector in self._collectors:
+            yield from collector()
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition, one line per sample
+        """
+        lines = []
+        for family in self.collect():
+            lines.append(f'# HELP {family.name} {escape_help(family.documentation)}')
+            lines.append(f'# TYPE {family.name} {family.type}')
+            for sample in family.samples:
+                labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in sample.labels.items())
+                labels = f'{{{labels}}}' if labels else ''
+                lines.append(f'{family.name}{sample.suffix}{labels} {format_value(sample.value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def gauge(name: str, documentation: str, value: float, **labels: str) -> MetricFamily:
+    return MetricFamily(name, 'gauge', documentation, [Sample('', labels, value)])
+
+
+REGISTRY = Registry()
+
+WEBHOOK_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'chatbridge_webhook_stage_seconds',
+    'Time spent in each stage of webhook handling. decode and the batch stages '
+    '(dedup, firm_lookup, chat_user_fetch, state_save) are observed once per '
+    'delivery or batch, the others once per message.',
+    ['stage'],
+))
+WEBHOOK_STAGE_FAILURES = REGISTRY.register(Counter(
+    'chatbridge_webhook_stage_failures_total',
+    'Webhook stages that raised an exception.',
+    ['stage'],
+))
+WEBHOOK_REQUESTS = REGISTRY.register(Counter(
+    'chatbridge_webhook_requests_total',
+    'Webhook deliveries by response status.',
+    ['status'],
+))
+WEBHOOK_EVENTS = REGISTRY.register(Counter(
+    'chatbridge_webhook_events_total',
+    'Inbound message events by outcome: received, duplicate, unknown_firm (no firm '
+    'has the phone number) and advanced (the conversation moved to a next step).',
+    ['outcome'],
+))
+OUTBOUND_MESSAGES = REGISTRY.register(Counter(
+    'chatbridge_outbound_messages_total',
+    'Replies handed to the WhatsApp API, by result.',
+    ['result'],
+))
+OUTBOUND_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'chatbridge_outbound_wait_seconds',
+    'Time outbound sends waited for the scheduler, by priority.',
+    ['priority'],
+    buckets=WAIT_BUCKETS,
+))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a stage of webhook handling into chatbridge_webhook_stage_seconds.
+
+    Works around awaits too, in which case the time spent waiting counts.
+
+    Args:
+        name (str): The stage label
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        WEBHOOK_STAGE_FAILURES.inc(name)
+        raise
+    finally:
+        WEBHOOK_STAGE_SECONDS.observe(time.perf_counter() - start, name)
+
+
+def runtime_metrics() -> Iterator[MetricFamily]:
+    # Imported here: these modules import this one for their own metrics
+    from django.conf import settings
+
+    from firms.rollups import get_rollups
+    from .dedup import dedup_snapshot
+    from .scheduler import get_scheduler
+    from .writer import get_message_log_writer
+
+    if settings.CHATBRIDGE_ASYNC_VIEWS:
+        from .async_views import webhook_runner
+        yield gauge('chatbridge_webhook_in_flight', 'Webhook batches being processed on the event loop.', webhook_runner.in_flight())
+    else:
+        from .worker import get_webhook_pool
+        pool = get_webhook_pool()
+        yield MetricFamily(
+            'chatbridge_webhook_queue_depth', 'gauge', 'Events waiting in each webhook worker queue.',
+            [Sample('', {'queue': str(index)}, depth) for index, depth in enumerate(pool.depths())],
+        )
+
+    writer = get_message_log_writer().snapshot()
+    yield gauge('chatbridge_messagelog_buffered_rows', 'MessageLog rows waiting to be written.', writer['buffered'])
+    yield MetricFamily('chatbridge_messagelog_rows_written_total', 'counter', 'MessageLog rows written by the buffered writer.',
+                       [Sample('', {}, writer['rows_written'])])
+    yield MetricFamily('chatbridge_messagelog_rows_spooled_total', 'counter', 'MessageLog rows spooled to disk after a failed write.',
+                       [Sample('', {}, writer['rows_spooled'])])
+    yield MetricFamily('chatbridge_messagelog_flushes_total', 'counter', 'MessageLog writer flushes.',
+                       [Sample('', {}, writer['flushes'])])
+    yield gauge('chatbridge_messagelog_last_flush_seconds', 'Duration of the last MessageLog flush.', writer['last_flush_seconds'])
+
+    dedup = dedup_snapshot()
+    yield MetricFamily('chatbridge_dedup_checked_total', 'counter', 'Inbound message ids checked for redelivery.',
+                       [Sample('', {}, dedup['checked'])])
+    yield MetricFamily('chatbridge_dedup_duplicates_total', 'counter', 'Provider redeliveries dropped.',
+                       [Sample('', {}, dedup['duplicates'])])
+    yield gauge('chatbridge_dedup_recent_ids', 'Message ids in the in-memory dedup cache.', dedup['recent_ids'])
+
+    scheduler = get_scheduler().snapshot()
+    yield gauge('chatbridge_outbound_in_flight', 'Outbound sends holding a scheduler slot.', scheduler['in_flight'])
+    yield MetricFamily(
+        'chatbridge_outbound_queue_depth', 'gauge', 'Outbound sends waiting for the scheduler, by firm and priority.',
+        [Sample('', {'firm': firm, 'priority': priority}, depth)
+         for firm, state in scheduler['firms'].items() for priority, depth in state['queued'].items()],
+    )
+    yield MetricFamily(
+        'chatbridge_outbound_firm_sends_total', 'counter', 'Outbound sends granted by the scheduler, by firm.',
+        [Sample('', {'firm': firm}, state['sent']) for firm, state in scheduler['firms'].items()],
+    )
+    yield MetricFamily(
+        'chatbridge_outbound_firm_wait_seconds_max', 'gauge', 'Longest scheduler wait of a send, by firm.',
+        [Sample('', {'firm': firm}, state['wait_max_ms'] / 1000) for firm, state in scheduler['firms'].items()],
+    )
+
+    if settings.CHATBRIDGE_OUTBOX:
+        from .outbox import get_outbox_dispatcher, outbox_backlog
+        outbox = get_outbox_dispatcher().snapshot()
+        yield gauge('chatbridge_outbox_pending_rows', 'Replies waiting in the outbox, across all dispatchers.', outbox_backlog())
+        yield MetricFamily('chatbridge_outbox_batches_total', 'counter', 'Outbox batches dispatched by this process.',
+                           [Sample('', {}, outbox['batches'])])
+        yield MetricFamily('chatbridge_outbox_retries_total', 'counter', 'Failed reply sends scheduled for a retry.',
+                           [Sample('', {}, outbox['retried'])])
+        yield MetricFamily('chatbridge_outbox_abandoned_total', 'counter', 'Replies given up after the maximum attempts.',
+                           [Sample('', {}, outbox['failed'])])
+
+    rollups = get_rollups().snapshot()
+    yield gauge('chatbridge_rollup_pending_rows', 'Firm rollup rows with counts waiting to be flushed.',
+                rollups['hourly_rows'] + rollups['transition_rows'])
+
+
+REGISTRY.register_collector(runtime_metrics)
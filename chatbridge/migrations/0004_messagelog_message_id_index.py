@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbridge', '0003_messagelog_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messagelog',
+            name='message_id',
+            field=models.CharField(blank=True, db_index=True, max_length=128, null=True),
+        ),
+    ]
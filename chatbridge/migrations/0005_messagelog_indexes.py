@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbridge', '0004_messagelog_message_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['firm_phone_number', 'phone_number', 'timestamp'], name='messagelog_conversation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['firm_phone_number', 'timestamp'], name='messagelog_firm_time_idx'),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:02
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_processed_messages(apps, schema_editor):
+    """
+    Seed the dedup ledger with the message ids logged within the retention
+    period; older ones would be pruned straight away.
+    """
+    MessageLog = apps.get_model('chatbridge', 'MessageLog')
+    ProcessedMessage = apps.get_model('chatbridge', 'ProcessedMessage')
+    since = django.utils.timezone.now() - datetime.timedelta(days=settings.CHATBRIDGE_DEDUP_RETENTION_DAYS)
+    rows = (
+        MessageLog.objects.exclude(message_id=None)
+        .exclude(message_id='')
+        .filter(timestamp__gte=since)
+        .values_list('message_id', 'timestamp')
+    )
+    batch = []
+    for message_id, timestamp in rows.iterator(chunk_size=5000):
+        batch.append(ProcessedMessage(message_id=message_id, received_at=timestamp))
+        if len(batch) >= 5000:
+            ProcessedMessage.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    ProcessedMessage.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def initial_upper_bound():
+    # Existing rows all go into one partition ending at the next window
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if settings.CHATBRIDGE_MESSAGELOG_PARTITION_INTERVAL == 'day':
+        return today + datetime.timedelta(days=1)
+    return today.replace(day=1, year=today.year + today.month // 12, month=today.month % 12 + 1)
+
+
+def partition_messagelog(apps, schema_editor):
+    """
+    Range-partition MessageLog on timestamp (MySQL only).
+
+    MySQL requires the partitioning column in every unique key, so the
+    primary key becomes (id, timestamp); id stays unique through
+    AUTO_INCREMENT.
+    """
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    table = schema_editor.quote_name(apps.get_model('chatbridge', 'MessageLog')._meta.db_table)
+    upper = initial_upper_bound()
+    schema_editor.execute(f'ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `timestamp`)')
+    schema_editor.execute(
+        f'ALTER TABLE {table} PARTITION BY RANGE COLUMNS(`timestamp`) ('
+        f"PARTITION {upper:p%Y%m%d} VALUES LESS THAN ('{upper:%Y-%m-%d %H:%M:%S}'), "
+        f'PARTITION pfuture VALUES LESS THAN (MAXVALUE))'
+    )
+
+
+def unpartition_messagelog(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    table = schema_editor.quote_name(apps.get_model('chatbridge', 'MessageLog')._meta.db_table)
+    schema_editor.execute(f'ALTER TABLE {table} REMOVE PARTITIONING')
+    schema_editor.execute(f'ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (`id`)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbridge', '0005_messagelog_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedMessage',
+            fields=[
+                ('message_id', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('received_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(fill_processed_messages, migrations.RunPython.noop),
+        migrations.RunPython(partition_messagelog, unpartition_messagelog),
+    ]
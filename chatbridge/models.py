@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 
@@ -10,13 +11,124 @@ class MessageLog(models.Model):
     direction = models.CharField(max_length=3, choices=DIRECTION_CHOICES)
     phone_number = models.CharField(max_length=20)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the row is created rather than when it is inserted, so rows
+    # buffered by chatbridge.writer keep their receive time
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     status = models.CharField(max_length=50, blank=True)
     # New fields for WhatsApp message details
     whatsapp_business_account_id = models.CharField(max_length=64, blank=True)
     firm_phone_number = models.CharField(max_length=20, blank=True)
     user_name = models.CharField(max_length=255, blank=True)
-    message_id = models.CharField(max_length=128, blank=True)
+    # WhatsApp's id for inbound messages. Not unique: the table is
+    # partitioned by timestamp on MySQL, and every unique key of a
+    # partitioned table must include the partitioning column. Redeliveries
+    # are rejected through ProcessedMessage instead.
+    message_id = models.CharField(max_length=128, blank=True, null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # One conversation's history, newest first (InnoDB appends the pk)
+            models.Index(fields=['firm_phone_number', 'phone_number', 'timestamp'], name='messagelog_conversation_idx'),
+            # A firm's traffic over a time range
+            models.Index(fields=['firm_phone_number', 'timestamp'], name='messagelog_firm_time_idx'),
+        ]
 
     def __str__(self):
         return f"{self.direction} - {self.phone_number} - {self.timestamp}"
+
+
+class ProcessedMessage(models.Model):
+    """
+    Ledger of inbound WhatsApp message ids that have been accepted, used to
+    drop provider redeliveries. Rows are pruned after
+    CHATBRIDGE_DEDUP_RETENTION_DAYS.
+    """
+    message_id = models.CharField(max_length=128, primary_key=True)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.message_id
+
+
+class BroadcastJob(models.Model):
+    """
+    A message sent by a firm to many recipients in the background (see
+    chatbridge.broadcast): either a list of phone numbers, or the firm's
+    chat users matching filters.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    firm_phone_number = models.CharField(max_length=20)
+    message = models.TextField()
+    # Exactly one of the two is set
+    recipients = models.JSONField(null=True, blank=True)
+    filters = models.JSONField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued', db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # Where an interrupted job resumes: the index of the next recipient in
+    # the list, or the last ChatUser id handled
+    position = models.PositiveBigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.firm_phone_number} - {self.status} - {self.sent}/{self.total}"
+
+
+class OutboxMessage(models.Model):
+    """
+    A bot reply waiting to be sent. Written in the same transaction as the
+    conversation step change that produced it, and sent by
+    chatbridge.outbox.OutboxDispatcher.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    firm_phone_number = models.CharField(max_length=20)
+    phone_number = models.CharField(max_length=20)
+    message = models.TextField()
+    whatsapp_business_account_id = models.CharField(max_length=64, blank=True)
+    user_name = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # A pending row can be claimed from this moment on; claiming it pushes
+    # this forward by the lease, a failed send by the retry backoff
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Claiming due rows, and pruning sent ones
+            models.Index(fields=['status', 'available_at'], name='outbox_status_available_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.firm_phone_number} -> {self.phone_number} - {self.status}"
+
+
+class WebhookDelivery(models.Model):
+    """
+    The message events of a webhook delivery, written before the delivery
+    is acknowledged and deleted once they have been processed, so events
+    lost with a process are handled again (see chatbridge.inbox).
+    """
+    events = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    # The inbox sweep may claim the row from this moment on; writing it and
+    # claiming it push this forward by the lease
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.pk} - {len(self.events)} events - {self.attempts} attempts"
@@ -0,0 +1,317 @@
+from contextlib import AbstractAsyncContextManager, AbstractContextManager, nullcontext
+from typing import Callable, Optional
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+import requests
+
+from .scheduler import REPLY, get_scheduler
+
+try:
+    import httpx
+except ImportError:  # httpx is only needed by the async client
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Provider responses worth retrying: throttling and server errors
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[str] = None) -> float:
+    """
+    Compute the delay before a retry using exponential backoff with full jitter.
+
+    Args:
+        attempt (int): The zero-based number of the attempt that failed
+        base (float): The delay scale in seconds
+        cap (float): The maximum delay in seconds
+        retry_after (Optional[str]): The provider's Retry-After header, if any
+
+    Returns:
+        float: Seconds to wait before the next attempt
+    """
+    if retry_after:
+        try:
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class WhatsAppClient:
+    """
+    Thread-safe client for the WhatsApp send API.
+
+    Connections are kept alive in a shared pool, every request has connect
+    and read timeouts, the number of in-flight requests is bounded and
+    throttled or failed requests are retried with jittered backoff.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        api_token: str,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        pool_size: int = 20,
+        max_concurrency: int = 20,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+    ):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Authorization'] = f'Bearer {api_token}'
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def send(
+        self,
+        to_number: str,
+        message: str,
+        slot: Callable[[], AbstractContextManager] = nullcontext,
+    ) -> bool:
+        """
+        Send a text message, retrying throttled and failed attempts.
+
+        Args:
+            to_number (str): The recipient's phone number
+            message (str): The message to send
+            slot (Callable[[], AbstractContextManager]): Called for each
+                attempt; the request is made inside the context it returns,
+                and backoff delays outside it
+
+        Returns:
+            bool: True if message was sent successfully, False otherwise
+        """
+        payload = {'to': to_number, 'message': message}
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                with slot(), self._slots:
+                    response = self.session.post(self.api_url, json=payload, timeout=self.timeout)
+                if response.status_code == 200:
+                    return True
+                if response.status_code not in RETRY_STATUSES:
+                    logger.error('WhatsApp API rejected message to %s: %s', to_number, response.status_code)
+                    return False
+                retry_after = response.headers.get('Retry-After')
+                logger.warning('WhatsApp API returned %s for %s (attempt %d)', response.status_code, to_number, attempt + 1)
+            except requests.ReadTimeout as e:
+                # The provider may have accepted the message; do not send it twice
+                logger.error('Timed out waiting for WhatsApp API: %s', e)
+                return False
+            except requests.RequestException as e:
+                logger.warning('Error sending WhatsApp message (attempt %d): %s', attempt + 1, e)
+            if attempt < self.max_retries:
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after))
+        logger.error('Giving up sending WhatsApp message to %s', to_number)
+        return False
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncWhatsAppClient:
+    """
+    asyncio counterpart of WhatsAppClient for ASGI deployments.
+
+    Requires the optional httpx package. An instance must only be used from
+    the event loop it was first used on.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        api_token: str,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        pool_size: int = 20,
+        max_concurrency: int = 20,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+    ):
+        if httpx is None:
+            raise ImproperlyConfigured('AsyncWhatsAppClient requires the httpx package.')
+        self.api_url = api_url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.client = httpx.AsyncClient(
+            headers={'Authorization': f'Bearer {api_token}'},
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self._slots = asyncio.BoundedSemaphore(max_concurrency)
+
+    async def send(
+        self,
+        to_number: str,
+        message: str,
+        slot: Callable[[], AbstractAsyncContextManager] = nullcontext,
+    ) -> bool:
+        """
+        Send a text message, retrying throttled and failed attempts.
+
+        Args:
+            to_number (str): The recipient's phone number
+            message (str): The message to send
+            slot (Callable[[], AbstractAsyncContextManager]): Called for each
+                attempt; the request is made inside the context it returns,
+                and backoff delays outside it
+
+        Returns:
+            bool: True if message was sent successfully, False otherwise
+        """
+        payload = {'to': to_number, 'message': message}
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with slot(), self._slots:
+                    response = await self.client.post(self.api_url, json=payload)
+                if response.status_code == 200:
+                    return True
+                if response.status_code not in RETRY_STATUSES:
+                    logger.error('WhatsApp API rejected message to %s: %s', to_number, response.status_code)
+                    return False
+                retry_after = response.headers.get('Retry-After')
+                logger.warning('WhatsApp API returned %s for %s (attempt %d)', response.status_code, to_number, attempt + 1)
+            except httpx.ReadTimeout as e:
+                logger.error('Timed out waiting for WhatsApp API: %s', e)
+                return False
+            except httpx.HTTPError as e:
+                logger.warning('Error sending WhatsApp message (attempt %d): %s', attempt + 1, e)
+            if attempt < self.max_retries:
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after))
+        logger.error('Giving up sending WhatsApp message to %s', to_number)
+        return False
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+def client_options() -> dict:
+    return {
+        'api_url': settings.WHATSAPP_API_URL,
+        'api_token': settings.WHATSAPP_API_TOKEN,
+        'connect_timeout': settings.WHATSAPP_API_CONNECT_TIMEOUT,
+        'read_timeout': settings.WHATSAPP_API_READ_TIMEOUT,
+        'pool_size': settings.WHATSAPP_API_POOL_SIZE,
+        'max_concurrency': settings.WHATSAPP_API_MAX_CONCURRENCY,
+        'max_retries': settings.WHATSAPP_API_MAX_RETRIES,
+        'backoff_base': settings.WHATSAPP_API_BACKOFF_BASE,
+        'backoff_max': settings.WHATSAPP_API_BACKOFF_MAX,
+    }
+
+
+_client: Optional[WhatsAppClient] = None
+_async_client: Optional[AsyncWhatsAppClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> WhatsAppClient:
+    """
+    Get the process-wide WhatsApp client configured from settings.
+
+    Returns:
+        WhatsAppClient: The shared client
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WhatsAppClient(**client_options())
+    return _client
+
+
+def get_async_client() -> AsyncWhatsAppClient:
+    """
+    Get the process-wide async WhatsApp client configured from settings.
+
+    Returns:
+        AsyncWhatsAppClient: The shared client
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncWhatsAppClient(**client_options())
+    return _async_client
+
+
+@receiver(setting_changed)
+def reset_clients(setting, **kwargs):
+    # Rebuild the shared clients when their settings change (e.g. in
+    # override_settings blocks or benchmarks pointing at a local sink)
+    global _client, _async_client
+    if setting.startswith('WHATSAPP_API_'):
+        with _client_lock:
+            if _client is not None:
+                _client.close()
+            _client = None
+            _async_client = None
+
+
+def send_whatsapp_message(to_number: str, message: str, firm_phone_number: str = '', priority: str = REPLY) -> bool:
+    """
+    Send a WhatsApp message using the configured API.
+
+    Each attempt waits for its turn in the outbound scheduler, which rate
+    limits each firm number and shares the API fairly between firms. Retries
+    wait for a new turn, so the backoff between attempts does not hold a
+    scheduler slot and every attempt spends a token.
+
+    Args:
+        to_number (str): The recipient's phone number
+        message (str): The message to send
+        firm_phone_number (str): The sending firm's phone number
+        priority (str): scheduler.REPLY for conversation replies, scheduler.BULK for bulk sends
+
+    Returns:
+        bool: True if message was sent successfully, False otherwise
+    """
+    try:
+        logger.debug('Sending WhatsApp message to %s', to_number)
+        scheduler = get_scheduler()
+        return get_client().send(to_number, message, slot=lambda: scheduler.slot(firm_phone_number, priority))
+    except Exception as e:
+        logger.error('Error sending WhatsApp message: %s', e)
+        return False
+
+
+async def asend_whatsapp_message(to_number: str, message: str, firm_phone_number: str = '', priority: str = REPLY) -> bool:
+    """
+    Async version of send_whatsapp_message.
+
+    Args:
+        to_number (str): The recipient's phone number
+        message (str): The message to send
+        firm_phone_number (str): The sending firm's phone number
+        priority (str): scheduler.REPLY for conversation replies, scheduler.BULK for bulk sends
+
+    Returns:
+        bool: True if message was sent successfully, False otherwise
+    """
+    try:
+        logger.debug('Sending WhatsApp message to %s', to_number)
+        scheduler = get_scheduler()
+        return await get_async_client().send(
+            to_number, message, slot=lambda: scheduler.aslot(firm_phone_number, priority),
+        )
+    except Exception as e:
+        logger.error('Error sending WhatsApp message: %s', e)
+        return False
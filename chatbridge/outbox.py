@@ -0,0 +1,345 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+import datetime
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, Min, OuterRef
+from django.utils import timezone
+
+from firms.rollups import get_rollups
+from firms.utils import get_firms_by_phone
+from .metrics import OUTBOUND_MESSAGES
+from .models import MessageLog, OutboxMessage
+from .outbound import backoff_delay, send_whatsapp_message
+
+logger = logging.getLogger(__name__)
+
+# Backoff between failed sends of a reply, in seconds
+RETRY_BASE = 1.0
+RETRY_MAX = 300.0
+
+
+def enqueue_replies(replies: List[Tuple[dict, str]]) -> None:
+    """
+    Write bot replies to the outbox. Call inside the transaction that saves
+    the conversation states; the dispatcher is woken once it commits.
+
+    Args:
+        replies (List[Tuple[dict, str]]): (message event, reply) pairs, in
+            the order they are to be sent
+    """
+    if not replies:
+        return
+    OutboxMessage.objects.bulk_create([
+        OutboxMessage(
+            firm_phone_number=event['firm_phone_number'],
+            phone_number=event['wa_id'],
+            message=response_message,
+            whatsapp_business_account_id=event['waba_id'],
+            user_name=event['profile_name'],
+        )
+        for event, response_message in replies
+    ])
+    transaction.on_commit(get_outbox_dispatcher().wake)
+
+
+class OutboxDispatcher:
+    """
+    Sends pending OutboxMessage rows in batches.
+
+    A batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased by
+    pushing its available_at lease seconds ahead, in a short transaction,
+    so several dispatchers can drain the outbox side by side and the rows
+    of a dispatcher that dies are claimed again once their lease runs out.
+    While a batch is being sent, the lease of its unfinished conversations
+    is renewed every third of the lease, so slow sends are not claimed
+    twice. Delivery is therefore at least once.
+
+    Replies to different recipients are sent concurrently, replies to one
+    recipient in order. When a send fails the reply is retried with
+    backoff and the recipient's later replies wait for it: a reply is only
+    claimed with, or after, every earlier pending reply to its recipient,
+    so neither replies written during the backoff nor replies behind rows
+    held by another dispatcher overtake them. Once a batch is done, its
+    sent rows are marked and their MessageLog rows inserted in one
+    transaction.
+    """
+
+    def __init__(self, batch_size: int, concurrency: int, poll_interval: float, lease: float, max_attempts: int):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._closed = False
+        self.stats = {
+            'batches': 0,
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'last_batch_size': 0,
+        }
+
+    def claim(self) -> List[OutboxMessage]:
+        """
+        Lease the next batch of due replies.
+
+        Returns:
+            List[OutboxMessage]: The claimed rows, oldest first
+        """
+        now = timezone.now()
+        # Earlier replies to the same recipient that are waiting for a
+        # retry or leased by another dispatcher
+        held = OutboxMessage.objects.filter(
+            status='pending',
+            available_at__gt=now,
+            firm_phone_number=OuterRef('firm_phone_number'),
+            phone_number=OuterRef('phone_number'),
+            pk__lt=OuterRef('pk'),
+        )
+        with transaction.atomic():
+            rows = list(
+                OutboxMessage.objects.select_for_update(skip_locked=True)
+                .filter(status='pending', available_at__lte=now)
+                .exclude(Exists(held))
+                .order_by('id')[:self.batch_size]
+            )
+            rows = self._first_in_line(rows)
+            if rows:
+                OutboxMessage.objects.filter(pk__in=[row.pk for row in rows]).update(
+                    available_at=now + datetime.timedelta(seconds=self.lease),
+                )
+        return rows
+
+    @staticmethod
+    def _first_in_line(rows: List[OutboxMessage]) -> List[OutboxMessage]:
+        # Rows locked by a concurrent claim are skipped without being leased
+        # yet; the recipient's later rows wait until that claim commits
+        if not rows:
+            return rows
+        claimed = {row.pk for row in rows}
+        firsts = (
+            OutboxMessage.objects.filter(status='pending', phone_number__in={row.phone_number for row in rows})
+            .values('firm_phone_number', 'phone_number')
+            .annotate(first=Min('id'))
+        )
+        waiting = {(first['firm_phone_number'], first['phone_number']) for first in firsts if first['first'] not in claimed}
+        return [row for row in rows if (row.firm_phone_number, row.phone_number) not in waiting]
+
+    def dispatch_batch(self) -> int:
+        """
+        Claim a batch of due replies, send them and record the outcome.
+
+        Returns:
+            int: The number of rows claimed
+        """
+        rows = self.claim()
+        if not rows:
+            return 0
+        conversations: Dict[Tuple[str, str], List[OutboxMessage]] = {}
+        for row in rows:
+            conversations.setdefault((row.firm_phone_number, row.phone_number), []).append(row)
+        executor = self._get_executor()
+        futures = {executor.submit(self._send_in_order, batch): batch for batch in conversations.values()}
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=self.lease / 3)
+            if pending:
+                self._renew_lease([row.pk for future in pending for row in futures[future]])
+        self._record([future.result() for future in futures])
+        return len(rows)
+
+    def _renew_lease(self, ids: List[int]) -> None:
+        try:
+            OutboxMessage.objects.filter(pk__in=ids, status='pending').update(
+                available_at=timezone.now() + datetime.timedelta(seconds=self.lease),
+            )
+        except Exception:
+            logger.exception('Error renewing the lease of %d outbox rows', len(ids))
+
+    @staticmethod
+    def _send_in_order(rows: List[OutboxMessage]) -> Tuple[List[OutboxMessage], List[OutboxMessage]]:
+        # Returns the rows sent and the rows not sent (the failed one first)
+        for index, row in enumerate(rows):
+            if not send_whatsapp_message(row.phone_number, row.message, row.firm_phone_number):
+                return rows[:index], rows[index:]
+        return rows, []
+
+    def _record(self, outcomes: List[Tuple[List[OutboxMessage], List[OutboxMessage]]]) -> None:
+        now = timezone.now()
+        sent, unsent, given_up = [], [], []
+        for sent_rows, unsent_rows in outcomes:
+            sent.extend(sent_rows)
+            if not unsent_rows:
+                continue
+            failed = unsent_rows[0]
+            failed.attempts += 1
+            if failed.attempts >= self.max_attempts:
+                failed.status = 'failed'
+                given_up.append(failed)
+                # The later replies no longer wait for it
+                retry_at = now
+            else:
+                retry_at = now + datetime.timedelta(seconds=backoff_delay(failed.attempts - 1, RETRY_BASE, RETRY_MAX))
+            for row in unsent_rows:
+                row.available_at = retry_at
+            unsent.extend(unsent_rows)
+        for row in sent:
+            row.status = 'sent'
+            row.attempts += 1
+            row.sent_at = now
+
+        with transaction.atomic():
+            OutboxMessage.objects.bulk_update(sent + unsent, ['status', 'attempts', 'available_at', 'sent_at'])
+            MessageLog.objects.bulk_create([
+                MessageLog(
+                    direction='OUT',
+                    phone_number=row.phone_number,
+                    message=row.message,
+                    timestamp=now,
+                    status=row.status,
+                    whatsapp_business_account_id=row.whatsapp_business_account_id,
+                    firm_phone_number=row.firm_phone_number,
+                    user_name=row.user_name,
+                )
+                for row in sent + given_up
+            ])
+
+        failures = len(outcomes) - sum(1 for _, unsent_rows in outcomes if not unsent_rows)
+        OUTBOUND_MESSAGES.inc('sent', amount=len(sent))
+        OUTBOUND_MESSAGES.inc('failed', amount=failures)
+        if sent:
+            rollups = get_rollups()
+            firms = get_firms_by_phone({row.firm_phone_number for row in sent})
+            for row in sent:
+                if row.firm_phone_number in firms:
+                    rollups.record_outbound(firms[row.firm_phone_number].pk, now)
+        for row in given_up:
+            logger.error('Giving up on reply %d to %s after %d attempts', row.pk, row.phone_number, row.attempts)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['sent'] += len(sent)
+            self.stats['retried'] += failures - len(given_up)
+            self.stats['failed'] += len(given_up)
+            self.stats['last_batch_size'] = len(sent) + len(unsent)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='outbox-send')
+        return self._executor
+
+    def run(self) -> None:
+        """Dispatch batches until closed, polling when the outbox is drained."""
+        while not self._closed:
+            self._wakeup.clear()
+            try:
+                claimed = self.dispatch_batch()
+            except Exception:
+                logger.exception('Error dispatching outbox batch')
+                claimed = 0
+            finally:
+                close_old_connections()
+            if claimed < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+    def wake(self) -> None:
+        """Tell the dispatcher new replies were committed."""
+        if settings.CHATBRIDGE_OUTBOX_IN_PROCESS:
+            self._ensure_started()
+        self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        # A forked worker inherits the thread object but not the thread
+        if (self._thread is not None and self._pid == os.getpid()) or self._closed:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._executor = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name='outbox-dispatcher', daemon=True)
+            self._thread.start()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, running=self._thread is not None and not self._closed)
+
+    def close(self) -> None:
+        """Stop dispatching once the current batch is done."""
+        self._closed = True
+        self._wakeup.set()
+
+
+_dispatcher: Optional[OutboxDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_outbox_dispatcher() -> OutboxDispatcher:
+    """
+    Get the process-wide outbox dispatcher configured from settings.
+
+    Returns:
+        OutboxDispatcher: The shared dispatcher
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OutboxDispatcher(
+                    batch_size=settings.CHATBRIDGE_OUTBOX_BATCH_SIZE,
+                    concurrency=settings.CHATBRIDGE_OUTBOX_CONCURRENCY,
+                    poll_interval=settings.CHATBRIDGE_OUTBOX_POLL_INTERVAL,
+                    lease=settings.CHATBRIDGE_OUTBOX_LEASE,
+                    max_attempts=settings.CHATBRIDGE_OUTBOX_MAX_ATTEMPTS,
+                )
+    return _dispatcher
+
+
+def start_outbox_dispatcher() -> None:
+    """
+    Start this process's dispatcher thread when replies go through the
+    outbox and CHATBRIDGE_OUTBOX_IN_PROCESS is on, so replies left pending
+    by a previous process are sent without waiting for a new one. Called
+    by the WSGI and ASGI entry points.
+    """
+    if settings.CHATBRIDGE_OUTBOX and settings.CHATBRIDGE_OUTBOX_IN_PROCESS:
+        get_outbox_dispatcher().wake()
+
+
+def outbox_backlog() -> int:
+    """Count the replies waiting to be sent, across all dispatchers."""
+    return OutboxMessage.objects.filter(status='pending').count()
+
+
+def prune_outbox(older_than, chunk_size: int = 5000) -> int:
+    """
+    Delete sent and abandoned outbox rows last handled before a cutoff, in
+    chunks.
+
+    Args:
+        older_than (datetime.datetime): The cutoff
+        chunk_size (int): Rows deleted per query
+
+    Returns:
+        int: The number of rows deleted
+    """
+    deleted = 0
+    while True:
+        ids = list(
+            OutboxMessage.objects.filter(status__in=['sent', 'failed'], available_at__lt=older_than)
+            .values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        deleted += OutboxMessage.objects.filter(pk__in=ids).delete()[0]
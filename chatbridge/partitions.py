@@ -0,0 +1,126 @@
+from typing import List, NamedTuple, Optional
+import datetime
+
+from django.db import connection
+
+from .models import MessageLog
+
+# Catch-all partition for rows newer than the last time window
+FUTURE_PARTITION = 'pfuture'
+
+
+class Partition(NamedTuple):
+    name: str
+    # Exclusive upper bound (UTC); None for the catch-all partition
+    upper: Optional[datetime.datetime]
+    rows: int
+
+
+def window_start(moment: datetime.datetime, interval: str) -> datetime.datetime:
+    """
+    Start of the time window containing a moment, as a naive UTC datetime.
+
+    Args:
+        moment (datetime.datetime): An aware or naive UTC datetime
+        interval (str): 'day' or 'month'
+
+    Returns:
+        datetime.datetime: The window start
+    """
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'month':
+        return start.replace(day=1)
+    if interval == 'day':
+        return start
+    raise ValueError(f'Unknown partition interval: {interval}')
+
+
+def next_window(start: datetime.datetime, interval: str) -> datetime.datetime:
+    if interval == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + datetime.timedelta(days=1)
+
+
+def partition_name(upper: datetime.datetime) -> str:
+    # Partitions are named after their exclusive upper bound
+    return upper.strftime('p%Y%m%d')
+
+
+def supports_partitioning() -> bool:
+    return connection.vendor == 'mysql'
+
+
+def table_name() -> str:
+    return MessageLog._meta.db_table
+
+
+def list_partitions() -> List[Partition]:
+    """
+    List MessageLog's partitions in order. Row counts are InnoDB estimates.
+
+    Returns:
+        List[Partition]: The partitions, empty if the table is not partitioned
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT PARTITION_NAME, TABLE_ROWS FROM information_schema.PARTITIONS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL '
+            'ORDER BY PARTITION_ORDINAL_POSITION',
+            [table_name()],
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, table_rows in rows:
+        upper = None if name == FUTURE_PARTITION else datetime.datetime.strptime(name, 'p%Y%m%d')
+        partitions.append(Partition(name, upper, table_rows or 0))
+    return partitions
+
+
+def ensure_partitions(now: datetime.datetime, interval: str, ahead: int, dry_run: bool = False) -> List[str]:
+    """
+    Split the catch-all partition so the current window and the next
+    `ahead` windows each have their own partition.
+
+    The catch-all partition only holds rows from the future, so splitting it
+    is cheap.
+
+    Args:
+        now (datetime.datetime): The current time
+        interval (str): 'day' or 'month'
+        ahead (int): Number of future windows to prepare
+        dry_run (bool): Only report the partitions that would be created
+
+    Returns:
+        List[str]: The names of the partitions created
+    """
+    existing = [partition.upper for partition in list_partitions() if partition.upper is not None]
+    if not existing:
+        raise RuntimeError(f'{table_name()} is not partitioned; run the chatbridge migrations first.')
+    last = max(existing)
+    target = next_window(window_start(now, interval), interval)
+    for _ in range(ahead):
+        target = next_window(target, interval)
+    uppers = []
+    upper = last
+    while upper < target:
+        upper = next_window(window_start(upper, interval), interval)
+        uppers.append(upper)
+    if uppers and not dry_run:
+        definitions = ', '.join(
+            f"PARTITION {partition_name(upper)} VALUES LESS THAN ('{upper:%Y-%m-%d %H:%M:%S}')"
+            for upper in uppers
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'ALTER TABLE {connection.ops.quote_name(table_name())} '
+                f'REORGANIZE PARTITION {FUTURE_PARTITION} INTO '
+                f'({definitions}, PARTITION {FUTURE_PARTITION} VALUES LESS THAN (MAXVALUE))'
+            )
+    return [partition_name(upper) for upper in uppers]
+
+
+def drop_partition(name: str) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {connection.ops.quote_name(table_name())} DROP PARTITION {name}')
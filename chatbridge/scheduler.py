@@ -0,0 +1,346 @@
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Callable, Deque, Dict, Iterator, Optional, Set
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .metrics import OUTBOUND_WAIT_SECONDS
+
+# Send priorities, most urgent first: replies in a conversation, then bulk
+# sends such as broadcasts
+REPLY = 'reply'
+BULK = 'bulk'
+PRIORITIES = (REPLY, BULK)
+
+
+class SchedulerTimeout(Exception):
+    pass
+
+
+def parse_weights(value: str) -> Dict[str, float]:
+    """
+    Parse firm weights given as "number:weight,number:weight".
+
+    Raises:
+        ValueError: If an entry is malformed or a weight is not positive
+    """
+    weights = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        number, _, weight = entry.rpartition(':')
+        if not number or float(weight) <= 0:
+            raise ValueError(f'Invalid firm weight: {entry}')
+        weights[number.strip()] = float(weight)
+    return weights
+
+
+class TokenBucket:
+    """
+    Allows rate sends per second on average, in bursts of up to burst.
+    A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is."""
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate:
+            self.tokens -= 1
+
+
+class _Ticket:
+    __slots__ = ('firm', 'priority', 'enqueued', 'finish', 'notify', 'granted')
+
+    def __init__(self, firm: str, priority: str, enqueued: float, finish: float, notify: Callable[[], None]):
+        self.firm = firm
+        self.priority = priority
+        self.enqueued = enqueued
+        self.finish = finish
+        self.notify = notify
+        self.granted = False
+
+
+class _FirmState:
+    def __init__(self, bucket: TokenBucket, weight: float):
+        self.bucket = bucket
+        self.weight = weight
+        self.queues: Dict[str, Deque[_Ticket]] = {priority: deque() for priority in PRIORITIES}
+        self.last_finish = {priority: 0.0 for priority in PRIORITIES}
+        self.sent = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class OutboundScheduler:
+    """
+    Decides when each outbound send may go to the WhatsApp API.
+
+    Every firm number has a token bucket, the account as a whole may have
+    one too, and at most max_in_flight sends run at once. When sends have
+    to wait, replies are served before bulk sends, and within a priority
+    firms share the capacity by weighted fair queuing (self-clocked: each
+    send gets a virtual finish time of its firm's previous one plus
+    1 / weight, and the earliest finish time among firms with a token goes
+    first), so one firm's backlog cannot starve the others.
+
+    A send holds its slot from grant to completion (see slot and aslot).
+    Slots are granted on the calling thread when possible; a background
+    thread grants the ones that wait for tokens to refill.
+    """
+
+    def __init__(
+        self,
+        firm_rate: float,
+        firm_burst: float,
+        max_in_flight: int,
+        account_rate: float = 0,
+        weights: Optional[Dict[str, float]] = None,
+        max_wait: float = 30.0,
+    ):
+        self.firm_rate = firm_rate
+        self.firm_burst = firm_burst
+        self.max_in_flight = max(max_in_flight, 1)
+        self.weights = weights or {}
+        self.max_wait = max_wait
+        self._account = TokenBucket(account_rate, account_rate, time.monotonic())
+        self._firms: Dict[str, _FirmState] = {}
+        # Firms with queued sends, per priority
+        self._active: Dict[str, Set[str]] = {priority: set() for priority in PRIORITIES}
+        self._virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        self._waiting = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._timer: Optional[threading.Thread] = None
+
+    def _firm(self, firm: str, now: float) -> _FirmState:
+        state = self._firms.get(firm)
+        if state is None:
+            state = self._firms[firm] = _FirmState(
+                TokenBucket(self.firm_rate, self.firm_burst, now), self.weights.get(firm, 1.0),
+            )
+        return state
+
+    def _submit(self, firm: str, priority: str, notify: Callable[[], None]) -> _Ticket:
+        if priority not in PRIORITIES:
+            raise ValueError(f'Unknown priority: {priority}')
+        with self._lock:
+            now = time.monotonic()
+            state = self._firm(firm, now)
+            start = max(self._virtual_time[priority], state.last_finish[priority])
+            ticket = _Ticket(firm, priority, now, start + 1 / state.weight, notify)
+            state.last_finish[priority] = ticket.finish
+            state.queues[priority].append(ticket)
+            self._active[priority].add(firm)
+            self._waiting += 1
+            self._dispatch()
+            if not ticket.granted:
+                self._ensure_timer()
+                self._wakeup.notify()
+            return ticket
+
+    def _dispatch(self) -> Optional[float]:
+        # Grant slots while possible; returns the seconds until a token
+        # frees up for a waiting send, if that is what blocks them
+        now = time.monotonic()
+        while self._waiting and self._in_flight < self.max_in_flight:
+            delay = self._account.ready_in(now)
+            if delay:
+                return delay
+            ticket, delay = self._next_ticket(now)
+            if ticket is None:
+                return delay
+            self._grant(ticket, now)
+        return None
+
+    def _next_ticket(self, now: float):
+        soonest = None
+        for priority in PRIORITIES:
+            best = None
+            for firm in self._active[priority]:
+                state = self._firms[firm]
+                delay = state.bucket.ready_in(now)
+                if delay:
+                    soonest = delay if soonest is None else min(soonest, delay)
+                    continue
+                head = state.queues[priority][0]
+                if best is None or head.finish < best.finish:
+                    best = head
+            if best is not None:
+                return best, None
+        return None, soonest
+
+    def _grant(self, ticket: _Ticket, now: float) -> None:
+        state = self._firms[ticket.firm]
+        self._dequeue(ticket)
+        state.bucket.take()
+        self._account.take()
+        self._virtual_time[ticket.priority] = ticket.finish
+        self._in_flight += 1
+        wait = now - ticket.enqueued
+        state.sent += 1
+        state.wait_total += wait
+        state.wait_max = max(state.wait_max, wait)
+        OUTBOUND_WAIT_SECONDS.observe(wait, ticket.priority)
+        ticket.granted = True
+        ticket.notify()
+
+    def _dequeue(self, ticket: _Ticket) -> None:
+        queue = self._firms[ticket.firm].queues[ticket.priority]
+        if queue[0] is ticket:
+            queue.popleft()
+        else:
+            queue.remove(ticket)
+        if not queue:
+            self._active[ticket.priority].discard(ticket.firm)
+        self._waiting -= 1
+
+    def _cancel(self, ticket: _Ticket) -> bool:
+        # Withdraw a waiting send; False if it was granted in the meantime
+        with self._lock:
+            if ticket.granted:
+                return False
+            self._dequeue(ticket)
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+            self._wakeup.notify()
+
+    def _ensure_timer(self) -> None:
+        if self._timer is None:
+            self._timer = threading.Thread(target=self._run_timer, name='outbound-scheduler', daemon=True)
+            self._timer.start()
+
+    def _run_timer(self) -> None:
+        with self._lock:
+            while True:
+                self._wakeup.wait(self._dispatch())
+
+    @contextmanager
+    def slot(self, firm: str, priority: str = REPLY) -> Iterator[None]:
+        """
+        Wait for the turn of a send and hold its slot while it runs.
+
+        Args:
+            firm (str): The sending firm's phone number
+            priority (str): REPLY or BULK
+
+        Raises:
+            SchedulerTimeout: If no slot was granted within max_wait seconds
+        """
+        event = threading.Event()
+        ticket = self._submit(firm, priority, event.set)
+        if not event.wait(self.max_wait) and self._cancel(ticket):
+            raise SchedulerTimeout(f'No outbound slot for firm {firm} within {self.max_wait}s')
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def aslot(self, firm: str, priority: str = REPLY) -> AsyncIterator[None]:
+        """Async version of slot."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def resolve():
+            if not granted.done():
+                granted.set_result(None)
+
+        ticket = self._submit(firm, priority, lambda: loop.call_soon_threadsafe(resolve))
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self.max_wait)
+            except asyncio.TimeoutError:
+                if self._cancel(ticket):
+                    raise SchedulerTimeout(f'No outbound slot for firm {firm} within {self.max_wait}s')
+            except asyncio.CancelledError:
+                if not self._cancel(ticket):
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def snapshot(self) -> dict:
+        """
+        Get the scheduler's state.
+
+        Returns:
+            dict: 'in_flight', 'max_in_flight', 'waiting' and per firm number
+            the queued sends per priority, sends granted, tokens left and the
+            average and maximum wait in milliseconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            firms = {}
+            for firm, state in self._firms.items():
+                state.bucket.ready_in(now)
+                firms[firm] = {
+                    'queued': {priority: len(state.queues[priority]) for priority in PRIORITIES},
+                    'sent': state.sent,
+                    'tokens': round(state.bucket.tokens, 2) if state.bucket.rate else None,
+                    'weight': state.weight,
+                    'wait_avg_ms': round(state.wait_total / state.sent * 1000, 3) if state.sent else 0.0,
+                    'wait_max_ms': round(state.wait_max * 1000, 3),
+                }
+            return {
+                'in_flight': self._in_flight,
+                'max_in_flight': self.max_in_flight,
+                'waiting': self._waiting,
+                'firms': firms,
+            }
+
+
+_scheduler: Optional[OutboundScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> OutboundScheduler:
+    """
+    Get the process-wide outbound scheduler configured from settings.
+
+    Returns:
+        OutboundScheduler: The shared scheduler
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = OutboundScheduler(
+                    firm_rate=settings.WHATSAPP_OUTBOUND_FIRM_RATE,
+                    firm_burst=settings.WHATSAPP_OUTBOUND_FIRM_BURST,
+                    max_in_flight=settings.WHATSAPP_API_MAX_CONCURRENCY,
+                    account_rate=settings.WHATSAPP_OUTBOUND_ACCOUNT_RATE,
+                    weights=parse_weights(settings.WHATSAPP_OUTBOUND_FIRM_WEIGHTS),
+                    max_wait=settings.WHATSAPP_OUTBOUND_MAX_WAIT,
+                )
+    return _scheduler
+
+
+@receiver(setting_changed)
+def reset_scheduler(setting, **kwargs):
+    # Sends already waiting keep the scheduler they were submitted to
+    global _scheduler
+    if setting.startswith('WHATSAPP_OUTBOUND_') or setting == 'WHATSAPP_API_MAX_CONCURRENCY':
+        with _scheduler_lock:
+            _scheduler = None
@@ -1,3 +1,1229 @@
-from django.test import TestCase
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipIf
+import asyncio
+import datetime
+import json
+import tempfile
+import threading
+import time
+import uuid
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models import F
+from django.contrib.auth.models import User
+from django.test import AsyncRequestFactory, Client, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import requests
+
+from firms.models import ChatUser, Firm, FirmHourlyStats
+from firms.rollups import RollupBuffer
+from firms.routing import routing_cache
+from firms.state import conversation_states
+from firms.utils import get_next_message
+from . import archive, async_views
+from .async_views import OrderedTaskRunner
+from .broadcast import broadcast_progress, create_broadcast, run_broadcast
+from .dedup import ConcurrentDelivery, adrop_duplicate_events, drop_duplicate_events, recent_message_ids, record_processed
+from .export import iter_message_logs, parse_bound
+from .history import InvalidCursor, decode_cursor, encode_cursor, get_conversation_page
+from .inbox import InboxSweeper
+from .metrics import Counter, Histogram, Registry, stage
+from .models import BroadcastJob, MessageLog, OutboxMessage, ProcessedMessage, WebhookDelivery
+from .outbound import AsyncWhatsAppClient, WhatsAppClient, asend_whatsapp_message, backoff_delay, send_whatsapp_message
+from .outbox import OutboxDispatcher, enqueue_replies
+from .scheduler import BULK, REPLY, OutboundScheduler, TokenBucket
+from .webhook import ahandle_webhook_events, decode_webhook_body, handle_webhook_events, parse_webhook_events
+from .worker import PendingDeliveries, WorkerPool, enqueue_webhook_events, handle_webhook_share
+from .writer import MessageLogWriter
+
+try:
+    import httpx
+except ImportError:  # httpx is only needed by the async client
+    httpx = None
+
+
+class WorkerPoolTests(SimpleTestCase):
+    def test_batch_is_queued_all_or_nothing(self):
+        release = threading.Event()
+        handled = []
+
+        def handler(batch):
+            release.wait(5)
+            handled.append(batch)
+
+        pool = WorkerPool(handler, workers=2, max_queue_size=1)
+        keys = [key for key in range(50) if pool._shard_index(key) == 0][:2] + \
+            [key for key in range(50) if pool._shard_index(key) == 1][:1]
+        try:
+            # Each worker picks up its share and blocks, then shard 0 queues one more
+            self.assertTrue(pool.submit_batch([(keys[0], 'a'), (keys[2], 'b')]))
+            while pool.depth():
+                time.sleep(0.01)
+            self.assertTrue(pool.submit_batch([(keys[1], 'c')]))
+            # Shard 0 is full, so the share for shard 1 must not be queued
+            self.assertFalse(pool.submit_batch([(keys[2], 'd'), (keys[0], 'e')]))
+            self.assertEqual(pool.depths(), [1, 0])
+        finally:
+            release.set()
+            pool.shutdown(5)
+        self.assertCountEqual(handled, [['a'], ['b'], ['c']])
+
+    def test_inline_errors_are_logged(self):
+        pool = WorkerPool(mock.Mock(side_effect=RuntimeError), workers=0)
+        with self.assertLogs('chatbridge.worker', 'ERROR'):
+            self.assertTrue(pool.submit_batch([('k', 'a')]))
+
+
+class PendingDeliveriesTests(SimpleTestCase):
+    def test_done_once_every_share_succeeded(self):
+        pending = PendingDeliveries()
+        pending.expect(1, 2)
+        pending.expect(2, 2)
+        self.assertFalse(pending.finish(1, True))
+        self.assertTrue(pending.finish(1, True))
+        self.assertFalse(pending.finish(2, False))
+        self.assertFalse(pending.finish(2, True))
+        # Unknown and forgotten deliveries are never done
+        self.assertFalse(pending.finish(1, True))
+        pending.expect(3, 1)
+        pending.forget(3)
+        self.assertFalse(pending.finish(3, True))
+
+
+def inbound_event(wa_id, body='hi'):
+    return {
+        'waba_id': 'w', 'firm_phone_number': 'f', 'wa_id': wa_id, 'profile_name': '',
+        'msg_body': body, 'msg_type': 'text', 'msg_id': '', 'timestamp': '',
+    }
+
+
+class WebhookInboxTests(TestCase):
+    def setUp(self):
+        pool = WorkerPool(handle_webhook_share, workers=0)
+        patcher = mock.patch('chatbridge.worker.get_webhook_pool', return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = [inbound_event(wa_id) for wa_id in ('a', 'b', 'c', 'd')]
+
+    def expire_leases(self):
+        WebhookDelivery.objects.update(available_at=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_delivery_leaves_the_inbox_once_processed(self):
+        with mock.patch('chatbridge.webhook.handle_webhook_events') as handler:
+            self.assertTrue(enqueue_webhook_events(self.events))
+        self.assertCountEqual([event for call in handler.call_args_list for event in call.args[0]], self.events)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_failed_delivery_is_processed_by_the_sweep(self):
+        with mock.patch('chatbridge.webhook.handle_webhook_events', side_effect=RuntimeError):
+            with self.assertLogs('chatbridge.worker', 'ERROR'):
+                self.assertTrue(enqueue_webhook_events(self.events))
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.events, self.events)
+
+        handler = mock.Mock()
+        sweeper = InboxSweeper(handler, batch_size=10, interval=1, max_attempts=2)
+        # Still leased to the process that wrote it
+        self.assertEqual(sweeper.sweep(), 0)
+        self.expire_leases()
+        self.assertEqual(sweeper.sweep(), 1)
+        handler.assert_called_once_with(self.events)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_sweep_gives_up_after_max_attempts(self):
+        WebhookDelivery.objects.create(events=self.events)
+        sweeper = InboxSweeper(mock.Mock(side_effect=RuntimeError), batch_size=10, interval=1, max_attempts=2)
+        with self.assertLogs('chatbridge.inbox', 'ERROR'):
+            for _ in range(3):
+                self.expire_leases()
+                sweeper.sweep()
+        self.assertEqual(sweeper.handler.call_count, 2)
+        self.assertEqual(sweeper.stats['given_up'], 1)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_unpersisted_delivery_is_refused(self):
+        body = {'entry': [{'id': 'w', 'changes': [{'value': {
+            'metadata': {'display_phone_number': 'f'},
+            'contacts': [{'wa_id': 'a', 'profile': {'name': 'A'}}],
+            'messages': [{'from': 'a', 'id': 'wamid.1', 'type': 'text', 'text': {'body': 'hi'}}],
+        }}]}]}
+        with mock.patch('chatbridge.inbox.WebhookDelivery.objects.create', side_effect=DatabaseError), \
+                mock.patch('chatbridge.webhook.handle_webhook_events') as handler:
+            with self.assertLogs('chatbridge', 'WARNING'):
+                response = self.client.post(reverse('whatsapp_webhook'), body, content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        handler.assert_not_called()
+
+
+class MessageLogWriterTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.writer = MessageLogWriter(max_batch_size=10, max_age=60, spool_path=self.directory / 'spool.ndjson')
+        # Flushes are driven by the tests rather than the background thread
+        patcher = mock.patch.object(self.writer, '_ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add(self, count, **fields):
+        for index in range(count):
+            self.writer.add(direction='IN', phone_number='u', firm_phone_number='f', message=f'm{index}', **fields)
+
+    def spooled(self):
+        if not self.writer.spool_path.exists():
+            return 0
+        return len(self.writer.spool_path.read_text().splitlines())
+
+    def test_flush_inserts_the_buffer(self):
+        self.add(3)
+        self.assertEqual(self.writer.snapshot()['buffered'], 3)
+        self.assertFalse(MessageLog.objects.exists())
+        self.assertEqual(self.writer.flush(), 3)
+        self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(MessageLog.objects.count(), 3)
+        self.assertEqual(self.writer.snapshot()['buffered'], 0)
+
+    def test_full_buffer_wakes_the_writer(self):
+        self.add(9)
+        self.assertFalse(self.writer._wakeup.is_set())
+        self.add(1)
+        self.assertTrue(self.writer._wakeup.is_set())
+
+    def test_failed_flush_is_spooled_and_replayed(self):
+        self.add(2)
+        with mock.patch.object(MessageLog.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertLogs('chatbridge.writer', 'ERROR'):
+                self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(self.spooled(), 2)
+        self.assertEqual(self.writer.replay_spool(), 2)
+        self.assertEqual(sorted(MessageLog.objects.values_list('message', flat=True)), ['m0', 'm1'])
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_replay_skips_inbound_rows_already_logged(self):
+        MessageLog.objects.create(direction='IN', phone_number='u', message='m0', message_id='wamid.0')
+        self.writer.add(direction='IN', phone_number='u', message='m0', message_id='wamid.0')
+        self.writer.add(direction='IN', phone_number='u', message='m1', message_id='wamid.1')
+        self.writer._spool(self.writer._buffer)
+        self.assertEqual(self.writer.replay_spool(), 1)
+        self.assertEqual(MessageLog.objects.filter(message_id='wamid.0').count(), 1)
+
+    def test_failed_replay_keeps_the_rows(self):
+        self.add(2)
+        self.writer._spool(self.writer._buffer)
+        with mock.patch.object(MessageLog.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.writer.replay_spool()
+        self.assertEqual(self.spooled(), 2)
+        self.assertEqual([path.name for path in self.directory.iterdir()], ['spool.ndjson'])
+
+        # When the rows cannot be spooled again either, the replay file stays
+        with mock.patch.object(MessageLog.objects, 'bulk_create', side_effect=DatabaseError), \
+                mock.patch.object(self.writer, '_spool', side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.writer.replay_spool()
+        replaying = list(self.directory.iterdir())
+        self.assertEqual(len(replaying), 1)
+        self.assertTrue(replaying[0].name.endswith('.replay'))
+        self.assertEqual(len(replaying[0].read_text().splitlines()), 2)
+
+    def test_rows_added_after_close_are_spooled(self):
+        self.add(1)
+        self.writer.close()
+        self.assertEqual(MessageLog.objects.count(), 1)
+
+        async def log_from_the_event_loop():
+            self.add(2)
+
+        asyncio.run(log_from_the_event_loop())
+        self.assertEqual(MessageLog.objects.count(), 1)
+        self.assertEqual(self.spooled(), 2)
+
+
+def change(display_phone_number, contacts, messages=None, statuses=None):
+    value = {'metadata': {'display_phone_number': display_phone_number}, 'contacts': contacts}
+    if messages is not None:
+        value['messages'] = messages
+    if statuses is not None:
+        value['statuses'] = statuses
+    return {'field': 'messages', 'value': value}
+
+
+def text_message(message_id, sender, body):
+    return {'from': sender, 'id': message_id, 'timestamp': '1700000000', 'type': 'text', 'text': {'body': body}}
+
+
+class ParseWebhookEventsTests(SimpleTestCase):
+    def test_every_entry_change_and_message_in_order(self):
+        data = {'entry': [
+            {'id': 'waba1', 'changes': [
+                change('111', [{'wa_id': 'a', 'profile': {'name': 'Ann'}}], [
+                    text_message('m1', 'a', 'one'),
+                    text_message('m2', 'a', 'two'),
+                ]),
+                change('222', [{'wa_id': 'b', 'profile': {'name': 'Bob'}}], [text_message('m3', 'b', 'three')]),
+            ]},
+            {'id': 'waba2', 'changes': [
+                change('333', [{'wa_id': 'c', 'profile': {'name': 'Cy'}}], [text_message('m4', 'c', 'four')]),
+            ]},
+        ]}
+        events = parse_webhook_events(data)
+        self.assertEqual(
+            [(e['waba_id'], e['firm_phone_number'], e['wa_id'], e['profile_name'], e['msg_id'], e['msg_body'])
+             for e in events],
+            [
+                ('waba1', '111', 'a', 'Ann', 'm1', 'one'),
+                ('waba1', '111', 'a', 'Ann', 'm2', 'two'),
+                ('waba1', '222', 'b', 'Bob', 'm3', 'three'),
+                ('waba2', '333', 'c', 'Cy', 'm4', 'four'),
+            ],
+        )
+        self.assertEqual(events[0]['msg_type'], 'text')
+        self.assertEqual(events[0]['timestamp'], '1700000000')
+
+    def test_sender_is_taken_from_each_message(self):
+        contacts = [{'wa_id': 'a', 'profile': {'name': 'Ann'}}, {'wa_id': 'b', 'profile': {'name': 'Bob'}}]
+        messages = [
+            text_message('m1', 'b', 'from b'),
+            text_message('m2', 'a', 'from a'),
+            {'id': 'm3', 'type': 'text', 'text': {'body': 'no sender'}},
+            text_message('m4', 'z', 'unknown contact'),
+        ]
+        events = parse_webhook_events({'entry': [{'id': 'w', 'changes': [change('111', contacts, messages)]}]})
+        self.assertEqual(
+            [(e['wa_id'], e['profile_name']) for e in events],
+            [('b', 'Bob'), ('a', 'Ann'), ('a', 'Ann'), ('z', '')],
+        )
+
+    def test_status_only_payloads_have_no_events(self):
+        statuses = [{'id': 'm1', 'status': 'delivered', 'recipient_id': 'a'}]
+        data = {'entry': [{'id': 'w', 'changes': [
+            {'field': 'messages', 'value': {'metadata': {'display_phone_number': '111'}, 'statuses': statuses}},
+            change('111', [{'wa_id': 'a'}], statuses=statuses),
+        ]}]}
+        self.assertEqual(parse_webhook_events(data), [])
+        self.assertEqual(parse_webhook_events({}), [])
+        self.assertEqual(parse_webhook_events({'entry': [{'id': 'w', 'changes': []}]}), [])
+
+    def test_malformed_payload_is_logged(self):
+        with self.assertLogs('chatbridge.webhook', 'ERROR'):
+            self.assertEqual(parse_webhook_events({'entry': [{'changes': [{'value': []}]}]}), [])
+
+
+def event(message_id):
+    return {'msg_id': message_id}
+
+
+class DedupTests(TestCase):
+    def test_drops_ids_in_the_ledger_without_recording_new_ones(self):
+        known, fresh = f'wamid.{uuid.uuid4().hex}', f'wamid.{uuid.uuid4().hex}'
+        ProcessedMessage.objects.create(message_id=known)
+        kept = drop_duplicate_events([event(known), event(fresh), event('')])
+        self.assertEqual([e['msg_id'] for e in kept], [fresh, ''])
+        self.assertFalse(ProcessedMessage.objects.filter(message_id=fresh).exists())
+
+    def test_drops_repeats_within_a_batch(self):
+        message_id = f'wamid.{uuid.uuid4().hex}'
+        self.assertEqual(len(drop_duplicate_events([event(message_id), event(message_id)])), 1)
+
+    def test_recorded_ids_are_dropped(self):
+        message_id = f'wamid.{uuid.uuid4().hex}'
+        with self.captureOnCommitCallbacks(execute=True):
+            record_processed([event(message_id), event('')])
+        self.assertTrue(ProcessedMessage.objects.filter(message_id=message_id).exists())
+        self.assertTrue(recent_message_ids.seen(message_id))
+        # Known to this process, so the ledger is not queried
+        with self.assertNumQueries(0):
+            self.assertEqual(drop_duplicate_events([event(message_id)]), [])
+
+    def test_recording_an_id_twice_is_a_concurrent_delivery(self):
+        message_id = f'wamid.{uuid.uuid4().hex}'
+        ProcessedMessage.objects.create(message_id=message_id)
+        with self.assertRaises(ConcurrentDelivery):
+            record_processed([event(message_id)])
+
+    def test_async(self):
+        known, fresh = f'wamid.{uuid.uuid4().hex}', f'wamid.{uuid.uuid4().hex}'
+        ProcessedMessage.objects.create(message_id=known)
+        kept = async_to_sync(adrop_duplicate_events)([event(known), event(fresh)])
+        self.assertEqual([e['msg_id'] for e in kept], [fresh])
+
+
+@override_settings(CHATBRIDGE_MESSAGELOG_BATCH_SIZE=1, CHATBRIDGE_OUTBOX=True)
+class WebhookRedeliveryTests(TestCase):
+    def setUp(self):
+        routing_cache().clear()
+        conversation_states.clear()
+        self.addCleanup(conversation_states.clear)
+        self.firm = Firm.objects.create(name='Redelivery firm', phone_number='f', first_step='start', flow={'steps': [
+            {'id': 'start', 'message': 'Welcome', 'next': [{'pattern': '^1$', 'next': 'one'}]},
+            {'id': 'one', 'message': 'One', 'next': 'start'},
+        ]})
+        self.rollups = RollupBuffer(flush_interval=60)
+        # Recording starts the flush thread; these tests flush by hand
+        self.rollups._closed = True
+        patcher = mock.patch('chatbridge.webhook.get_rollups', return_value=self.rollups)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.message = dict(inbound_event('a', '1'), msg_id=f'wamid.{uuid.uuid4().hex}')
+
+    def step(self):
+        return ChatUser.objects.get(firm=self.firm, phone_number='a').current_step
+
+    def assert_not_processed(self):
+        self.assertEqual(self.step(), 'start')
+        self.assertFalse(ProcessedMessage.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertFalse(MessageLog.objects.exists())
+
+    def assert_processed_once(self):
+        self.assertEqual(self.step(), 'one')
+        self.assertTrue(ProcessedMessage.objects.filter(message_id=self.message['msg_id']).exists())
+        self.assertEqual(list(OutboxMessage.objects.values_list('message', flat=True)), ['One'])
+        self.assertEqual(MessageLog.objects.filter(direction='IN', message_id=self.message['msg_id']).count(), 1)
+        self.assertEqual(self.hourly_stats(), {'messages_in': 1, 'new_users': 1, 'active_users': 1})
+
+    def hourly_stats(self):
+        self.rollups.flush()
+        return FirmHourlyStats.objects.values('messages_in', 'new_users', 'active_users').get(firm=self.firm)
+
+    def test_failed_batch_is_processed_when_redelivered(self):
+        with mock.patch('chatbridge.webhook.get_next_message', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                handle_webhook_events([self.message])
+        self.assert_not_processed()
+
+        handle_webhook_events([self.message])
+        self.assert_processed_once()
+        handle_webhook_events([self.message])
+        self.assert_processed_once()
+
+    def test_failed_batch_is_processed_when_redelivered_async(self):
+        with mock.patch('chatbridge.webhook.aget_next_message', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                async_to_sync(ahandle_webhook_events)([self.message])
+        self.assert_not_processed()
+
+        async_to_sync(ahandle_webhook_events)([self.message])
+        self.assert_processed_once()
+        async_to_sync(ahandle_webhook_events)([self.message])
+        self.assert_processed_once()
+
+    def test_batch_losing_to_a_concurrent_delivery_is_rolled_back(self):
+        other = dict(inbound_event('b', '1'), msg_id=f'wamid.{uuid.uuid4().hex}')
+
+        def concurrent_commit(*args):
+            # Another process processes the message while this batch runs
+            ProcessedMessage.objects.get_or_create(message_id=self.message['msg_id'])
+            return get_next_message(*args)
+
+        with mock.patch('chatbridge.webhook.get_next_message', side_effect=concurrent_commit), \
+                self.assertLogs('chatbridge.webhook', 'INFO'):
+            handle_webhook_events([self.message, other])
+        # The retry processed only the other message
+        self.assertEqual(self.step(), 'start')
+        self.assertEqual(ChatUser.objects.get(firm=self.firm, phone_number='b').current_step, 'one')
+        self.assertEqual(list(OutboxMessage.objects.values_list('phone_number', flat=True)), ['b'])
+        self.assertEqual(list(MessageLog.objects.values_list('phone_number', flat=True)), ['b'])
+        self.assertEqual(self.hourly_stats(), {'messages_in': 1, 'new_users': 1, 'active_users': 1})
+
+    def test_batch_saved_from_a_stale_conversation_is_retried(self):
+        # Cache the conversation at 'start'
+        handle_webhook_events([dict(inbound_event('a', 'hello'), msg_id=f'wamid.{uuid.uuid4().hex}')])
+        self.assertEqual(self.step(), 'start')
+        # Another process moves it to 'one', which always leads back to 'start'
+        ChatUser.objects.filter(firm=self.firm, phone_number='a').update(
+            current_step='one', state_version=F('state_version') + 1,
+        )
+        with self.assertLogs('chatbridge.webhook', 'INFO'):
+            handle_webhook_events([self.message])
+        self.assertEqual(self.step(), 'start')
+        self.assertEqual(list(OutboxMessage.objects.values_list('message', flat=True)), ['Welcome'])
+        self.assertEqual(self.hourly_stats(), {'messages_in': 2, 'new_users': 1, 'active_users': 1})
+
+
+class ConversationHistoryTests(TestCase):
+    def setUp(self):
+        moment = timezone.now().replace(microsecond=0)
+        # Several rows share a timestamp, so pages must break ties on id
+        self.rows = MessageLog.objects.bulk_create([
+            MessageLog(
+                direction='IN', phone_number='u', firm_phone_number='f', message=f'm{index}',
+                timestamp=moment - datetime.timedelta(seconds=index // 3),
+            )
+            for index in range(10)
+        ])
+        MessageLog.objects.create(direction='IN', phone_number='other', firm_phone_number='f', message='x')
+
+    def expected(self):
+        ordered = MessageLog.objects.filter(phone_number='u').order_by('-timestamp', '-id')
+        return list(ordered.values_list('id', flat=True))
+
+    def test_pages_cover_every_row_once_in_order(self):
+        for limit in (1, 2, 3, 4, 10, 11):
+            with self.subTest(limit=limit):
+                seen, cursor = [], None
+                while True:
+                    page, cursor = get_conversation_page('f', 'u', limit, cursor)
+                    self.assertLessEqual(len(page), limit)
+                    seen += [row['id'] for row in page]
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, self.expected())
+
+    def test_last_full_page_has_no_cursor(self):
+        page, cursor = get_conversation_page('f', 'u', 10)
+        self.assertEqual(len(page), 10)
+        self.assertIsNone(cursor)
+
+    def test_cursor_round_trip(self):
+        moment = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(moment, 42)), (moment, 42))
+
+    def test_bad_cursor(self):
+        for cursor in ('not base64!', encode_cursor(timezone.now(), 1)[:-4], 'bm8tc2VwYXJhdG9y', 'eHxhYmM='):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(InvalidCursor):
+                    get_conversation_page('f', 'u', 5, cursor)
+
+
+class OrderedTaskRunnerTests(SimpleTestCase):
+    def run_batches(self, runner, batches, release_first=None):
+        # Each (keys, name) batch runs until its gate is opened
+        log = []
+        gates = {name: asyncio.Event() for _, name in batches}
+
+        async def handle(events):
+            name = events[0]['name']
+            log.append(('start', name))
+            await gates[name].wait()
+            log.append(('end', name))
+
+        async def run():
+            with mock.patch('chatbridge.async_views.ahandle_webhook_events', side_effect=handle), \
+                    mock.patch('chatbridge.async_views.acomplete_delivery') as complete:
+                accepted = [runner.submit(keys, [{'name': name}], index) for index, (keys, name) in enumerate(batches)]
+                await asyncio.sleep(0)
+                started = [name for event, name in log]
+                for name in release_first or []:
+                    gates[name].set()
+                    await asyncio.sleep(0)
+                for gate in gates.values():
+                    gate.set()
+                await runner.drain(1)
+                return accepted, started, [call.args[0] for call in complete.call_args_list]
+
+        accepted, started, completed = asyncio.run(run())
+        return accepted, started, completed, log
+
+    def test_conversations_are_handled_in_order(self):
+        runner = OrderedTaskRunner(max_in_flight=10)
+        batches = [(['a'], 'a1'), (['a', 'b'], 'ab2'), (['c'], 'c1'), (['b'], 'b3'), (['a'], 'a4')]
+        accepted, started, completed, log = self.run_batches(runner, batches, release_first=['c1', 'a1'])
+        self.assertEqual(accepted, [True] * 5)
+        # Unrelated conversations start at once, later batches wait
+        self.assertEqual(started, ['a1', 'c1'])
+        for first, second in [('a1', 'ab2'), ('ab2', 'b3'), ('ab2', 'a4')]:
+            self.assertLess(log.index(('end', first)), log.index(('start', second)))
+        self.assertCountEqual(completed, range(5))
+        self.assertEqual((runner.in_flight(), runner._tails), (0, {}))
+
+    def test_batches_beyond_max_in_flight_are_refused(self):
+        runner = OrderedTaskRunner(max_in_flight=2)
+        accepted, started, completed, log = self.run_batches(runner, [(['a'], 'a1'), (['b'], 'b1'), (['c'], 'c1')])
+        self.assertEqual(accepted, [True, True, False])
+        self.assertCountEqual(completed, [0, 1])
+
+    def test_failed_batch_stays_in_the_inbox(self):
+        async def run():
+            runner = OrderedTaskRunner(max_in_flight=2)
+            with mock.patch('chatbridge.async_views.ahandle_webhook_events', side_effect=RuntimeError), \
+                    mock.patch('chatbridge.async_views.acomplete_delivery') as complete:
+                runner.submit(['a'], [{}], 1)
+                await runner.drain(1)
+            return runner, complete
+
+        with self.assertLogs('chatbridge.async_views', 'ERROR'):
+            runner, complete = asyncio.run(run())
+        complete.assert_not_called()
+        self.assertEqual(runner.in_flight(), 0)
+
+
+class AsyncWebhookViewTests(TestCase):
+    body = {'entry': [{'id': 'w', 'changes': [change('f', [{'wa_id': 'a', 'profile': {'name': 'A'}}], [
+        text_message('wamid.1', 'a', 'hi'),
+    ])]}]}
+
+    def post(self, runner):
+        request = AsyncRequestFactory().post('/webhook/', self.body, content_type='application/json')
+        with mock.patch('chatbridge.async_views.webhook_runner', runner):
+            return async_to_sync(async_views.whatsapp_webhook)(request)
+
+    def test_delivery_is_processed_and_leaves_the_inbox(self):
+        runner = OrderedTaskRunner(max_in_flight=1)
+        handled = []
+
+        async def handle(events):
+            handled.extend(events)
+
+        async def post_and_drain():
+            request = AsyncRequestFactory().post('/webhook/', self.body, content_type='application/json')
+            with mock.patch('chatbridge.async_views.webhook_runner', runner), \
+                    mock.patch('chatbridge.async_views.ahandle_webhook_events', side_effect=handle):
+                response = await async_views.whatsapp_webhook(request)
+                await runner.drain(5)
+            return response
+
+        response = async_to_sync(post_and_drain)()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([event['msg_id'] for event in handled], ['wamid.1'])
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_too_many_batches_in_flight(self):
+        with self.assertLogs('chatbridge.async_views', 'WARNING'):
+            response = self.post(OrderedTaskRunner(max_in_flight=0))
+        self.assertEqual(response.status_code, 503)
+        # The provider redelivers it, so it is not kept for the sweep
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+
+class ArchivedHistoryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_dir = override_settings(CHATBRIDGE_MESSAGELOG_ARCHIVE_DIR=Path(directory.name))
+        archive_dir.enable()
+        self.addCleanup(archive_dir.disable)
+        self.addCleanup(archive._read_index.cache_clear)
+        self.addCleanup(archive._archived_conversation.cache_clear)
+        self.cutoff = timezone.now().replace(microsecond=0) - datetime.timedelta(days=1)
+        rows = []
+        for index in range(15):
+            # Two rows per timestamp, and another conversation interleaved
+            timestamp = self.cutoff - datetime.timedelta(minutes=index // 2 + 1)
+            rows.append(MessageLog(direction='IN', phone_number='u', firm_phone_number='f', message=f'old{index}', timestamp=timestamp))
+            rows.append(MessageLog(direction='IN', phone_number='other', firm_phone_number='f', message='x', timestamp=timestamp))
+        for index in range(5):
+            timestamp = self.cutoff + datetime.timedelta(minutes=index)
+            rows.append(MessageLog(direction='OUT', phone_number='u', firm_phone_number='f', message=f'new{index}', timestamp=timestamp))
+        MessageLog.objects.bulk_create(rows)
+        ordered = MessageLog.objects.filter(firm_phone_number='f', phone_number='u').order_by('-timestamp', '-id')
+        self.expected = list(ordered.values_list('id', flat=True))
+        # Small blocks, so a conversation spans several gzip members
+        with mock.patch('chatbridge.archive.BLOCK_ROWS', 4):
+            self.entry = archive.archive_window('p1', None, self.cutoff)
+        # Dropping the partition removes the archived rows from the database
+        MessageLog.objects.filter(timestamp__lt=self.cutoff).delete()
+
+    def pages(self, limit):
+        seen, cursor = [], None
+        while True:
+            page, cursor = get_conversation_page('f', 'u', limit, cursor, include_archived=True)
+            self.assertLessEqual(len(page), limit)
+            seen += [row['id'] for row in page]
+            if cursor is None:
+                return seen
+
+    def test_archive_window_writes_rows_and_manifest(self):
+        self.assertEqual(self.entry['rows'], 30)
+        self.assertEqual(archive.read_manifest(), [self.entry])
+        rows = list(archive.read_archive(self.entry))
+        self.assertEqual(len(rows), 30)
+        self.assertTrue(all(row['timestamp'] < self.cutoff for row in rows))
+
+    def test_empty_window_is_not_archived(self):
+        self.assertIsNone(archive.archive_window('p0', None, self.cutoff - datetime.timedelta(days=1)))
+        self.assertEqual(len(archive.read_manifest()), 1)
+
+    def test_archived_conversation_rows(self):
+        rows = archive.archived_conversation_rows('f', 'u', 100)
+        self.assertEqual([row['id'] for row in rows], self.expected[5:])
+        self.assertEqual({row['phone_number'] for row in rows}, {'u'})
+
+    def test_pages_cover_live_and_archived_rows_once_in_order(self):
+        for limit in (1, 3, 4, 5, 7, 20, 21):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.pages(limit), self.expected)
+
+    def test_archive_without_index_is_scanned(self):
+        archive.index_path(self.entry['file']).unlink()
+        self.assertEqual(self.pages(4), self.expected)
+
+    def test_archived_rows_are_left_out_by_default(self):
+        page, cursor = get_conversation_page('f', 'u', 20)
+        self.assertEqual([row['id'] for row in page], self.expected[:5])
+        self.assertIsNone(cursor)
+
+
+class MessageLogExportTests(TestCase):
+    def setUp(self):
+        moment = timezone.now().replace(microsecond=0) - datetime.timedelta(hours=1)
+        rows = []
+        # Timestamps out of id order and shared across rows, so the firm
+        # export's (timestamp, id) keyset must break ties across chunks
+        for index in range(23):
+            timestamp = moment + datetime.timedelta(minutes=(index * 7) % 5)
+            rows.append(MessageLog(direction='IN', phone_number=f'u{index}', firm_phone_number='f', message=f'm{index}', timestamp=timestamp))
+            if index % 3 == 0:
+                rows.append(MessageLog(direction='OUT', phone_number='v', firm_phone_number='g', message='x', timestamp=timestamp))
+        MessageLog.objects.bulk_create(rows)
+        self.moment = moment
+
+    def ids(self, *args, **kwargs):
+        return [row['id'] for row in iter_message_logs(*args, **kwargs)]
+
+    def test_firm_export_is_complete_across_chunks(self):
+        expected = list(MessageLog.objects.filter(firm_phone_number='f').order_by('timestamp', 'id').values_list('id', flat=True))
+        for chunk_size in (1, 2, 4, 5, 23, 24):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.ids('f', chunk_size=chunk_size), expected)
+
+    def test_export_across_firms_is_complete_across_chunks(self):
+        expected = list(MessageLog.objects.order_by('id').values_list('id', flat=True))
+        for chunk_size in (1, 3, 31, 32):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.ids(chunk_size=chunk_size), expected)
+
+    def test_time_bounds(self):
+        start = self.moment + datetime.timedelta(minutes=1)
+        end = self.moment + datetime.timedelta(minutes=3)
+        expected = list(
+            MessageLog.objects.filter(firm_phone_number='f', timestamp__gte=start, timestamp__lt=end)
+            .order_by('timestamp', 'id').values_list('id', flat=True)
+        )
+        self.assertTrue(expected)
+        self.assertEqual(self.ids('f', start, end, chunk_size=2), expected)
+
+    def test_parse_bound(self):
+        self.assertEqual(parse_bound('2024-05-01'), datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc))
+        self.assertIsNone(parse_bound(''))
+
+    def test_command_writes_every_row(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / 'export.ndjson'
+            call_command('export_messagelog', firm_phone_number='f', format='ndjson', output=str(output), chunk_size=4)
+            lines = output.read_text(encoding='utf-8').splitlines()
+        self.assertEqual(sorted(json.loads(line)['message'] for line in lines), sorted(f'm{index}' for index in range(23)))
+
+
+class WhatsAppClientTests(SimpleTestCase):
+    def setUp(self):
+        self.client = WhatsAppClient('http://api.test/send', 'token', max_retries=2)
+        self.addCleanup(self.client.close)
+
+    def response(self, status_code, retry_after=None):
+        return mock.Mock(status_code=status_code, headers={'Retry-After': retry_after} if retry_after else {})
+
+    def send(self, *responses):
+        with mock.patch.object(self.client.session, 'post', side_effect=responses) as post, \
+                mock.patch('chatbridge.outbound.time.sleep') as sleep, \
+                self.assertLogs('chatbridge.outbound', 'DEBUG'):
+            sent = self.client.send('u', 'hi')
+        return sent, post.call_count, [call.args[0] for call in sleep.call_args_list]
+
+    def test_retries_throttling_and_server_errors(self):
+        for status_code in (429, 500, 502, 503, 504):
+            with self.subTest(status_code=status_code):
+                sent, posts, sleeps = self.send(self.response(status_code), self.response(200))
+                self.assertTrue(sent)
+                self.assertEqual((posts, len(sleeps)), (2, 1))
+
+    def test_gives_up_after_max_retries(self):
+        sent, posts, sleeps = self.send(*[self.response(503)] * 3)
+        self.assertFalse(sent)
+        self.assertEqual((posts, len(sleeps)), (3, 2))
+
+    def test_honours_retry_after(self):
+        sent, posts, sleeps = self.send(self.response(429, retry_after='2'), self.response(200))
+        self.assertTrue(sent)
+        self.assertEqual(sleeps, [2.0])
+
+    def test_backoff_delay(self):
+        self.assertEqual(backoff_delay(0, 0.5, 8, retry_after='3'), 3.0)
+        # Retry-After is capped, and ignored unless it is a number of seconds
+        self.assertEqual(backoff_delay(0, 0.5, 8, retry_after='120'), 8)
+        for attempt in range(8):
+            self.assertLessEqual(backoff_delay(attempt, 0.5, 8, retry_after='soon'), min(8, 0.5 * 2 ** attempt))
+
+    def test_client_errors_are_not_retried(self):
+        for status_code in (400, 401, 404):
+            with self.subTest(status_code=status_code):
+                sent, posts, sleeps = self.send(self.response(status_code))
+                self.assertFalse(sent)
+                self.assertEqual((posts, sleeps), (1, []))
+
+    def test_read_timeout_is_not_retried(self):
+        # The provider may have accepted the message
+        sent, posts, sleeps = self.send(requests.ReadTimeout('slow'), self.response(200))
+        self.assertFalse(sent)
+        self.assertEqual((posts, sleeps), (1, []))
+
+    def test_connection_errors_are_retried(self):
+        sent, posts, sleeps = self.send(requests.ConnectionError('refused'), self.response(200))
+        self.assertTrue(sent)
+        self.assertEqual(posts, 2)
+
+
+@skipIf(httpx is None, 'httpx is not installed')
+class AsyncWhatsAppClientTests(SimpleTestCase):
+    def send(self, *replies):
+        replies = list(replies)
+        requests_seen = []
+
+        def handle(request):
+            requests_seen.append(request)
+            reply = replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        async def send():
+            client = AsyncWhatsAppClient('http://api.test/send', 'token', max_retries=2)
+            client.client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+            try:
+                return await client.send('u', 'hi')
+            finally:
+                await client.aclose()
+
+        with mock.patch('chatbridge.outbound.asyncio.sleep') as sleep, self.assertLogs('chatbridge.outbound', 'DEBUG'):
+            sent = asyncio.run(send())
+        return sent, len(requests_seen), [call.args[0] for call in sleep.call_args_list]
+
+    def test_retries_and_honours_retry_after(self):
+        sent, posts, sleeps = self.send(httpx.Response(503, headers={'Retry-After': '1'}), httpx.Response(200))
+        self.assertTrue(sent)
+        self.assertEqual((posts, sleeps), (2, [1.0]))
+
+    def test_client_errors_are_not_retried(self):
+        sent, posts, sleeps = self.send(httpx.Response(400))
+        self.assertFalse(sent)
+        self.assertEqual((posts, sleeps), (1, []))
+
+    def test_read_timeout_is_not_retried(self):
+        sent, posts, sleeps = self.send(httpx.ReadTimeout('slow'), httpx.Response(200))
+        self.assertFalse(sent)
+        self.assertEqual((posts, sleeps), (1, []))
+
+    def test_gives_up_after_max_retries(self):
+        sent, posts, sleeps = self.send(*[httpx.Response(500)] * 3)
+        self.assertFalse(sent)
+        self.assertEqual((posts, len(sleeps)), (3, 2))
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_refill(self):
+        bucket = TokenBucket(rate=10, burst=2, now=0)
+        self.assertEqual(bucket.ready_in(0), 0)
+        bucket.take()
+        bucket.take()
+        self.assertAlmostEqual(bucket.ready_in(0), 0.1)
+        self.assertAlmostEqual(bucket.ready_in(0.05), 0.05)
+        self.assertEqual(bucket.ready_in(0.1), 0)
+        # Idle time never adds more than a burst
+        self.assertEqual(bucket.ready_in(60), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_no_limit(self):
+        bucket = TokenBucket(rate=0, burst=0, now=0)
+        for _ in range(100):
+            bucket.take()
+        self.assertEqual(bucket.ready_in(0), 0)
+
+
+class OutboundSchedulerTests(SimpleTestCase):
+    def grant_order(self, scheduler, sends):
+        # Hold the only slot, queue the sends, then release one at a time
+        order = []
+        blocker = scheduler._submit('blocker', REPLY, lambda: None)
+        self.assertTrue(blocker.granted)
+        for firm, priority in sends:
+            scheduler._submit(firm, priority, lambda firm=firm, priority=priority: order.append((firm, priority)))
+        for _ in sends:
+            scheduler._release()
+        scheduler._release()
+        return order
+
+    def test_firms_share_capacity_fairly(self):
+        scheduler = OutboundScheduler(firm_rate=0, firm_burst=1, max_in_flight=1)
+        order = self.grant_order(scheduler, [('a', REPLY)] * 4 + [('b', REPLY)] * 2)
+        firms = [firm for firm, _ in order]
+        # b is served within the first rounds rather than after a's backlog
+        self.assertEqual(sorted(firms[:4]), ['a', 'a', 'b', 'b'])
+        self.assertEqual(firms[4:], ['a', 'a'])
+
+    def test_weights(self):
+        scheduler = OutboundScheduler(firm_rate=0, firm_burst=1, max_in_flight=1, weights={'a': 3})
+        order = self.grant_order(scheduler, [('a', REPLY)] * 6 + [('b', REPLY)] * 6)
+        self.assertEqual([firm for firm, _ in order[:8]].count('a'), 6)
+
+    def test_replies_before_bulk(self):
+        scheduler = OutboundScheduler(firm_rate=0, firm_burst=1, max_in_flight=1)
+        order = self.grant_order(scheduler, [('a', BULK), ('a', BULK), ('b', REPLY)])
+        self.assertEqual(order[0], ('b', REPLY))
+
+    def test_waits_for_tokens(self):
+        scheduler = OutboundScheduler(firm_rate=20, firm_burst=1, max_in_flight=4)
+        with scheduler.slot('a'):
+            pass
+        granted = threading.Event()
+        ticket = scheduler._submit('a', REPLY, granted.set)
+        self.assertFalse(ticket.granted)
+        # The scheduler's timer grants it once the bucket refills
+        self.assertTrue(granted.wait(1))
+        scheduler._release()
+
+
+class OutboundRetryTests(SimpleTestCase):
+    def setUp(self):
+        self.events = []
+        self.scheduler = OutboundScheduler(firm_rate=0, firm_burst=1, max_in_flight=1)
+        patcher = mock.patch('chatbridge.outbound.get_scheduler', return_value=self.scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def response(self, status_code):
+        return mock.Mock(status_code=status_code, headers={})
+
+    def sleep(self, delay):
+        # Backoff runs without a scheduler slot
+        self.events.append(('sleep', self.scheduler.snapshot()['in_flight']))
+
+    def post(self, status_codes):
+        responses = iter(status_codes)
+
+        def post(*args, **kwargs):
+            self.events.append(('post', self.scheduler.snapshot()['in_flight']))
+            return self.response(next(responses))
+        return post
+
+    def test_each_attempt_takes_a_slot(self):
+        client = WhatsAppClient('http://api.test/send', 'token', max_retries=2)
+        with mock.patch.object(client.session, 'post', side_effect=self.post([503, 429, 200])), \
+                mock.patch('chatbridge.outbound.get_client', return_value=client), \
+                mock.patch('chatbridge.outbound.time.sleep', side_effect=self.sleep), \
+                self.assertLogs('chatbridge.outbound', 'WARNING'):
+            self.assertTrue(send_whatsapp_message('u', 'hi', 'f'))
+        self.assertEqual(self.events, [('post', 1), ('sleep', 0), ('post', 1), ('sleep', 0), ('post', 1)])
+        self.assertEqual(self.scheduler.snapshot()['in_flight'], 0)
+
+    def test_each_async_attempt_takes_a_slot(self):
+        async def sleep(delay):
+            self.sleep(delay)
+
+        async def send():
+            client = AsyncWhatsAppClient('http://api.test/send', 'token', max_retries=1)
+            with mock.patch.object(client.client, 'post', side_effect=self.post([500, 200])), \
+                    mock.patch('chatbridge.outbound.get_async_client', return_value=client), \
+                    mock.patch('chatbridge.outbound.asyncio.sleep', side_effect=sleep):
+                return await asend_whatsapp_message('u', 'hi', 'f')
+
+        with self.assertLogs('chatbridge.outbound', 'WARNING'):
+            self.assertTrue(asyncio.run(send()))
+        self.assertEqual(self.events, [('post', 1), ('sleep', 0), ('post', 1)])
+
+
+class RegistryRenderTests(SimpleTestCase):
+    def test_renders_counters_in_the_text_format(self):
+        registry = Registry()
+        requests_total = registry.register(Counter('requests_total', 'Requests\nby status.', ['status']))
+        requests_total.inc('200')
+        requests_total.inc('200')
+        requests_total.inc('5"03', amount=0.5)
+
+        self.assertEqual(registry.render(), (
+            '# HELP requests_total Requests\\nby status.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{status="200"} 2\n'
+            'requests_total{status="5\\"03"} 0.5\n'
+        ))
+
+    def test_renders_cumulative_histogram_buckets(self):
+        registry = Registry()
+        seconds = registry.register(Histogram('stage_seconds', 'Stage time.', ['stage'], buckets=(0.1, 1.0)))
+        seconds.observe(0.05, 'decode')
+        seconds.observe(0.5, 'decode')
+        seconds.observe(3, 'decode')
+
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'stage_seconds_bucket{stage="decode",le="0.1"} 1',
+            'stage_seconds_bucket{stage="decode",le="1"} 2',
+            'stage_seconds_bucket{stage="decode",le="+Inf"} 3',
+            'stage_seconds_sum{stage="decode"} 3.55',
+            'stage_seconds_count{stage="decode"} 3',
+        ])
+
+    def test_rejects_the_wrong_number_of_labels(self):
+        with self.assertRaises(ValueError):
+            Counter('requests_total', 'Requests.', ['status']).inc()
+
+
+class MetricsViewTests(TestCase):
+    def get(self, name, token=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        return self.client.get(reverse(name), headers=headers)
+
+    @override_settings(CHATBRIDGE_METRICS_TOKEN='')
+    def test_endpoints_do_not_exist_without_a_token(self):
+        self.assertEqual(self.get('chatbridge_metrics').status_code, 404)
+        self.assertEqual(self.get('webhook_status').status_code, 404)
+
+    @override_settings(CHATBRIDGE_METRICS_TOKEN='secret')
+    def test_rejects_missing_or_wrong_tokens(self):
+        for name in ('chatbridge_metrics', 'webhook_status'):
+            for token in (None, 'wrong'):
+                response = self.get(name, token)
+                self.assertEqual(response.status_code, 401)
+                self.assertEqual(response.content, b'Unauthorized\n')
+
+    @override_settings(CHATBRIDGE_METRICS_TOKEN='secret')
+    def test_serves_stage_histograms(self):
+        with stage('metrics_view_test'):
+            pass
+        with self.assertRaises(RuntimeError):
+            with stage('metrics_view_test'):
+                raise RuntimeError('boom')
+
+        response = self.get('chatbridge_metrics', 'secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE chatbridge_webhook_stage_seconds histogram', lines)
+        self.assertIn('chatbridge_webhook_stage_seconds_bucket{stage="metrics_view_test",le="+Inf"} 2', lines)
+        self.assertIn('chatbridge_webhook_stage_seconds_count{stage="metrics_view_test"} 2', lines)
+        self.assertIn('chatbridge_webhook_stage_failures_total{stage="metrics_view_test"} 1', lines)
+        self.assertIn('# TYPE chatbridge_messagelog_buffered_rows gauge', lines)
+
+    @override_settings(CHATBRIDGE_METRICS_TOKEN='secret')
+    def test_serves_the_webhook_status(self):
+        response = self.get('webhook_status', 'secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('message_log_writer', response.json())
+
+
+class DecodeWebhookBodyTests(SimpleTestCase):
+    body = json.dumps({'entry': [{'id': 'w', 'changes': [change('f', [{'wa_id': 'a', 'profile': {'name': 'Zoë'}}], [
+        text_message('wamid.1', 'a', 'olá 👋'),
+    ])]}]}, ensure_ascii=False).encode('utf-8')
+
+    def decoders(self):
+        # With orjson when it is installed, and always with the json fallback
+        yield 'default'
+        with mock.patch('chatbridge.webhook.orjson', None):
+            yield 'json'
+
+    def test_decodes_utf8_json(self):
+        for decoder in self.decoders():
+            with self.subTest(decoder):
+                data = decode_webhook_body(self.body)
+                self.assertEqual(parse_webhook_events(data)[0]['msg_body'], 'olá 👋')
+                self.assertEqual(parse_webhook_events(data)[0]['profile_name'], 'Zoë')
+
+    def test_rejects_invalid_bodies(self):
+        for decoder in self.decoders():
+            for body in (b'', b'{"entry": [', b'\xff\xfe{}', 'olá'.encode('latin-1'), '{}'.encode('utf-16')):
+                with self.subTest(decoder, body=body):
+                    with self.assertRaises(ValueError):
+                        decode_webhook_body(body)
+
+
+class InvalidWebhookBodyTests(TestCase):
+    bodies = (b'{"entry": [', b'\xff\xfe{}')
+
+    def test_sync_view_answers_400(self):
+        for body in self.bodies:
+            with self.subTest(body=body):
+                with self.assertLogs('chatbridge.views', 'WARNING'):
+                    response = self.client.post(reverse('whatsapp_webhook'), body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_async_view_answers_400(self):
+        for body in self.bodies:
+            with self.subTest(body=body):
+                request = AsyncRequestFactory().post('/webhook/', body, content_type='application/json')
+                with self.assertLogs('chatbridge.async_views', 'WARNING'):
+                    response = async_to_sync(async_views.whatsapp_webhook)(request)
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(WebhookDelivery.objects.exists())
+
+
+@override_settings(CHATBRIDGE_BROADCAST_CHUNK_SIZE=2, CHATBRIDGE_BROADCAST_CONCURRENCY=1, CHATBRIDGE_BROADCAST_IN_PROCESS=False)
+class BroadcastTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name='Broadcast firm', phone_number='400', first_step='start')
+        for index in range(5):
+            ChatUser.objects.create(firm=self.firm, phone_number=f'u{index}', profile_name=f'U{index}', current_step='start')
+        self.sent_to = []
+        patcher = mock.patch('chatbridge.broadcast.get_rollups')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, fail=(), die_at=None):
+        def send(to_number, message, firm_phone_number, priority):
+            if to_number == die_at:
+                # Not an Exception: the process dies mid-chunk
+                raise SystemExit
+            self.sent_to.append(to_number)
+            return to_number not in fail
+        return mock.patch('chatbridge.broadcast.send_whatsapp_message', side_effect=send)
+
+    def test_filtered_broadcast(self):
+        job = create_broadcast('400', 'Hello', filters={})
+        with self.send(fail={'u1'}):
+            job = run_broadcast(job.pk)
+        self.assertEqual(self.sent_to, [f'u{index}' for index in range(5)])
+        self.assertEqual((job.status, job.total, job.sent, job.failed), ('done', 5, 4, 1))
+        self.assertEqual(job.position, ChatUser.objects.get(phone_number='u4').pk)
+        statuses = dict(MessageLog.objects.filter(direction='OUT').values_list('phone_number', 'status'))
+        self.assertEqual(statuses['u1'], 'failed')
+        self.assertEqual(list(statuses.values()).count('sent'), 4)
+        progress = broadcast_progress(job)
+        self.assertEqual((progress['progress'], progress['pending']), (1.0, 0))
+
+    def test_resume_after_the_process_died(self):
+        for job in (create_broadcast('400', 'Hello', filters={}), create_broadcast('400', 'Hi', recipients=['a', 'b', 'c', 'd', 'e'])):
+            with self.subTest(recipients=job.recipients):
+                self.sent_to = []
+                die_at = 'u3' if job.recipients is None else 'd'
+                with self.send(die_at=die_at), self.assertRaises(SystemExit):
+                    run_broadcast(job.pk)
+                job.refresh_from_db()
+                # The first chunk was recorded, the interrupted one was not
+                self.assertEqual((job.status, job.sent, job.failed), ('running', 2, 0))
+                progress = broadcast_progress(job)
+                self.assertEqual((progress['progress'], progress['pending']), (0.4, 3))
+
+                self.assertIsNone(run_broadcast(job.pk))
+                with self.send():
+                    job = run_broadcast(job.pk, resume=True)
+                self.assertEqual((job.status, job.sent, job.failed), ('done', 5, 0))
+                # Only the interrupted chunk is sent again
+                self.assertEqual(len(self.sent_to), 2 + 1 + 3)
+                self.assertEqual(MessageLog.objects.filter(message=job.message).count(), 5)
+
+    def test_error_fails_the_job_and_keeps_its_progress(self):
+        job = create_broadcast('400', 'Hello', recipients=['a', 'b', 'c'])
+        with mock.patch('chatbridge.broadcast.MessageLog.objects.bulk_create', side_effect=[[], DatabaseError('gone')]), \
+                self.send(), self.assertLogs('chatbridge.broadcast', 'ERROR'):
+            job = run_broadcast(job.pk)
+        self.assertEqual((job.status, job.sent, job.position, job.error), ('failed', 2, 2, 'gone'))
+        self.assertIsNone(run_broadcast(job.pk, resume=True))
+
+    def test_api_requires_a_session_and_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        url = reverse('broadcasts')
+        body = {'firm_phone_number': '400', 'message': 'Hello', 'recipients': ['a', 'b']}
+        csrf_token = 'a' * 32
+        client.cookies['csrftoken'] = csrf_token
+
+        response = client.post(url, body, content_type='application/json', headers={'X-CSRFToken': csrf_token})
+        self.assertEqual(response.status_code, 401)
+
+        client.force_login(User.objects.create_user('operator'))
+        with self.assertLogs('django.security.csrf', 'WARNING'):
+            response = client.post(url, body, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        response = client.post(url, body, content_type='application/json', headers={'X-CSRFToken': csrf_token})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['total'], 2)
+        status = client.get(reverse('broadcast_status', args=[response.json()['job_id']]))
+        self.assertEqual(status.json()['status'], 'queued')
+
+    def test_run_broadcasts_command(self):
+        job = create_broadcast('400', 'Hello', recipients=['a', 'b', 'c'])
+        BroadcastJob.objects.filter(pk=job.pk).update(status='running', position=2, sent=2)
+        output = StringIO()
+        with self.send():
+            call_command('run_broadcasts', stdout=output)
+            self.assertEqual(self.sent_to, [])
+            call_command('run_broadcasts', '--resume', stdout=output)
+        self.assertEqual(self.sent_to, ['c'])
+        self.assertIn(f'Broadcast {job.pk} done: 3 sent, 0 failed of 3.', output.getvalue())
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.dispatcher = OutboxDispatcher(batch_size=10, concurrency=4, poll_interval=0.1, lease=60, max_attempts=2)
+        enqueue_replies([
+            ({'firm_phone_number': 'f', 'wa_id': wa_id, 'waba_id': 'w', 'profile_name': ''}, message)
+            for wa_id, message in [('a', 'a1'), ('b', 'b1'), ('a', 'a2')]
+        ])
+
+    def tearDown(self):
+        if self.dispatcher._executor is not None:
+            self.dispatcher._executor.shutdown()
+
+    def dispatch(self, send):
+        with mock.patch('chatbridge.outbox.send_whatsapp_message', side_effect=send) as sender:
+            self.assertEqual(self.dispatcher.dispatch_batch(), 3)
+        return [(call.args[0], call.args[1]) for call in sender.call_args_list]
+
+    def statuses(self):
+        return dict(OutboxMessage.objects.values_list('message', 'status'))
+
+    def test_claim_leases_rows(self):
+        rows = self.dispatcher.claim()
+        self.assertEqual([row.message for row in rows], ['a1', 'b1', 'a2'])
+        self.assertEqual(self.dispatcher.claim(), [])
+        self.assertTrue(all(row.available_at > timezone.now() for row in OutboxMessage.objects.all()))
+
+    def test_sends_each_recipient_in_order(self):
+        calls = self.dispatch(lambda *args: True)
+        self.assertEqual([message for number, message in calls if number == 'a'], ['a1', 'a2'])
+        self.assertEqual(set(self.statuses().values()), {'sent'})
+        self.assertEqual(MessageLog.objects.filter(direction='OUT', status='sent').count(), 3)
+
+    def test_failed_send_holds_back_later_replies(self):
+        calls = self.dispatch(lambda number, message, *args: message != 'a1')
+        self.assertNotIn(('a', 'a2'), calls)
+        self.assertEqual(self.statuses(), {'a1': 'pending', 'b1': 'sent', 'a2': 'pending'})
+        failed = OutboxMessage.objects.get(message='a1')
+        self.assertEqual(failed.attempts, 1)
+        self.assertGreater(failed.available_at, timezone.now())
+        self.assertEqual(self.dispatcher.claim(), [])
+
+        # Once due again, the retry succeeds and the held back reply follows
+        OutboxMessage.objects.filter(status='pending').update(available_at=timezone.now())
+        with mock.patch('chatbridge.outbox.send_whatsapp_message', return_value=True) as sender:
+            self.assertEqual(self.dispatcher.dispatch_batch(), 2)
+        self.assertEqual([call.args[1] for call in sender.call_args_list], ['a1', 'a2'])
+        self.assertEqual(set(self.statuses().values()), {'sent'})
+
+    def test_gives_up_after_max_attempts(self):
+        with self.assertLogs('chatbridge.outbox', 'ERROR'):
+            for _ in range(2):
+                OutboxMessage.objects.filter(status='pending').update(available_at=timezone.now())
+                with mock.patch('chatbridge.outbox.send_whatsapp_message', side_effect=lambda number, *args: number != 'a'):
+                    self.dispatcher.dispatch_batch()
+        self.assertEqual(self.statuses(), {'a1': 'failed', 'b1': 'sent', 'a2': 'pending'})
+        self.assertTrue(MessageLog.objects.filter(message='a1', status='failed').exists())
+        # The later reply no longer waits for the abandoned one
+        self.assertEqual([row.message for row in self.dispatcher.claim()], ['a2'])
+
+    def test_replies_written_during_a_retry_wait_for_it(self):
+        self.dispatch(lambda number, message, *args: message != 'a1')
+        enqueue_replies([
+            ({'firm_phone_number': 'f', 'wa_id': wa_id, 'waba_id': 'w', 'profile_name': ''}, message)
+            for wa_id, message in [('a', 'a3'), ('b', 'b2')]
+        ])
+        self.assertEqual([row.message for row in self.dispatcher.claim()], ['b2'])
+
+        OutboxMessage.objects.filter(message__in=['a1', 'a2']).update(available_at=timezone.now())
+        self.assertEqual([row.message for row in self.dispatcher.claim()], ['a1', 'a2', 'a3'])
+
+    def test_replies_wait_for_earlier_ones_held_by_another_dispatcher(self):
+        # Leased by another dispatcher
+        OutboxMessage.objects.filter(message='a1').update(available_at=timezone.now() + datetime.timedelta(seconds=60))
+        self.assertEqual([row.message for row in self.dispatcher.claim()], ['b1'])
+
+        # Locked by a claim that has not leased it yet, so skipped by the query
+        OutboxMessage.objects.update(available_at=timezone.now())
+        rows = list(OutboxMessage.objects.exclude(message='a1').order_by('id'))
+        self.assertEqual([row.message for row in OutboxDispatcher._first_in_line(rows)], ['b1'])
@@ -1,7 +1,23 @@
+from django.conf import settings
 from django.urls import path
-from .views import whatsapp_webhook, send_message
+from .views import webhook_status, conversation_history, export_message_logs, metrics, broadcasts, broadcast_status
+
+if settings.CHATBRIDGE_ASYNC_VIEWS:
+    from .async_views import whatsapp_webhook, send_message
+else:
+    from .views import whatsapp_webhook, send_message
  
 urlpatterns = [
     path('webhook/', whatsapp_webhook, name='whatsapp_webhook'),
+    path('webhook/status/', webhook_status, name='webhook_status'),
     path('send-message/', send_message, name='send_message'),
+    path(
+        'conversations/<str:firm_phone_number>/<str:phone_number>/',
+        conversation_history,
+        name='conversation_history',
+    ),
+    path('export/', export_message_logs, name='export_message_logs'),
+    path('metrics/', metrics, name='chatbridge_metrics'),
+    path('broadcasts/', broadcasts, name='broadcasts'),
+    path('broadcasts/<int:job_id>/', broadcast_status, name='broadcast_status'),
 ] 
\ No newline at end of file
@@ -1,14 +1,24 @@
 from django.shortcuts import render
-from django.http import JsonResponse, HttpResponse
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 import logging
 import json
-from .models import MessageLog
-from django.conf import settings
-from firms.models import Firm, ChatUser
-from firms.utils import get_firm_by_phone, get_next_message, get_or_create_chat_user
-import requests
+from .broadcast import InvalidBroadcast, broadcast_progress, create_broadcast, start_broadcast
+from .decorators import api_login_required, metrics_token_required
+from .dedup import dedup_snapshot
+from .export import EXPORT_FORMATS, InvalidExportRange, iter_message_logs, parse_bound
+from .history import InvalidCursor, get_conversation_page
+from .inbox import get_inbox_sweeper
+from .metrics import REGISTRY, WEBHOOK_REQUESTS, stage
+from .models import BroadcastJob
+from .outbound import send_whatsapp_message
+from .outbox import get_outbox_dispatcher, outbox_backlog
+from .scheduler import PRIORITIES, REPLY, get_scheduler
+from .webhook import decode_webhook_body, log_webhook_payload, parse_webhook_events
+from .worker import enqueue_webhook_events, get_webhook_pool
+from .writer import get_message_log_writer, log_message
 
 logger = logging.getLogger(__name__)
 
@@ -17,79 +27,23 @@ logger = logging.getLogger(__name__)
 @csrf_exempt
 def whatsapp_webhook(request):
     if request.method == 'POST':
-        try:
-            data = json.loads(request.body.decode('utf-8'))
-        except Exception as e:
-            logger.error(f'Error decoding JSON: {e}')
-            data = {}
-        logger.info(f'Received WhatsApp webhook data: {data}')
-        # Parse WhatsApp Business API format
-        try:
-            entry = data.get('entry', [])[0]
-            waba_id = entry.get('id', '')
-            change = entry.get('changes', [])[0]
-            value = change.get('value', {})
-            metadata = value.get('metadata', {})
-            firm_phone_number = metadata.get('display_phone_number', '')
-            contacts = value.get('contacts', [])
-            messages = value.get('messages', [])
-            if contacts and messages:
-                wa_id = contacts[0].get('wa_id', '')
-                profile_name = contacts[0].get('profile', {}).get('name', '')
-                msg = messages[0]
-                msg_body = msg.get('text', {}).get('body', '')
-                msg_type = msg.get('type', '')
-                msg_id = msg.get('id', '')
-                timestamp = msg.get('timestamp', '')
-                
-                # Log the incoming message
-                MessageLog.objects.create(
-                    direction='IN',
-                    phone_number=wa_id,
-                    message=f"{msg_body}",
-                    status='received',
-                    whatsapp_business_account_id=waba_id,
-                    firm_phone_number=firm_phone_number,
-                    user_name=profile_name,
-                    message_id=msg_id,
-                )
-                logger.info(f"Logged WhatsApp message from {wa_id}: {msg_body}")
-                
-                # Process the message and get response
-                firm = get_firm_by_phone(firm_phone_number)
-                if firm:
-                    chat_user = get_or_create_chat_user(firm, wa_id, profile_name)
-                    next_step, response_message = get_next_message(
-                        firm,
-                        chat_user.current_step,
-                        msg_body
-                    )
-                    print(f"Next step: {next_step}")
-                    print(f"Response message: {response_message}")
-                    
-                    if next_step:
-                        # Update user's current step
-                        chat_user.current_step = next_step
-                        chat_user.last_message_received = msg_body
-                        chat_user.save()
-                        
-                        # Send response message
-                        send_whatsapp_message(wa_id, response_message)
-                        
-                        # Log the outgoing message
-                        MessageLog.objects.create(
-                            direction='OUT',
-                            phone_number=wa_id,
-                            message=response_message,
-                            status='sent',
-                            whatsapp_business_account_id=waba_id,
-                            firm_phone_number=firm_phone_number,
-                            user_name=profile_name,
-                        )
-            else:
-                logger.warning('No contacts or messages found in webhook payload.')
-        except Exception as e:
-            logger.error(f'Error parsing WhatsApp webhook format: {e}')
+        with stage('decode'):
+            try:
+                data = decode_webhook_body(request.body)
+            except ValueError as e:
+                logger.warning('Rejecting webhook delivery that is not valid JSON: %s', e)
+                WEBHOOK_REQUESTS.inc('400')
+                return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        log_webhook_payload(request.body)
+        # Acknowledge once the events are in the inbox; they are processed
+        # by the worker pool
+        events = parse_webhook_events(data)
+        logger.debug('Received webhook delivery with %d messages', len(events))
+        if events and not enqueue_webhook_events(events):
+            logger.warning('Webhook delivery not persisted or queue full, asking the provider to redeliver.')
+            WEBHOOK_REQUESTS.inc('503')
+            return JsonResponse({'status': 'busy'}, status=503)
+        WEBHOOK_REQUESTS.inc('200')
         return JsonResponse({'status': 'received'}, status=200)
     return JsonResponse({'error': 'Invalid method'}, status=405)
 
@@ -102,13 +56,16 @@ def send_message(request):
             message = data.get('message')
             if not recipient or not message:
                 return JsonResponse({'error': 'recipient and message are required'}, status=400)
+            priority = data.get('priority', REPLY)
+            if priority not in PRIORITIES:
+                return JsonResponse({'error': f'priority must be one of {", ".join(PRIORITIES)}'}, status=400)
             
             # Send message via WhatsApp API
-            success = send_whatsapp_message(recipient, message)
+            success = send_whatsapp_message(recipient, message, data.get('firm_phone_number') or '', priority)
             
             if success:
                 # Log the message
-                MessageLog.objects.create(
+                log_message(
                     direction='OUT',
                     phone_number=recipient,
                     message=message,
@@ -119,34 +76,114 @@ def send_message(request):
                 return JsonResponse({'error': 'Failed to send message'}, status=500)
                 
         except Exception as e:
-            logger.error(f'Error in send_message: {e}')
+            logger.error('Error in send_message: %s', e)
             return JsonResponse({'error': 'Invalid request'}, status=400)
     return JsonResponse({'error': 'Invalid method'}, status=405)
 
-def send_whatsapp_message(to_number: str, message: str) -> bool:
-    """
-    Send a WhatsApp message using the configured API.
-    
-    Args:
-        to_number (str): The recipient's phone number
-        message (str): The message to send
-        
-    Returns:
-        bool: True if message was sent successfully, False otherwise
-    """
+@require_GET
+@metrics_token_required
+def metrics(request):
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def outbox_status():
+    if not settings.CHATBRIDGE_OUTBOX:
+        return None
+    return dict(get_outbox_dispatcher().snapshot(), pending=outbox_backlog())
+
+@require_GET
+@metrics_token_required
+def webhook_status(request):
+    if settings.CHATBRIDGE_ASYNC_VIEWS:
+        from .async_views import webhook_runner
+        return JsonResponse({
+            'async_in_flight': webhook_runner.in_flight(),
+            'message_log_writer': get_message_log_writer().snapshot(),
+            'dedup': dedup_snapshot(),
+            'outbound': get_scheduler().snapshot(),
+            'outbox': outbox_status(),
+            'inbox': get_inbox_sweeper().snapshot(),
+        })
+    pool = get_webhook_pool()
+    return JsonResponse({
+        'workers': pool.workers,
+        'queue_depth': pool.depth(),
+        'queue_depths': pool.depths(),
+        'message_log_writer': get_message_log_writer().snapshot(),
+        'dedup': dedup_snapshot(),
+        'outbound': get_scheduler().snapshot(),
+        'outbox': outbox_status(),
+        'inbox': get_inbox_sweeper().snapshot(),
+    })
+
+@require_GET
+@api_login_required
+def conversation_history(request, firm_phone_number, phone_number):
     try:
-        print(f"Sending WhatsApp message to {to_number}: {message}")
-        response = requests.post(
-            settings.WHATSAPP_API_URL,
-            json={
-                'to': to_number,
-                'message': message
-            },
-            headers={
-                'Authorization': f'Bearer {settings.WHATSAPP_API_TOKEN}'
-            }
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 200)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    try:
+        messages, next_cursor = get_conversation_page(
+            firm_phone_number,
+            phone_number,
+            limit,
+            request.GET.get('cursor'),
+            include_archived=request.GET.get('include_archived') in ('1', 'true'),
         )
-        return response.status_code == 200
-    except Exception as e:
-        logger.error(f'Error sending WhatsApp message: {e}')
-        return False
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'messages': messages, 'next_cursor': next_cursor})
+
+@require_GET
+@api_login_required
+def export_message_logs(request):
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}, status=400)
+    try:
+        start = parse_bound(request.GET.get('start'))
+        end = parse_bound(request.GET.get('end'))
+    except InvalidExportRange as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    firm_phone_number = request.GET.get('firm_phone_number')
+    lines, content_type = EXPORT_FORMATS[export_format]
+    # Rows are read in chunks while the response is written
+    response = StreamingHttpResponse(
+        lines(iter_message_logs(firm_phone_number, start, end)),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="messagelog.{export_format}"'
+    return response
+
+# Session-authenticated like the dashboard, so unlike the webhook and
+# send_message it keeps CSRF protection: API clients log in, then send the
+# csrftoken cookie back in the X-CSRFToken header.
+@require_POST
+@api_login_required
+def broadcasts(request):
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'error': 'Expected a JSON object'}, status=400)
+    try:
+        job = create_broadcast(
+            data.get('firm_phone_number'),
+            data.get('message'),
+            recipients=data.get('recipients'),
+            filters=data.get('filter'),
+        )
+    except InvalidBroadcast as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    # Sent in the background; poll broadcast_status for progress
+    start_broadcast(job)
+    return JsonResponse(broadcast_progress(job), status=202)
+
+@require_GET
+@api_login_required
+def broadcast_status(request, job_id):
+    job = BroadcastJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse({'error': 'Broadcast not found'}, status=404)
+    return JsonResponse(broadcast_progress(job))
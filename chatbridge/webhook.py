@@ -0,0 +1,392 @@
+from typing import Callable, List, Tuple
+import asyncio
+import json
+import logging
+import random
+
+from django.conf import settings
+from django.utils import timezone
+
+from firms.rollups import get_rollups, mark_active
+from firms.state import StaleConversationState
+from firms.utils import (
+    aget_firms_by_phone,
+    aget_next_message,
+    aget_or_create_chat_users,
+    asave_chat_user_states,
+    discard_chat_user_states,
+    get_firms_by_phone,
+    get_next_message,
+    get_or_create_chat_users,
+    save_chat_user_states,
+)
+from .dedup import ConcurrentDelivery, adrop_duplicate_events, drop_duplicate_events, record_processed
+from .metrics import OUTBOUND_MESSAGES, WEBHOOK_EVENTS, stage
+from .outbound import asend_whatsapp_message, send_whatsapp_message
+from .outbox import enqueue_replies
+from .writer import alog_message, log_message
+
+try:
+    import orjson
+except ImportError:  # optional; the standard library decoder is used without it
+    orjson = None
+
+logger = logging.getLogger(__name__)
+# Sampled full webhook payloads, see log_webhook_payload
+payload_logger = logging.getLogger('chatbridge.payloads')
+
+# Times a batch is processed when other deliveries of its messages, or other
+# processes saving its conversations, keep committing first
+BATCH_ATTEMPTS = 3
+
+# Raised when a batch lost a race and must be processed again
+RETRIED_ERRORS = (ConcurrentDelivery, StaleConversationState)
+
+
+def decode_webhook_body(body: bytes):
+    """
+    Decode a webhook request body.
+
+    orjson parses the raw bytes several times faster than the json module;
+    it is used when installed.
+
+    Args:
+        body (bytes): The request body
+
+    Returns:
+        The decoded JSON document
+
+    Raises:
+        ValueError: If the body is not valid UTF-8 JSON
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    # Decoded first: json.loads would also accept UTF-16 and UTF-32 bytes
+    return json.loads(body.decode('utf-8'))
+
+
+def log_webhook_payload(body: bytes) -> None:
+    """
+    Log the raw body of a sample of webhook deliveries.
+
+    Payloads go to the chatbridge.payloads logger at DEBUG, for a
+    CHATBRIDGE_PAYLOAD_LOG_SAMPLE_RATE fraction of deliveries; nothing is
+    formatted unless that logger is enabled for DEBUG.
+
+    Args:
+        body (bytes): The request body
+    """
+    rate = settings.CHATBRIDGE_PAYLOAD_LOG_SAMPLE_RATE
+    if rate and payload_logger.isEnabledFor(logging.DEBUG) and random.random() < rate:
+        payload_logger.debug('Webhook payload: %s', body.decode('utf-8', 'replace'))
+
+
+def parse_webhook_events(data: dict) -> List[dict]:
+    """
+    Extract every inbound message from a WhatsApp Business API webhook payload.
+    
+    Deliveries can batch several entries, changes and messages; events are
+    returned in payload order.
+    
+    Args:
+        data (dict): The decoded webhook payload
+        
+    Returns:
+        List[dict]: The message events, empty if the payload carries no message
+    """
+    events = []
+    try:
+        for entry in data.get('entry', []):
+            waba_id = entry.get('id', '')
+            for change in entry.get('changes', []):
+                value = change.get('value', {})
+                metadata = value.get('metadata', {})
+                firm_phone_number = metadata.get('display_phone_number', '')
+                contacts = value.get('contacts', [])
+                messages = value.get('messages', [])
+                if not contacts or not messages:
+                    continue
+                profiles = {
+                    contact.get('wa_id', ''): contact.get('profile', {}).get('name', '')
+                    for contact in contacts
+                }
+                default_wa_id = contacts[0].get('wa_id', '')
+                for msg in messages:
+                    wa_id = msg.get('from') or default_wa_id
+                    events.append({
+                        'waba_id': waba_id,
+                        'firm_phone_number': firm_phone_number,
+                        'wa_id': wa_id,
+                        'profile_name': profiles.get(wa_id, ''),
+                        'msg_body': msg.get('text', {}).get('body', ''),
+                        'msg_type': msg.get('type', ''),
+                        'msg_id': msg.get('id', ''),
+                        'timestamp': msg.get('timestamp', ''),
+                    })
+    except Exception as e:
+        logger.error('Error parsing WhatsApp webhook format: %s', e)
+    if not events:
+        # Status callbacks (sent, delivered, read) carry no messages
+        logger.debug('No contacts or messages found in webhook payload.')
+    return events
+
+
+def inbound_log_fields(event: dict) -> dict:
+    return {
+        'direction': 'IN',
+        'phone_number': event['wa_id'],
+        'message': f"{event['msg_body']}",
+        'status': 'received',
+        'whatsapp_business_account_id': event['waba_id'],
+        'firm_phone_number': event['firm_phone_number'],
+        'user_name': event['profile_name'],
+        'message_id': event['msg_id'] or None,
+    }
+
+
+def outbound_log_fields(event: dict, response_message: str) -> dict:
+    return {
+        'direction': 'OUT',
+        'phone_number': event['wa_id'],
+        'message': response_message,
+        'status': 'sent',
+        'whatsapp_business_account_id': event['waba_id'],
+        'firm_phone_number': event['firm_phone_number'],
+        'user_name': event['profile_name'],
+    }
+
+
+def advance_conversation(event: dict, chat_user, next_step: str) -> bool:
+    if not next_step:
+        return False
+    logger.debug('Conversation %s moves from %s to %s', event['wa_id'], chat_user.current_step, next_step)
+    # Update user's current step
+    chat_user.current_step = next_step
+    chat_user.last_message_received = event['msg_body']
+    return True
+
+
+def batch_writes(events: List[dict], replies: List[Tuple[dict, str]]) -> Callable[[], None]:
+    # Writes that commit or roll back with the conversation states: the
+    # dedup ledger rows and, with the outbox, the replies
+    def write():
+        record_processed(events)
+        if settings.CHATBRIDGE_OUTBOX:
+            enqueue_replies(replies)
+    return write
+
+
+def handle_webhook_events(events: List[dict]) -> None:
+    """
+    Log a batch of inbound messages, advance the conversations and send the replies.
+    
+    Firms and chat users are looked up once for the whole batch and the
+    conversation state changes are written with a single bulk update.
+    Message volume, active users and step transitions are counted in the
+    firm rollups, and each stage is timed in chatbridge.metrics.
+    Events for the same conversation are applied in order, and provider
+    redeliveries of already processed messages are dropped up front.
+    The messages' dedup ledger rows are written in the transaction that
+    saves the states, so a batch that fails is processed again when
+    redelivered; if another delivery of one of its messages commits first,
+    the batch is rolled back and retried without it. It is also retried,
+    with the conversations reloaded, when another process saved one of
+    them since it was cached.
+    With CHATBRIDGE_OUTBOX the replies are not sent here but written to the
+    outbox in the same transaction.
+    
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+    """
+    received = len(events)
+    WEBHOOK_EVENTS.inc('received', amount=received)
+    for attempt in range(1, BATCH_ATTEMPTS + 1):
+        with stage('dedup'):
+            fresh = drop_duplicate_events(events)
+        try:
+            process_webhook_events(fresh)
+            break
+        except RETRIED_ERRORS as e:
+            if attempt == BATCH_ATTEMPTS:
+                raise
+            logger.info('Retrying webhook batch: %s', e)
+    WEBHOOK_EVENTS.inc('duplicate', amount=received - len(fresh))
+
+
+def process_webhook_events(events: List[dict]) -> None:
+    if not events:
+        return
+    received_at = timezone.now()
+
+    # Process the messages and get responses
+    with stage('firm_lookup'):
+        firms = get_firms_by_phone(event['firm_phone_number'] for event in events)
+    routed = [event for event in events if event['firm_phone_number'] in firms]
+    with stage('chat_user_fetch'):
+        chat_users = get_or_create_chat_users([
+            (firms[event['firm_phone_number']], event['wa_id'], event['profile_name'])
+            for event in routed
+        ])
+
+    try:
+        rollups = get_rollups()
+        replies = []
+        changed = {}
+        inbound = []
+        transitions = []
+        for event in routed:
+            firm = firms[event['firm_phone_number']]
+            chat_user = chat_users[(firm.pk, event['wa_id'])]
+            # Users whose message neither advances the conversation nor starts
+            # a new active hour are not saved; last_active_at is kept to the hour
+            new_user, first_this_hour = mark_active(chat_user, received_at)
+            if first_this_hour:
+                changed[chat_user.pk] = chat_user
+            inbound.append((firm.pk, new_user, first_this_hour))
+            previous_step = chat_user.current_step
+            with stage('flow'):
+                next_step, response_message = get_next_message(
+                    firm,
+                    chat_user.current_step,
+                    event['msg_body']
+                )
+            if advance_conversation(event, chat_user, next_step):
+                changed[chat_user.pk] = chat_user
+                transitions.append((firm.pk, previous_step, next_step))
+                replies.append((event, response_message))
+
+        # With the outbox, the replies commit or roll back with the new
+        # steps and the outbox dispatcher sends and logs them
+        with stage('state_save'):
+            save_chat_user_states(changed.values(), also=batch_writes(events, replies))
+    except Exception:
+        # The cached chat users were changed in place; do not serve those
+        # changes to later messages when they were not saved
+        discard_chat_user_states(chat_users.values())
+        raise
+    WEBHOOK_EVENTS.inc('unknown_firm', amount=len(events) - len(routed))
+    WEBHOOK_EVENTS.inc('advanced', amount=len(replies))
+    # Counted once the states are saved, so retries count each message once
+    for firm_id, new_user, first_this_hour in inbound:
+        rollups.record_inbound(firm_id, received_at, new_user, first_this_hour)
+    for firm_id, previous_step, next_step in transitions:
+        rollups.record_transition(firm_id, previous_step, next_step, received_at)
+
+    for event in events:
+        # Log the incoming message
+        with stage('inbound_log'):
+            log_message(**inbound_log_fields(event), timestamp=received_at)
+        logger.debug('Logged WhatsApp message %s from %s', event['msg_id'], event['wa_id'])
+    if settings.CHATBRIDGE_OUTBOX:
+        return
+
+    for event, response_message in replies:
+        # Send response message
+        with stage('send'):
+            sent = send_whatsapp_message(event['wa_id'], response_message, event['firm_phone_number'])
+        OUTBOUND_MESSAGES.inc('sent' if sent else 'failed')
+        if sent:
+            rollups.record_outbound(firms[event['firm_phone_number']].pk, timezone.now())
+
+        # Log the outgoing message
+        with stage('outbound_log'):
+            log_message(**outbound_log_fields(event, response_message))
+
+
+async def ahandle_webhook_events(events: List[dict]) -> None:
+    """
+    Async version of handle_webhook_events.
+    
+    Replies to different users are sent concurrently; replies to the same
+    user are sent one after the other, in order.
+    
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+    """
+    received = len(events)
+    WEBHOOK_EVENTS.inc('received', amount=received)
+    for attempt in range(1, BATCH_ATTEMPTS + 1):
+        with stage('dedup'):
+            fresh = await adrop_duplicate_events(events)
+        try:
+            await aprocess_webhook_events(fresh)
+            break
+        except RETRIED_ERRORS as e:
+            if attempt == BATCH_ATTEMPTS:
+                raise
+            logger.info('Retrying webhook batch: %s', e)
+    WEBHOOK_EVENTS.inc('duplicate', amount=received - len(fresh))
+
+
+async def aprocess_webhook_events(events: List[dict]) -> None:
+    if not events:
+        return
+    received_at = timezone.now()
+
+    with stage('firm_lookup'):
+        firms = await aget_firms_by_phone(event['firm_phone_number'] for event in events)
+    routed = [event for event in events if event['firm_phone_number'] in firms]
+    with stage('chat_user_fetch'):
+        chat_users = await aget_or_create_chat_users([
+            (firms[event['firm_phone_number']], event['wa_id'], event['profile_name'])
+            for event in routed
+        ])
+
+    try:
+        rollups = get_rollups()
+        replies = {}
+        changed = {}
+        inbound = []
+        transitions = []
+        for event in routed:
+            firm = firms[event['firm_phone_number']]
+            chat_user = chat_users[(firm.pk, event['wa_id'])]
+            new_user, first_this_hour = mark_active(chat_user, received_at)
+            if first_this_hour:
+                changed[chat_user.pk] = chat_user
+            inbound.append((firm.pk, new_user, first_this_hour))
+            previous_step = chat_user.current_step
+            with stage('flow'):
+                next_step, response_message = await aget_next_message(
+                    firm,
+                    chat_user.current_step,
+                    event['msg_body']
+                )
+            if advance_conversation(event, chat_user, next_step):
+                changed[chat_user.pk] = chat_user
+                transitions.append((firm.pk, previous_step, next_step))
+                replies.setdefault(chat_user.pk, []).append((event, response_message))
+
+        ordered = [reply for user_replies in replies.values() for reply in user_replies]
+        with stage('state_save'):
+            await asave_chat_user_states(changed.values(), also=batch_writes(events, ordered))
+    except BaseException:
+        # Also on cancellation, which can interrupt any await above
+        discard_chat_user_states(chat_users.values())
+        raise
+    WEBHOOK_EVENTS.inc('unknown_firm', amount=len(events) - len(routed))
+    WEBHOOK_EVENTS.inc('advanced', amount=len(ordered))
+    # Counted once the states are saved, so retries count each message once
+    for firm_id, new_user, first_this_hour in inbound:
+        rollups.record_inbound(firm_id, received_at, new_user, first_this_hour)
+    for firm_id, previous_step, next_step in transitions:
+        rollups.record_transition(firm_id, previous_step, next_step, received_at)
+
+    for event in events:
+        with stage('inbound_log'):
+            await alog_message(**inbound_log_fields(event), timestamp=received_at)
+        logger.debug('Logged WhatsApp message %s from %s', event['msg_id'], event['wa_id'])
+    if settings.CHATBRIDGE_OUTBOX:
+        return
+
+    async def reply_in_order(user_replies):
+        for event, response_message in user_replies:
+            with stage('send'):
+                sent = await asend_whatsapp_message(event['wa_id'], response_message, event['firm_phone_number'])
+            OUTBOUND_MESSAGES.inc('sent' if sent else 'failed')
+            if sent:
+                rollups.record_outbound(firms[event['firm_phone_number']].pk, timezone.now())
+            with stage('outbound_log'):
+                await alog_message(**outbound_log_fields(event, response_message))
+
+    await asyncio.gather(*(reply_in_order(user_replies) for user_replies in replies.values()))
@@ -0,0 +1,266 @@
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+import atexit
+import logging
+import queue
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .inbox import complete_delivery, persist_delivery
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WorkerPool:
+    """
+    A pool of worker threads, each draining its own FIFO queue.
+
+    Items are assigned to a queue by hashing their key, so all items sharing
+    a key are handled by the same thread in submission order, while items
+    with different keys are processed concurrently.
+    """
+
+    def __init__(self, handler: Callable, workers: int, max_queue_size: int = 0, name: str = 'worker'):
+        self.handler = handler
+        self.workers = workers
+        self.name = name
+        self._queues: List[queue.Queue] = [queue.Queue(max_queue_size) for _ in range(workers)]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._put_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        # Threads are started lazily so forking servers start them per worker
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index, q in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run, args=(q,), name=f'{self.name}-{index}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _shard_index(self, key: Hashable) -> int:
+        digest = zlib.crc32(repr(key).encode('utf-8'))
+        return digest % max(self.workers, 1)
+
+    def _handle_inline(self, item) -> None:
+        # No workers configured: process inline, logging errors as the
+        # workers do so the delivery is still acknowledged
+        try:
+            self.handler(item)
+        except Exception:
+            logger.exception('Error processing %s item inline', self.name)
+
+    def submit(self, key: Hashable, item) -> bool:
+        """
+        Queue an item for processing.
+
+        Args:
+            key (Hashable): Items with equal keys are processed in order
+            item: The item passed to the handler
+
+        Returns:
+            bool: True if the item was queued, False if its queue is full
+        """
+        if self.workers <= 0:
+            self._handle_inline(item)
+            return True
+        self._ensure_started()
+        with self._put_lock:
+            try:
+                self._queues[self._shard_index(key)].put_nowait(item)
+            except queue.Full:
+                return False
+        return True
+
+    def submit_batch(self, items: Iterable[Tuple[Hashable, object]]) -> bool:
+        """
+        Queue several keyed items, handing each worker its share as one list.
+
+        The handler is called with a list of items, in submission order, for
+        every worker that received at least one of them. Either every share
+        is queued or none is, so a delivery refused with False can be
+        redelivered without any of it being processed twice.
+
+        Args:
+            items (Iterable[Tuple[Hashable, object]]): (key, item) pairs
+
+        Returns:
+            bool: True if every share was queued, False if any queue was full
+        """
+        shards: Dict[int, list] = {}
+        for key, item in items:
+            shards.setdefault(self._shard_index(key), []).append(item)
+        if self.workers <= 0:
+            for batch in shards.values():
+                self._handle_inline(batch)
+            return True
+        self._ensure_started()
+        # Only producers fill the queues and they all hold this lock, so a
+        # queue with room when checked still has room when put to
+        with self._put_lock:
+            if any(self._queues[index].full() for index in shards):
+                return False
+            for index, batch in shards.items():
+                self._queues[index].put_nowait(batch)
+        return True
+
+    def share_count(self, keys: Iterable[Hashable]) -> int:
+        """Count the workers submit_batch would hand a share of these keys to."""
+        return len({self._shard_index(key) for key in keys})
+
+    def depth(self) -> int:
+        return sum(self.depths())
+
+    def depths(self) -> List[int]:
+        return [q.qsize() for q in self._queues]
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                close_old_connections()
+                self.handler(item)
+            except Exception:
+                logger.exception('Error processing queued item in %s', threading.current_thread().name)
+            finally:
+                close_old_connections()
+                q.task_done()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the workers once the items already queued have been processed.
+
+        Args:
+            timeout (Optional[float]): Seconds to wait for each worker
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for q in self._queues[:len(threads)]:
+            q.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+
+class PendingDeliveries:
+    """
+    Counts the shares of each webhook delivery still being processed, so
+    the delivery leaves the inbox only once every share succeeded.
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, List] = {}
+        self._lock = threading.Lock()
+
+    def expect(self, delivery_id: int, shares: int) -> None:
+        with self._lock:
+            self._pending[delivery_id] = [shares, True]
+
+    def forget(self, delivery_id: int) -> None:
+        with self._lock:
+            self._pending.pop(delivery_id, None)
+
+    def finish(self, delivery_id: int, succeeded: bool) -> bool:
+        """
+        Record that a share of a delivery was processed.
+
+        Returns:
+            bool: True if this was the last share and every share succeeded
+        """
+        with self._lock:
+            entry = self._pending.get(delivery_id)
+            if entry is None:
+                return False
+            entry[0] -= 1
+            entry[1] = entry[1] and succeeded
+            if entry[0] > 0:
+                return False
+            del self._pending[delivery_id]
+            return entry[1]
+
+
+pending_deliveries = PendingDeliveries()
+
+
+def handle_webhook_share(share: List[Tuple[int, dict]]) -> None:
+    """
+    Process a worker's share of a webhook delivery, and remove the delivery
+    from the inbox once all of its shares were processed. A delivery with a
+    failed share stays in the inbox for the inbox sweep to retry.
+
+    Args:
+        share (List[Tuple[int, dict]]): (inbox row id, message event) pairs
+            of one delivery
+    """
+    from .webhook import handle_webhook_events
+
+    delivery_id = share[0][0]
+    succeeded = False
+    try:
+        handle_webhook_events([event for _, event in share])
+        succeeded = True
+    finally:
+        if pending_deliveries.finish(delivery_id, succeeded):
+            complete_delivery(delivery_id)
+
+
+_webhook_pool: Optional[WorkerPool] = None
+_webhook_pool_lock = threading.Lock()
+
+
+def get_webhook_pool() -> WorkerPool:
+    """
+    Get the process-wide pool that handles webhook events.
+
+    Returns:
+        WorkerPool: The pool, configured from CHATBRIDGE_WEBHOOK_* settings
+    """
+    global _webhook_pool
+    if _webhook_pool is None:
+        with _webhook_pool_lock:
+            if _webhook_pool is None:
+                pool = WorkerPool(
+                    handle_webhook_share,
+                    workers=settings.CHATBRIDGE_WEBHOOK_WORKERS,
+                    max_queue_size=settings.CHATBRIDGE_WEBHOOK_QUEUE_SIZE,
+                    name='webhook',
+                )
+                atexit.register(pool.shutdown, settings.CHATBRIDGE_WEBHOOK_DRAIN_TIMEOUT)
+                _webhook_pool = pool
+    return _webhook_pool
+
+
+def enqueue_webhook_events(events: List[dict]) -> bool:
+    """
+    Write parsed webhook events to the inbox and queue them, keeping
+    per-conversation order.
+
+    Args:
+        events (List[dict]): Message events built by parse_webhook_events
+
+    Returns:
+        bool: True if the events were persisted and queued, False if they
+        could not be persisted or a queue is full
+    """
+    delivery_id = persist_delivery(events)
+    if delivery_id is None:
+        return False
+    pool = get_webhook_pool()
+    items = [((event['firm_phone_number'], event['wa_id']), (delivery_id, event)) for event in events]
+    pending_deliveries.expect(delivery_id, pool.share_count(key for key, _ in items))
+    if not pool.submit_batch(items):
+        # The provider redelivers it
+        pending_deliveries.forget(delivery_id)
+        complete_delivery(delivery_id)
+        return False
+    return True
@@ -0,0 +1,262 @@
+from pathlib import Path
+from typing import List, Optional
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import MessageLog
+
+logger = logging.getLogger(__name__)
+
+SPOOL_FIELDS = [
+    'direction', 'phone_number', 'message', 'timestamp', 'status',
+    'whatsapp_business_account_id', 'firm_phone_number', 'user_name', 'message_id',
+]
+
+
+def row_to_spool(row: MessageLog) -> dict:
+    data = {field: getattr(row, field) for field in SPOOL_FIELDS}
+    data['timestamp'] = row.timestamp.isoformat()
+    return data
+
+
+def row_from_spool(data: dict) -> MessageLog:
+    data = dict(data)
+    data['timestamp'] = parse_datetime(data['timestamp'])
+    return MessageLog(**data)
+
+
+class MessageLogWriter:
+    """
+    Buffers MessageLog rows and inserts them with bulk_create.
+
+    A background thread flushes the buffer once it holds max_batch_size rows
+    or its oldest row is max_age seconds old. Rows that cannot be inserted,
+    including at shutdown, are appended to an NDJSON spool file and replayed
+    into the database when the next writer starts.
+    """
+
+    def __init__(self, max_batch_size: int, max_age: float, spool_path: Path):
+        self.max_batch_size = max_batch_size
+        self.max_age = max_age
+        self.spool_path = Path(spool_path)
+        self._buffer: List[MessageLog] = []
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.stats = {
+            'flushes': 0,
+            'rows_written': 0,
+            'rows_spooled': 0,
+            'last_batch_size': 0,
+            'last_flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+        }
+
+    def add(self, **fields) -> None:
+        """
+        Buffer a MessageLog row.
+
+        Args:
+            **fields: MessageLog field values; timestamp defaults to now
+        """
+        fields.setdefault('timestamp', timezone.now())
+        row = MessageLog(**fields)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._buffer.append(row)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                size = len(self._buffer)
+        if closed:
+            # Rows logged while shutting down are spooled for the next
+            # writer; add can be called from the event loop, where the
+            # synchronous ORM cannot run
+            self._spool([row])
+            return
+        self._ensure_started()
+        if size >= self.max_batch_size:
+            self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='messagelog-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            self.replay_spool()
+        except Exception:
+            logger.exception('Error replaying MessageLog spool')
+        while not self._closed:
+            self._wakeup.wait(self.max_age)
+            self._wakeup.clear()
+            with self._lock:
+                due = self._buffer and (
+                    len(self._buffer) >= self.max_batch_size
+                    or time.monotonic() - self._oldest >= self.max_age
+                )
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    # e.g. the spool could not be written; keep the thread
+                    # alive so later rows are still flushed
+                    logger.exception('Error flushing MessageLog rows')
+                finally:
+                    close_old_connections()
+
+    def flush(self) -> int:
+        """
+        Insert all buffered rows, spooling them to disk if the insert fails.
+
+        Returns:
+            int: The number of rows inserted
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+                self._oldest = None
+            if not rows:
+                return 0
+            started = time.perf_counter()
+            try:
+                MessageLog.objects.bulk_create(rows, batch_size=self.max_batch_size)
+            except Exception:
+                logger.exception('Error writing %d MessageLog rows, spooling to %s', len(rows), self.spool_path)
+                self._spool(rows)
+                return 0
+            elapsed = time.perf_counter() - started
+            self.stats['flushes'] += 1
+            self.stats['rows_written'] += len(rows)
+            self.stats['last_batch_size'] = len(rows)
+            self.stats['last_flush_seconds'] = elapsed
+            self.stats['max_flush_seconds'] = max(self.stats['max_flush_seconds'], elapsed)
+            logger.debug('Flushed %d MessageLog rows in %.1fms', len(rows), elapsed * 1000)
+            return len(rows)
+
+    def _spool(self, rows: List[MessageLog]) -> None:
+        self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.spool_path, 'a', encoding='utf-8') as spool:
+            for row in rows:
+                spool.write(json.dumps(row_to_spool(row)) + '\n')
+            spool.flush()
+            os.fsync(spool.fileno())
+        self.stats['rows_spooled'] += len(rows)
+
+    def replay_spool(self) -> int:
+        """
+        Insert rows left in the spool file by earlier failed flushes.
+
+        The spool is renamed before it is read, so concurrent writers never
+        replay the same rows twice. If the insert fails the rows go back to
+        the spool; the renamed file is only removed once they are either
+        inserted or spooled again.
+
+        Returns:
+            int: The number of rows inserted
+        """
+        if not self.spool_path.exists():
+            return 0
+        replaying = self.spool_path.with_name(f'{self.spool_path.name}.{os.getpid()}.replay')
+        try:
+            os.replace(self.spool_path, replaying)
+        except FileNotFoundError:
+            return 0
+        with open(replaying, encoding='utf-8') as spool:
+            rows = [row_from_spool(json.loads(line)) for line in spool if line.strip()]
+        # A failed batch may have been partly inserted; skip inbound rows
+        # that made it in
+        message_ids = [row.message_id for row in rows if row.message_id]
+        if message_ids:
+            logged = set(MessageLog.objects.filter(message_id__in=message_ids).values_list('message_id', flat=True))
+            rows = [row for row in rows if not row.message_id or row.message_id not in logged]
+        try:
+            MessageLog.objects.bulk_create(rows, batch_size=self.max_batch_size)
+        except Exception:
+            # Keep the replay file unless the rows made it back to the spool
+            self._spool(rows)
+            replaying.unlink()
+            raise
+        replaying.unlink()
+        logger.info('Replayed %d MessageLog rows from %s', len(rows), self.spool_path)
+        return len(rows)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            buffered = len(self._buffer)
+        return dict(self.stats, buffered=buffered)
+
+    def close(self) -> None:
+        """Flush the buffer and stop the background thread."""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+
+_writer: Optional[MessageLogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_message_log_writer() -> MessageLogWriter:
+    """
+    Get the process-wide MessageLog writer configured from settings.
+
+    Returns:
+        MessageLogWriter: The shared writer
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = MessageLogWriter(
+                    max_batch_size=settings.CHATBRIDGE_MESSAGELOG_BATCH_SIZE,
+                    max_age=settings.CHATBRIDGE_MESSAGELOG_MAX_AGE,
+                    spool_path=settings.CHATBRIDGE_MESSAGELOG_SPOOL,
+                )
+                atexit.register(writer.close)
+                _writer = writer
+    return _writer
+
+
+def log_message(**fields) -> None:
+    """
+    Record a MessageLog row through the shared buffered writer.
+
+    Args:
+        **fields: MessageLog field values
+    """
+    if settings.CHATBRIDGE_MESSAGELOG_BATCH_SIZE <= 1:
+        MessageLog.objects.create(**fields)
+        return
+    get_message_log_writer().add(**fields)
+
+
+async def alog_message(**fields) -> None:
+    """
+    Async version of log_message. Buffering never blocks, so only the
+    unbuffered configuration touches the database.
+
+    Args:
+        **fields: MessageLog field values
+    """
+    if settings.CHATBRIDGE_MESSAGELOG_BATCH_SIZE <= 1:
+        await MessageLog.objects.acreate(**fields)
+        return
+    get_message_log_writer().add(**fields)
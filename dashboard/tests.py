@@ -1,3 +1,108 @@
+from unittest import mock
+import datetime
+import json
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from firms.models import ChatUser, Firm
+
+
+class EditFirmFlowTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name='Flow firm', phone_number='200', first_step='start')
+        self.client.force_login(User.objects.create_user('staff', password='secret'))
+        self.url = reverse('dashboard_edit_firm_flow', args=[self.firm.pk])
+
+    def post_flow(self, flow):
+        return self.client.post(self.url, {'flow_json': json.dumps(flow)})
+
+    def test_saves_valid_flow(self):
+        flow = {
+            'steps': [
+                {'id': 'start', 'message': 'Hi', 'next': [{'pattern': '^1$', 'next': 'one'}]},
+                {'id': 'one', 'message': 'One', 'next': 'start'},
+            ]
+        }
+        response = self.post_flow(flow)
+        self.assertRedirects(response, reverse('dashboard_firm_list'), fetch_redirect_response=False)
+        self.firm.refresh_from_db()
+        self.assertEqual(self.firm.flow, flow)
+        self.assertEqual(self.firm.flow_version, 1)
+
+    def test_rejects_missing_step(self):
+        response = self.post_flow({'steps': [{'id': 'start', 'message': 'Hi', 'next': 'gone'}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('missing step', response.context['error'])
+        self.firm.refresh_from_db()
+        self.assertEqual(self.firm.flow_version, 0)
+
+    def test_rejects_slow_pattern(self):
+        flow = {'steps': [{'id': 'start', 'message': 'Hi', 'next': [{'pattern': '^(a+)+$', 'next': 'start'}]}]}
+        with self.settings(FLOW_PATTERN_TIME_BUDGET=0.2):
+            response = self.post_flow(flow)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('matching budget', response.context['error'])
+        self.firm.refresh_from_db()
+        self.assertEqual(self.firm.flow_version, 0)
+
+    def test_rejects_invalid_json(self):
+        response = self.client.post(self.url, {'flow_json': '{"steps": ['})
+        self.assertIn('Invalid JSON syntax', response.context['error'])
+
+    def test_requires_login(self):
+        self.client.logout()
+        response = self.post_flow({'steps': []})
+        self.assertEqual(response.status_code, 302)
+        self.firm.refresh_from_db()
+        self.assertEqual(self.firm.flow_version, 0)
+
+
+@mock.patch('dashboard.views.FIRMS_PER_PAGE', 3)
+class FirmListTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', password='secret'))
+        self.now = timezone.now()
+        for index in range(7):
+            firm = Firm.objects.create(name=f'Firm {index}', phone_number=f'30{index}', first_step='start')
+            ChatUser.objects.bulk_create([
+                ChatUser(
+                    firm=firm, phone_number=f'u{user}', profile_name='', current_step='start',
+                    last_active_at=self.now - datetime.timedelta(hours=user),
+                )
+                for user in range(index)
+            ])
+
+    def get(self, **params):
+        response = self.client.get(reverse('dashboard_firm_list'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def rows(self, response):
+        return [(firm.name, firm.user_count, firm.last_active_at) for firm in response.context['firms']]
+
+    def test_query_count_does_not_depend_on_the_firms_shown(self):
+        # Session, user, firm count, the page of firms and one aggregate for their users
+        with self.assertNumQueries(5):
+            response = self.get()
+        self.assertEqual(self.rows(response), [
+            ('Firm 0', 0, None),
+            ('Firm 1', 1, self.now),
+            ('Firm 2', 2, self.now),
+        ])
+        with mock.patch('dashboard.views.FIRMS_PER_PAGE', 7), self.assertNumQueries(5):
+            self.assertEqual(len(self.rows(self.get())), 7)
+
+    def test_pages(self):
+        response = self.get(page=3)
+        self.assertEqual(self.rows(response), [('Firm 6', 6, self.now)])
+        self.assertContains(response, 'Page 3 of 3 (7 firms)')
+        # Out of range pages show the last one
+        self.assertEqual(self.rows(self.get(page=9)), self.rows(response))
 
-# Create your tests here.
+    def test_search(self):
+        response = self.get(q='304')
+        self.assertEqual([name for name, _, _ in self.rows(response)], ['Firm 4'])
+        self.assertNotContains(response, 'Page ')
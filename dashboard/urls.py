@@ -8,4 +8,5 @@ urlpatterns = [
     path('logout/', LogoutView.as_view(next_page='dashboard_login'), name='dashboard_logout'),
     path('firms/', views.firm_list, name='dashboard_firm_list'),
     path('firms/<int:firm_id>/flow/', views.edit_firm_flow, name='dashboard_edit_firm_flow'),
+    path('firms/<int:firm_id>/stats/', views.firm_stats, name='dashboard_firm_stats'),
 ] 
\ No newline at end of file
@@ -1,7 +1,16 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from firms.models import Firm
+from firms.models import ChatUser, Firm
+from firms.flow import analyze_flow, flow_patterns, get_compiled_flow, invalidate_compiled_flow, set_flow
+from firms.patterns import find_slow_patterns
+from firms.rollups import HOURLY_FIELDS, hourly_stats, step_funnel
+from django.conf import settings
+from django.utils import timezone
+import datetime
+from django.contrib import messages
 from django.http import HttpResponseRedirect
 from django.urls import reverse
+from django.core.paginator import Paginator
+from django.db.models import Count, Max, Q
 import json as pyjson
 from django.contrib.auth.decorators import login_required
 from jsonschema import validate, ValidationError
@@ -46,10 +55,28 @@ FLOW_SCHEMA = {
 }
 
 
+FIRMS_PER_PAGE = 50
+
 @login_required
 def firm_list(request):
-    firms = Firm.objects.all()
-    return render(request, 'dashboard/firm_list.html', {'firms': firms})
+    query = request.GET.get('q', '').strip()
+    # The flow JSON is not shown here; leave it (and its artifact) in the database
+    firms = Firm.objects.defer('flow', 'compiled_flow').order_by('name')
+    if query:
+        firms = firms.filter(Q(name__icontains=query) | Q(phone_number__icontains=query))
+    page = Paginator(firms, FIRMS_PER_PAGE).get_page(request.GET.get('page'))
+    # One aggregated query for the firms on this page
+    stats = {
+        row['firm_id']: row
+        for row in ChatUser.objects.filter(firm_id__in=[firm.id for firm in page])
+        .values('firm_id')
+        .annotate(user_count=Count('id'), last_active_at=Max('last_active_at'))
+    }
+    for firm in page:
+        row = stats.get(firm.id, {})
+        firm.user_count = row.get('user_count', 0)
+        firm.last_active_at = row.get('last_active_at')
+    return render(request, 'dashboard/firm_list.html', {'firms': page, 'page': page, 'query': query})
 
 @login_required
 def edit_firm_flow(request, firm_id):
@@ -62,8 +89,26 @@ def edit_firm_flow(request, firm_id):
             flow_data = pyjson.loads(json_text)
             # Validate JSON against schema
             validate(instance=flow_data, schema=FLOW_SCHEMA)
-            firm.flow = flow_data
+            # Resolve step references before the flow goes live
+            report = analyze_flow(flow_data, firm.first_step)
+            if report.errors:
+                raise ValidationError('; '.join(report.errors))
+            # Reject patterns that backtrack catastrophically on long inputs
+            slow = find_slow_patterns(
+                flow_patterns(flow_data), settings.FLOW_PATTERN_TIME_BUDGET, settings.FLOW_MAX_INPUT_LENGTH
+            )
+            if slow:
+                raise ValidationError(
+                    f"patterns exceed the {settings.FLOW_PATTERN_TIME_BUDGET}s matching budget: "
+                    + ', '.join(repr(pattern) for pattern in slow)
+                )
+            set_flow(firm, flow_data)
             firm.save()
+            for warning in report.warnings:
+                messages.warning(request, f"{firm.name}: {warning}")
+            # Rebuild the compiled flow so this worker routes on the new version
+            invalidate_compiled_flow(firm.pk)
+            get_compiled_flow(firm)
             return HttpResponseRedirect(reverse('dashboard_firm_list'))
         except pyjson.JSONDecodeError as e:
             error = f"Invalid JSON syntax: {e}"
@@ -72,6 +117,39 @@ def edit_firm_flow(request, firm_id):
     flow_json = pyjson.dumps(firm.flow, indent=2) if firm.flow else pyjson.dumps({"steps": []}, indent=2)
     return render(request, 'dashboard/edit_firm_flow.html', {'firm': firm, 'flow_json': flow_json, 'error': error})
 
+# Periods offered on the stats page, in days
+STATS_PERIODS = [1, 7, 30]
+
+@login_required
+def firm_stats(request, firm_id):
+    firm = get_object_or_404(Firm, id=firm_id)
+    try:
+        days = int(request.GET.get('days', 7))
+    except ValueError:
+        days = 7
+    if days not in STATS_PERIODS:
+        days = 7
+    since = timezone.now() - datetime.timedelta(days=days)
+    # Only the rollup tables are read here, never MessageLog or ChatUser
+    hours = hourly_stats(firm.pk, since)
+    totals = {field: sum(hour[field] for hour in hours) for field in HOURLY_FIELDS}
+    peak = max((hour['messages_in'] for hour in hours), default=0)
+    for hour in hours:
+        hour['width'] = round(100 * hour['messages_in'] / peak) if peak else 0
+    funnel = step_funnel(firm, since, totals['new_users'])
+    top = max((step['entered'] for step in funnel), default=0)
+    for step in funnel:
+        step['width'] = round(100 * step['entered'] / top) if top else 0
+        step['drop_percent'] = round(100 * step['drop_rate'], 1)
+    return render(request, 'dashboard/firm_stats.html', {
+        'firm': firm,
+        'days': days,
+        'periods': STATS_PERIODS,
+        'hours': hours,
+        'totals': totals,
+        'funnel': funnel,
+    })
+
 def dashboard_root(request):
     if request.user.is_authenticated:
         return redirect('dashboard_firm_list')
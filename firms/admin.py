@@ -1,6 +1,48 @@
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from .flow import analyze_flow, flow_patterns, set_flow
 from .models import Firm, ChatUser
+from .patterns import find_slow_patterns
 
 # Register your models here.
-admin.site.register(Firm)
+
+class FirmAdminForm(forms.ModelForm):
+    class Meta:
+        model = Firm
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if {'flow', 'first_step'} & set(self.changed_data) and 'flow' in cleaned_data:
+            if cleaned_data['flow'] is not None and not isinstance(cleaned_data['flow'], dict):
+                self.add_error('flow', 'The flow must be a JSON object')
+                return cleaned_data
+            report = analyze_flow(cleaned_data['flow'], cleaned_data.get('first_step', ''))
+            if report.errors:
+                self.add_error('flow', report.errors)
+                return cleaned_data
+            # Reject patterns that backtrack catastrophically on long inputs
+            slow = find_slow_patterns(
+                flow_patterns(cleaned_data['flow']), settings.FLOW_PATTERN_TIME_BUDGET, settings.FLOW_MAX_INPUT_LENGTH
+            )
+            if slow:
+                self.add_error(
+                    'flow',
+                    f"patterns exceed the {settings.FLOW_PATTERN_TIME_BUDGET}s matching budget: "
+                    + ', '.join(repr(pattern) for pattern in slow),
+                )
+        return cleaned_data
+
+
+@admin.register(Firm)
+class FirmAdmin(admin.ModelAdmin):
+    form = FirmAdminForm
+
+    def save_model(self, request, obj, form, change):
+        # Compiled flows are cached per flow_version, so edits must bump it
+        if 'flow' in form.changed_data or obj.compiled_flow is None:
+            set_flow(obj, obj.flow)
+        super().save_model(request, obj, form, change)
+
 admin.site.register(ChatUser)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FirmsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'firms'
+
+    def ready(self):
+        from . import signals  # noqa: F401
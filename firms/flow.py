@@ -0,0 +1,376 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import threading
+
+from django.conf import settings
+
+from .models import Firm
+from .patterns import StepMatcher, shadows
+
+# Bumped when the layout of Firm.compiled_flow changes
+ARTIFACT_FORMAT = 1
+
+
+class Route(NamedTuple):
+    pattern: str
+    next_step: str
+    next_message: str
+
+
+class CompiledStep(NamedTuple):
+    id: str
+    message: str
+    next_step: Optional[str]
+    next_message: str
+    routes: Tuple[Route, ...]
+    matcher: Optional[StepMatcher]
+
+
+class CompiledFlow:
+    """
+    A firm's flow pre-processed for routing.
+
+    Steps are indexed by id, each step's route patterns are combined into
+    a single StepMatcher and the message of every referenced step is
+    resolved up front, so a routing decision is a dict lookup followed by
+    one matcher pass.
+    """
+
+    def __init__(self, steps: Dict[str, CompiledStep]):
+        self.steps = steps
+
+    def get_step(self, step_id: str) -> Optional[CompiledStep]:
+        return self.steps.get(step_id)
+
+    def get_message(self, step_id: str) -> str:
+        step = self.steps.get(step_id)
+        return step.message if step else ''
+
+    def route(self, current_step: str, user_input: str) -> Tuple[Optional[str], str]:
+        """
+        Resolve the next step for the given input.
+
+        Args:
+            current_step (str): The current step ID
+            user_input (str): The user's input message
+
+        Returns:
+            Tuple[Optional[str], str]: A tuple containing (next_step_id, message_to_send)
+        """
+        step = self.steps.get(current_step)
+        if step is None:
+            return None, "Invalid step in conversation flow."
+
+        if step.next_step is not None:
+            return step.next_step, step.next_message
+
+        if step.matcher is not None:
+            # Bound the work a single message can cause
+            text = user_input.strip()[:settings.FLOW_MAX_INPUT_LENGTH]
+            index = step.matcher.match(text)
+            if index is not None:
+                route = step.routes[index]
+                return route.next_step, route.next_message
+
+        return None, "No valid next step found in the flow."
+
+
+def compile_step(step_id: str, message: str, next_step: Optional[str], next_message: str, routes: List[Route]) -> CompiledStep:
+    return CompiledStep(
+        id=step_id,
+        message=message,
+        next_step=next_step,
+        next_message=next_message,
+        routes=tuple(routes),
+        matcher=StepMatcher([route.pattern for route in routes]) if routes else None,
+    )
+
+
+def first_definitions(flow: dict) -> Dict[str, dict]:
+    # The first definition of a step id wins, as with the linear lookup
+    raw_steps: Dict[str, dict] = {}
+    for step in flow['steps']:
+        raw_steps.setdefault(step['id'], step)
+    return raw_steps
+
+
+def compile_flow(flow: dict) -> Optional[CompiledFlow]:
+    """
+    Compile a flow definition into a CompiledFlow.
+
+    Args:
+        flow (dict): The flow configuration
+
+    Returns:
+        Optional[CompiledFlow]: The compiled flow, or None if no flow is configured
+    """
+    if not flow or 'steps' not in flow:
+        return None
+
+    raw_steps = first_definitions(flow)
+
+    def message_for(step_id) -> str:
+        step = raw_steps.get(step_id)
+        return step.get('message', '') if step else ''
+
+    steps: Dict[str, CompiledStep] = {}
+    for step_id, step in raw_steps.items():
+        next_step = step.get('next')
+        routes: List[Route] = []
+        if isinstance(next_step, list):
+            for pattern_data in next_step:
+                target = pattern_data.get('next')
+                routes.append(Route(pattern_data.get('pattern', ''), target, message_for(target)))
+        direct = next_step if isinstance(next_step, str) else None
+        steps[step_id] = compile_step(
+            step_id,
+            step.get('message', ''),
+            direct,
+            message_for(direct) if direct is not None else '',
+            routes,
+        )
+    return CompiledFlow(steps)
+
+
+def flow_artifact(flow: dict, flow_version: int) -> dict:
+    """
+    Build the pre-resolved form of a flow stored in Firm.compiled_flow.
+
+    Step references and their messages are resolved, so workers only have
+    to build the pattern matchers when loading it.
+
+    Args:
+        flow (dict): The flow configuration
+        flow_version (int): The flow_version the artifact belongs to
+
+    Returns:
+        dict: The JSON-serialisable artifact
+    """
+    compiled = compile_flow(flow)
+    steps = None
+    if compiled is not None:
+        steps = {
+            step.id: {
+                'message': step.message,
+                'next': step.next_step,
+                'next_message': step.next_message,
+                'routes': [list(route) for route in step.routes],
+            }
+            for step in compiled.steps.values()
+        }
+    return {'format': ARTIFACT_FORMAT, 'version': flow_version, 'steps': steps}
+
+
+def load_artifact(artifact: Optional[dict], flow_version: int) -> Tuple[bool, Optional[CompiledFlow]]:
+    """
+    Load a CompiledFlow from a stored artifact.
+
+    Args:
+        artifact (Optional[dict]): The content of Firm.compiled_flow
+        flow_version (int): The firm's current flow_version
+
+    Returns:
+        Tuple[bool, Optional[CompiledFlow]]: (usable, compiled flow); the
+        artifact is unusable if missing, stale or in an older format
+    """
+    if (
+        not artifact
+        or artifact.get('format') != ARTIFACT_FORMAT
+        or artifact.get('version') != flow_version
+    ):
+        return False, None
+    if artifact['steps'] is None:
+        return True, None
+    steps = {
+        step_id: compile_step(
+            step_id,
+            step['message'],
+            step['next'],
+            step['next_message'],
+            [Route(*route) for route in step['routes']],
+        )
+        for step_id, step in artifact['steps'].items()
+    }
+    return True, CompiledFlow(steps)
+
+
+class FlowReport(NamedTuple):
+    errors: List[str]
+    warnings: List[str]
+
+
+def analyze_flow(flow: dict, first_step: str) -> FlowReport:
+    """
+    Check a flow definition before it goes live.
+
+    References to missing steps are errors. Steps that cannot be reached
+    from the first step, and routes that can never match because an earlier
+    route in the same step matches every input they would, are warnings.
+
+    Args:
+        flow (dict): The flow configuration
+        first_step (str): The step new conversations start at
+
+    Returns:
+        FlowReport: The errors and warnings found
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+    if not flow or not flow.get('steps'):
+        return FlowReport(errors, warnings)
+
+    seen = set()
+    for step in flow['steps']:
+        if step['id'] in seen:
+            warnings.append(f"Step '{step['id']}' is defined more than once; only the first definition is used.")
+        seen.add(step['id'])
+    raw_steps = first_definitions(flow)
+
+    entry = first_step or 'start'
+    if entry not in raw_steps:
+        errors.append(f"First step '{entry}' does not exist.")
+
+    edges: Dict[str, List[str]] = {}
+    for step_id, step in raw_steps.items():
+        next_step = step.get('next')
+        targets = []
+        if isinstance(next_step, str):
+            targets.append(next_step)
+        elif isinstance(next_step, list):
+            patterns = [pattern_data.get('pattern', '') for pattern_data in next_step]
+            for index, pattern_data in enumerate(next_step):
+                target = pattern_data.get('next')
+                shadowed_by = next((p for p in patterns[:index] if shadows(p, patterns[index])), None)
+                if shadowed_by is not None:
+                    warnings.append(
+                        f"Step '{step_id}': route {patterns[index]!r} -> '{target}' can never match, "
+                        f"{shadowed_by!r} matches first."
+                    )
+                else:
+                    targets.append(target)
+                if target not in raw_steps:
+                    errors.append(f"Step '{step_id}': route {patterns[index]!r} points to missing step '{target}'.")
+        if isinstance(next_step, str) and next_step not in raw_steps:
+            errors.append(f"Step '{step_id}': next points to missing step '{next_step}'.")
+        edges[step_id] = [target for target in targets if target in raw_steps]
+
+    if entry in raw_steps:
+        reachable = {entry}
+        pending = [entry]
+        while pending:
+            for target in edges[pending.pop()]:
+                if target not in reachable:
+                    reachable.add(target)
+                    pending.append(target)
+        for step_id in raw_steps:
+            if step_id not in reachable:
+                warnings.append(f"Step '{step_id}' cannot be reached from '{entry}'.")
+
+    return FlowReport(errors, warnings)
+
+
+def set_flow(firm: Firm, flow: dict) -> None:
+    """
+    Replace a firm's flow, bumping its version and storing the compiled
+    artifact next to it. The caller saves the firm.
+
+    Args:
+        firm (Firm): The firm object
+        flow (dict): The new flow configuration
+    """
+    firm.flow = flow
+    firm.flow_version += 1
+    firm.compiled_flow = flow_artifact(flow, firm.flow_version)
+
+
+# firm id -> (flow_version, compiled flow)
+_compiled_flows: Dict[int, Tuple[int, Optional[CompiledFlow]]] = {}
+_compiled_flows_lock = threading.Lock()
+
+
+def get_compiled_flow(firm: Firm) -> Optional[CompiledFlow]:
+    """
+    Get the compiled flow for a firm, loading it on first use.
+
+    Compiled flows are cached per process, keyed on the firm id and its
+    flow_version, so a flow saved from another process is picked up as
+    soon as a firm row with the new version is seen. They are loaded from
+    the stored artifact, and only compiled from the flow itself when the
+    artifact is missing or stale.
+
+    Args:
+        firm (Firm): The firm object
+
+    Returns:
+        Optional[CompiledFlow]: The compiled flow, or None if no flow is configured
+    """
+    cached = _compiled_flows.get(firm.pk)
+    if cached is not None and cached[0] == firm.flow_version:
+        return cached[1]
+    usable, compiled = load_artifact(firm.compiled_flow, firm.flow_version)
+    if not usable:
+        compiled = compile_flow(firm.flow)
+    with _compiled_flows_lock:
+        _compiled_flows[firm.pk] = (firm.flow_version, compiled)
+    return compiled
+
+
+async def aget_compiled_flow(firm: Firm) -> Optional[CompiledFlow]:
+    """
+    Async version of get_compiled_flow.
+
+    The artifact and flow are fetched with the async ORM when needed,
+    since firms from the routing cache have them deferred.
+
+    Args:
+        firm (Firm): The firm object
+
+    Returns:
+        Optional[CompiledFlow]: The compiled flow, or None if no flow is configured
+    """
+    cached = _compiled_flows.get(firm.pk)
+    if cached is not None and cached[0] == firm.flow_version:
+        return cached[1]
+    deferred = firm.get_deferred_fields()
+    if 'compiled_flow' in deferred:
+        artifact = await Firm.objects.filter(pk=firm.pk).values_list('compiled_flow', flat=True).aget()
+    else:
+        artifact = firm.compiled_flow
+    usable, compiled = load_artifact(artifact, firm.flow_version)
+    if not usable:
+        if 'flow' in deferred:
+            flow = await Firm.objects.filter(pk=firm.pk).values_list('flow', flat=True).aget()
+        else:
+            flow = firm.flow
+        compiled = compile_flow(flow)
+    with _compiled_flows_lock:
+        _compiled_flows[firm.pk] = (firm.flow_version, compiled)
+    return compiled
+
+
+def invalidate_compiled_flow(firm_id: int) -> None:
+    """
+    Drop the cached compiled flow for a firm.
+
+    Args:
+        firm_id (int): The firm's primary key
+    """
+    with _compiled_flows_lock:
+        _compiled_flows.pop(firm_id, None)
+
+
+def flow_patterns(flow: dict) -> List[str]:
+    """
+    Collect every route pattern in a flow definition.
+
+    Args:
+        flow (dict): The flow configuration
+
+    Returns:
+        List[str]: The patterns, in order of appearance
+    """
+    patterns = []
+    for step in (flow or {}).get('steps', []):
+        next_step = step.get('next')
+        if isinstance(next_step, list):
+            patterns.extend(pattern_data.get('pattern', '') for pattern_data in next_step)
+    return patterns
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0003_firm_created_at_firm_first_step'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firm',
+            name='flow_version',
+            field=models.PositiveIntegerField(default=0, help_text='Bumped every time the flow is saved'),
+        ),
+    ]
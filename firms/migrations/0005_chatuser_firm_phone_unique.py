@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:45
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_chat_users(apps, schema_editor):
+    """
+    Keep only the earliest ChatUser per (firm, phone_number). Duplicates
+    could not be used anyway: get_or_create raised MultipleObjectsReturned.
+    """
+    ChatUser = apps.get_model('firms', 'ChatUser')
+    duplicates = (
+        ChatUser.objects.values('firm_id', 'phone_number')
+        .annotate(rows=Count('id'), first_id=Min('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        ChatUser.objects.filter(
+            firm_id=duplicate['firm_id'], phone_number=duplicate['phone_number']
+        ).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0004_firm_flow_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_chat_users, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatuser',
+            constraint=models.UniqueConstraint(fields=('firm', 'phone_number'), name='chatuser_firm_phone_unique'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0005_chatuser_firm_phone_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firm',
+            name='compiled_flow',
+            field=models.JSONField(blank=True, editable=False, help_text='Pre-resolved flow built when the flow is saved', null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0006_firm_compiled_flow'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatuser',
+            name='last_active_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='FirmHourlyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('messages_in', models.PositiveIntegerField(default=0)),
+                ('messages_out', models.PositiveIntegerField(default=0)),
+                ('new_users', models.PositiveIntegerField(default=0)),
+                ('active_users', models.PositiveIntegerField(default=0)),
+                ('firm', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_stats', to='firms.firm')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('firm', 'hour'), name='firmhourlystats_firm_hour_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StepTransitionStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('from_step', models.CharField(max_length=100)),
+                ('to_step', models.CharField(max_length=100)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('firm', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='step_transitions', to='firms.firm')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('firm', 'day', 'from_step', 'to_step'), name='steptransitionstats_unique')],
+            },
+        ),
+    ]
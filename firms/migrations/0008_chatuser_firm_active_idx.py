@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0007_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatuser',
+            index=models.Index(fields=['firm', 'last_active_at'], name='chatuser_firm_active_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0008_chatuser_firm_active_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatuser',
+            name='state_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
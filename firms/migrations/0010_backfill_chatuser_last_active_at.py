@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:05
+
+from django.db import migrations
+from django.db.models import F
+
+
+def backfill_last_active_at(apps, schema_editor):
+    """
+    Set last_active_at for users created before it existed. Rollups count a
+    sender whose last_active_at is unset as a new user, which these are not.
+    """
+    ChatUser = apps.get_model('firms', 'ChatUser')
+    ChatUser.objects.filter(last_active_at__isnull=True).update(last_active_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('firms', '0009_chatuser_state_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_last_active_at, migrations.RunPython.noop),
+    ]
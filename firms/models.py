@@ -7,6 +7,8 @@ class Firm(models.Model):
     phone_number = models.CharField(max_length=20, blank=True)
     status = models.BooleanField(default=True, help_text='Is the firm active?')
     flow = models.JSONField(default=dict, blank=True)
+    flow_version = models.PositiveIntegerField(default=0, help_text='Bumped every time the flow is saved')
+    compiled_flow = models.JSONField(null=True, blank=True, editable=False, help_text='Pre-resolved flow built when the flow is saved')
     created_at = models.DateTimeField(auto_now_add=True)
     first_step = models.CharField(max_length=100, blank=True)
 
@@ -20,6 +22,57 @@ class ChatUser(models.Model):
     last_message_received = models.TextField(blank=True, null=True)
     current_step = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Last inbound message, used to count each user once per hour in FirmHourlyStats
+    last_active_at = models.DateTimeField(blank=True, null=True)
+    # Bumped by every write of the row, so a process saving from a stale
+    # cached copy finds out (see firms.state)
+    state_version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['firm', 'phone_number'], name='chatuser_firm_phone_unique'),
+        ]
+        indexes = [
+            # Per-firm user count and last activity for the dashboard firm list
+            models.Index(fields=['firm', 'last_active_at'], name='chatuser_firm_active_idx'),
+        ]
 
     def __str__(self):
         return f"{self.phone_number} - {self.firm.name}"
+
+
+class FirmHourlyStats(models.Model):
+    """Per-firm message volume and users for one hour, kept up to date by firms.rollups."""
+    firm = models.ForeignKey(Firm, on_delete=models.CASCADE, related_name='hourly_stats')
+    hour = models.DateTimeField()
+    messages_in = models.PositiveIntegerField(default=0)
+    messages_out = models.PositiveIntegerField(default=0)
+    new_users = models.PositiveIntegerField(default=0)
+    active_users = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['firm', 'hour'], name='firmhourlystats_firm_hour_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.firm_id} - {self.hour}"
+
+
+class StepTransitionStats(models.Model):
+    """How often conversations of a firm moved between two steps on one day."""
+    firm = models.ForeignKey(Firm, on_delete=models.CASCADE, related_name='step_transitions')
+    day = models.DateField()
+    from_step = models.CharField(max_length=100)
+    to_step = models.CharField(max_length=100)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['firm', 'day', 'from_step', 'to_step'], name='steptransitionstats_unique',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.firm_id} - {self.day} - {self.from_step} -> {self.to_step}"
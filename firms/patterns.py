@@ -0,0 +1,238 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+import multiprocessing
+import re
+
+# Characters with a special meaning in Python regular expressions
+REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+_LEADING_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+
+def literal_form(pattern: str) -> Optional[Tuple[str, bool]]:
+    """
+    Describe a pattern that matches a fixed string.
+
+    re.match anchors at the start, so a plain literal matches any input
+    starting with it, and a literal ending in $ matches only itself (inputs
+    are stripped, so they never end in a newline).
+
+    Args:
+        pattern (str): The route pattern
+
+    Returns:
+        Optional[Tuple[str, bool]]: (literal, exact) or None if the pattern is a real regex
+    """
+    body = pattern[1:] if pattern.startswith('^') else pattern
+    exact = body.endswith('$') and not body.endswith('\\$')
+    if exact:
+        body = body[:-1]
+    if any(char in REGEX_METACHARACTERS for char in body):
+        return None
+    return body, exact
+
+
+def scoped(pattern: str) -> str:
+    # Leading global flags are only allowed at the very start of a pattern,
+    # so turn them into a scoped group before combining patterns
+    match = _LEADING_FLAGS.match(pattern)
+    if match:
+        return f'(?{match.group(1)}:{pattern[match.end():]})'
+    return pattern
+
+
+class StepMatcher:
+    """
+    Finds the first of a step's route patterns that matches an input.
+
+    Literal patterns are answered from hash lookups, the remaining patterns
+    are combined into a single alternation so one regex pass finds the
+    first match, and only patterns that cannot be combined safely (those
+    with capturing groups, which may be back-referenced) are tried one by
+    one. The result is the same as trying re.match on each pattern in order,
+    with invalid patterns compared for equality.
+    """
+
+    def __init__(self, patterns: Sequence[str]):
+        self.exact: Dict[str, int] = {}
+        self.prefixes: Dict[int, Dict[str, int]] = {}
+        self.sequential: List[Tuple[int, re.Pattern]] = []
+        combinable: List[Tuple[int, str]] = []
+        for index, pattern in enumerate(patterns):
+            literal = literal_form(pattern)
+            if literal is not None:
+                text, exact = literal
+                table = self.exact if exact else self.prefixes.setdefault(len(text), {})
+                table.setdefault(text, index)
+                continue
+            try:
+                regex = re.compile(pattern)
+            except re.error:
+                # Invalid patterns fall back to direct string matching
+                self.exact.setdefault(pattern, index)
+                continue
+            if regex.groups:
+                self.sequential.append((index, regex))
+            else:
+                combinable.append((index, pattern))
+        self.combined = self._combine(combinable)
+
+    def _combine(self, combinable: List[Tuple[int, str]]) -> Optional[re.Pattern]:
+        if not combinable:
+            return None
+        try:
+            return re.compile('|'.join(f'(?P<r{index}>{scoped(pattern)})' for index, pattern in combinable))
+        except re.error:
+            self.sequential.extend((index, re.compile(pattern)) for index, pattern in combinable)
+            self.sequential.sort(key=lambda item: item[0])
+            return None
+
+    def match(self, text: str) -> Optional[int]:
+        """
+        Find the first matching pattern.
+
+        Args:
+            text (str): The stripped user input
+
+        Returns:
+            Optional[int]: The index of the first matching pattern, or None
+        """
+        best = self.exact.get(text)
+        for length, table in self.prefixes.items():
+            index = table.get(text[:length]) if len(text) >= length else None
+            if index is not None and (best is None or index < best):
+                best = index
+        if self.combined is not None:
+            found = self.combined.match(text)
+            if found is not None:
+                index = int(found.lastgroup[1:])
+                if best is None or index < best:
+                    best = index
+        for index, regex in self.sequential:
+            if best is not None and index > best:
+                break
+            if regex.match(text):
+                return index
+        return best
+
+
+def probe_inputs(pattern: str, length: int) -> List[str]:
+    """
+    Inputs likely to trigger catastrophic backtracking in a pattern: long
+    runs of characters it mentions, or that its classes accept, followed by
+    a character that makes the match fail late.
+    """
+    chars = {char for char in pattern if char.isalnum() or char in ' -_.,@'}
+    chars.update('a0 ')
+    probes = []
+    for char in sorted(chars):
+        run = char * length
+        probes.extend([run, run + '!', run + '\x00'])
+    return probes
+
+
+def _probe_patterns(conn, patterns: Sequence[str], length: int) -> None:
+    for index, pattern in enumerate(patterns):
+        conn.send(index)
+        try:
+            regex = re.compile(pattern)
+        except re.error:
+            continue
+        for probe in probe_inputs(pattern, length):
+            regex.match(probe)
+    conn.send(len(patterns))
+    conn.close()
+
+
+def find_slow_patterns(patterns: Sequence[str], budget: float, length: int, startup_timeout: float = 10.0) -> List[str]:
+    """
+    Find patterns that exceed a time budget on adversarial inputs.
+
+    Python's re module cannot be interrupted, so the probes run in a child
+    process that is killed when a pattern overruns its budget; probing then
+    resumes with the next pattern in a fresh process. Callers are web
+    workers running several threads, and a forked copy of a threaded
+    process can deadlock on a lock held by another thread, so children come
+    from a single-threaded fork server, or are spawned where there is none.
+
+    Args:
+        patterns (Sequence[str]): The patterns to check
+        budget (float): Seconds each pattern may spend on all of its probes
+        length (int): Length of the probe inputs, i.e. the longest input matched at runtime
+        startup_timeout (float): Seconds to wait for the child process to start
+
+    Returns:
+        List[str]: The patterns that exceeded the budget
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    remaining = list(dict.fromkeys(patterns))
+    slow = []
+    while remaining:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_probe_patterns, args=(sender, remaining, length), daemon=True)
+        process.start()
+        sender.close()
+        current = None
+        try:
+            while True:
+                if not receiver.poll(budget if current is not None else startup_timeout):
+                    break
+                current = receiver.recv()
+                if current == len(remaining):
+                    break
+        except EOFError:
+            # The child died: before starting, or on the current pattern
+            pass
+        finally:
+            process.kill()
+            process.join()
+            receiver.close()
+        if current is None:
+            raise RuntimeError('Pattern probe process did not start')
+        if current >= len(remaining):
+            break
+        slow.append(remaining[current])
+        remaining = remaining[current + 1:]
+    return slow
+
+
+def literal_or_invalid(pattern: str) -> Optional[Tuple[str, bool]]:
+    # Invalid patterns are matched by equality, like an anchored literal
+    literal = literal_form(pattern)
+    if literal is not None:
+        return literal
+    try:
+        re.compile(pattern)
+    except re.error:
+        return pattern, True
+    return None
+
+
+def is_catch_all(pattern: str) -> bool:
+    """
+    Whether a pattern matches every input.
+
+    With re.match, any pattern that can match the empty string at the
+    start of an input (e.g. '.*' or 'a?') matches everything. Regex
+    patterns are judged by trying a few representative inputs.
+    """
+    literal = literal_or_invalid(pattern)
+    if literal is not None:
+        return literal == ('', False)
+    regex = re.compile(pattern)
+    return all(regex.match(text) for text in ('', 'x', '0', ' ', '!', 'Hello 123'))
+
+
+def shadows(earlier: str, later: str) -> bool:
+    """
+    Whether an earlier route pattern matches every input a later one does,
+    which makes the later route unreachable.
+    """
+    if earlier == later or is_catch_all(earlier):
+        return True
+    first, second = literal_or_invalid(earlier), literal_or_invalid(later)
+    if first is None or second is None:
+        return False
+    if first[1]:
+        return second == first
+    return second[0].startswith(first[0])
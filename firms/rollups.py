@@ -0,0 +1,268 @@
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+import atexit
+import datetime
+import logging
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, Sum
+
+from .models import ChatUser, Firm, FirmHourlyStats, StepTransitionStats
+
+logger = logging.getLogger(__name__)
+
+HOURLY_FIELDS = ('messages_in', 'messages_out', 'new_users', 'active_users')
+
+
+def hour_of(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def increment(model, lookup: dict, increments: Dict[str, int]) -> None:
+    """
+    Add to the counters of a rollup row, creating the row if needed.
+
+    Args:
+        model: The rollup model
+        lookup (dict): The row's unique key
+        increments (Dict[str, int]): Counter field -> amount to add
+    """
+    increments = {field: amount for field, amount in increments.items() if amount}
+    if not increments:
+        return
+    updates = {field: F(field) + amount for field, amount in increments.items()}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **increments)
+    except IntegrityError:
+        # Another process created the row first
+        model.objects.filter(**lookup).update(**updates)
+
+
+def mark_active(chat_user: ChatUser, moment: datetime.datetime) -> Tuple[bool, bool]:
+    """
+    Set a chat user's last_active_at for an inbound message; the caller
+    saves the chat user.
+
+    A sender without last_active_at is a new user: it is set on a user's
+    first message, and was backfilled for users created before the rollups.
+
+    Args:
+        chat_user (ChatUser): The sender
+        moment (datetime.datetime): When the message was received
+
+    Returns:
+        Tuple[bool, bool]: Whether the sender is a new user, and whether this
+        is their first message this hour, in which case last_active_at must
+        be saved for the hourly active user count to stay right
+    """
+    previous = chat_user.last_active_at
+    chat_user.last_active_at = moment
+    return previous is None, previous is None or previous < hour_of(moment)
+
+
+class RollupBuffer:
+    """
+    Accumulates analytics counters in memory and adds them to the rollup
+    tables in the background.
+
+    Recording is a dict update, so the webhook path never waits on the
+    rollup tables; a background thread flushes every flush_interval
+    seconds with one UPDATE per touched row. Counts recorded since the
+    last flush are lost if the process dies.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        # (firm id, hour) -> counter field -> amount
+        self._hourly: Dict[Tuple[int, datetime.datetime], Counter] = defaultdict(Counter)
+        # (firm id, day, from step, to step) -> amount
+        self._transitions: Counter = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def record_inbound(self, firm_id: int, moment: datetime.datetime, new_user: bool, first_this_hour: bool) -> None:
+        """
+        Count an inbound message, and its sender as new or active this hour.
+
+        Call once the sender's state is saved, so a batch that is retried
+        or redelivered is counted once.
+
+        Args:
+            firm_id (int): The firm's primary key
+            moment (datetime.datetime): When the message was received
+            new_user (bool): The sender's first message, see mark_active
+            first_this_hour (bool): The sender's first message this hour, see mark_active
+        """
+        with self._lock:
+            counters = self._hourly[(firm_id, hour_of(moment))]
+            counters['messages_in'] += 1
+            if new_user:
+                counters['new_users'] += 1
+            if first_this_hour:
+                counters['active_users'] += 1
+        self._ensure_started()
+
+    def record_outbound(self, firm_id: int, moment: datetime.datetime) -> None:
+        with self._lock:
+            self._hourly[(firm_id, hour_of(moment))]['messages_out'] += 1
+        self._ensure_started()
+
+    def record_transition(self, firm_id: int, from_step: str, to_step: str, moment: datetime.datetime) -> None:
+        with self._lock:
+            self._transitions[(firm_id, moment.date(), from_step, to_step)] += 1
+        self._ensure_started()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None or self._closed:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='firm-rollups', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self.flush()
+            close_old_connections()
+
+    def flush(self) -> None:
+        """Add the buffered counters to the rollup tables."""
+        with self._flush_lock:
+            with self._lock:
+                hourly, self._hourly = self._hourly, defaultdict(Counter)
+                transitions, self._transitions = self._transitions, Counter()
+            try:
+                while hourly:
+                    (firm_id, hour), counters = next(iter(hourly.items()))
+                    increment(FirmHourlyStats, {'firm_id': firm_id, 'hour': hour}, counters)
+                    del hourly[(firm_id, hour)]
+                while transitions:
+                    (firm_id, day, from_step, to_step), count = next(iter(transitions.items()))
+                    increment(
+                        StepTransitionStats,
+                        {'firm_id': firm_id, 'day': day, 'from_step': from_step, 'to_step': to_step},
+                        {'count': count},
+                    )
+                    del transitions[(firm_id, day, from_step, to_step)]
+            except Exception:
+                logger.exception('Error flushing firm rollups, keeping the counters for the next flush')
+                with self._lock:
+                    for key, counters in hourly.items():
+                        self._hourly[key].update(counters)
+                    self._transitions.update(transitions)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'hourly_rows': len(self._hourly), 'transition_rows': len(self._transitions)}
+
+    def close(self) -> None:
+        """Flush the counters and stop the background thread."""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+
+_rollups: Optional[RollupBuffer] = None
+_rollups_lock = threading.Lock()
+
+
+def get_rollups() -> RollupBuffer:
+    """
+    Get the process-wide rollup buffer configured from settings.
+
+    Returns:
+        RollupBuffer: The shared buffer
+    """
+    global _rollups
+    if _rollups is None:
+        with _rollups_lock:
+            if _rollups is None:
+                rollups = RollupBuffer(settings.FIRM_ROLLUP_FLUSH_INTERVAL)
+                atexit.register(rollups.close)
+                _rollups = rollups
+    return _rollups
+
+
+def hourly_stats(firm_id: int, since: datetime.datetime) -> List[dict]:
+    """
+    Get a firm's hourly rollups since a moment, oldest first.
+
+    Args:
+        firm_id (int): The firm's primary key
+        since (datetime.datetime): The first hour to include
+
+    Returns:
+        List[dict]: One dict per hour with traffic, with 'hour' and HOURLY_FIELDS
+    """
+    return list(
+        FirmHourlyStats.objects.filter(firm_id=firm_id, hour__gte=hour_of(since))
+        .order_by('hour')
+        .values('hour', *HOURLY_FIELDS)
+    )
+
+
+def step_funnel(firm: Firm, since: datetime.datetime, new_users: int) -> List[dict]:
+    """
+    Build a firm's step funnel from the transition rollups.
+
+    A step is entered by transitions into it from another step, and by new
+    users for the first step; what is not followed by a transition to
+    another step counts as drop-off. Steps are listed in flow order, with
+    steps no longer in the flow last.
+
+    Args:
+        firm (Firm): The firm object
+        since (datetime.datetime): Start of the period
+        new_users (int): New users in the period
+
+    Returns:
+        List[dict]: Per step: 'step', 'entered', 'continued', 'dropped',
+        'drop_rate', 'repeats' and 'next' (the most common next steps)
+    """
+    transitions = (
+        StepTransitionStats.objects.filter(firm_id=firm.pk, day__gte=since.date())
+        .values('from_step', 'to_step')
+        .annotate(total=Sum('count'))
+    )
+    entered: Counter = Counter()
+    continued: Counter = Counter()
+    repeats: Counter = Counter()
+    next_steps: Dict[str, Counter] = defaultdict(Counter)
+    for transition in transitions:
+        from_step, to_step, total = transition['from_step'], transition['to_step'], transition['total']
+        if from_step == to_step:
+            repeats[from_step] += total
+            continue
+        entered[to_step] += total
+        continued[from_step] += total
+        next_steps[from_step][to_step] += total
+    entered[firm.first_step or 'start'] += new_users
+
+    order = [step['id'] for step in (firm.flow or {}).get('steps', [])]
+    seen = set(order)
+    order = list(dict.fromkeys(order)) + sorted(
+        step for step in set(entered) | set(continued) | set(repeats) if step not in seen
+    )
+    funnel = []
+    for step in order:
+        dropped = max(entered[step] - continued[step], 0)
+        funnel.append({
+            'step': step,
+            'entered': entered[step],
+            'continued': continued[step],
+            'dropped': dropped,
+            'drop_rate': dropped / entered[step] if entered[step] else 0.0,
+            'repeats': repeats[step],
+            'next': next_steps[step].most_common(3),
+        })
+    return funnel
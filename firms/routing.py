@@ -0,0 +1,169 @@
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Firm
+
+# Sentinel stored for phone numbers with no active firm
+MISSING = 'missing'
+
+
+def routing_cache():
+    return caches['firm_routing']
+
+
+def routing_fields() -> List[str]:
+    """
+    Firm columns kept in the routing cache, in model order.
+
+    The flow JSON and its compiled artifact are left out; they are loaded
+    lazily on the rare occasion the compiled flow for the firm's
+    flow_version is not cached yet.
+    """
+    return [f.attname for f in Firm._meta.concrete_fields if f.attname not in ('flow', 'compiled_flow')]
+
+
+def cache_key(phone_number: str) -> str:
+    return f'firm-routing:{phone_number}'
+
+
+def get_routed_firm(phone_number: str) -> Optional[Firm]:
+    """
+    Get the active firm for a display phone number through the routing cache.
+
+    Args:
+        phone_number (str): The firm's display phone number
+
+    Returns:
+        Optional[Firm]: The firm with its flow deferred if found, None otherwise
+    """
+    cache = routing_cache()
+    key = cache_key(phone_number)
+    fields = routing_fields()
+    values = cache.get(key)
+    if values == MISSING:
+        return None
+    if values is None:
+        try:
+            values = Firm.objects.values_list(*fields).get(phone_number=phone_number, status=True)
+        except Firm.DoesNotExist:
+            cache.set(key, MISSING, settings.FIRM_ROUTING_NEGATIVE_TIMEOUT)
+            return None
+        cache.set(key, tuple(values))
+    return Firm.from_db('default', fields, values)
+
+
+async def aget_routed_firm(phone_number: str) -> Optional[Firm]:
+    """
+    Async version of get_routed_firm.
+
+    Args:
+        phone_number (str): The firm's display phone number
+
+    Returns:
+        Optional[Firm]: The firm with its flow deferred if found, None otherwise
+    """
+    cache = routing_cache()
+    key = cache_key(phone_number)
+    fields = routing_fields()
+    values = await cache.aget(key)
+    if values == MISSING:
+        return None
+    if values is None:
+        try:
+            values = await Firm.objects.values_list(*fields).aget(phone_number=phone_number, status=True)
+        except Firm.DoesNotExist:
+            await cache.aset(key, MISSING, settings.FIRM_ROUTING_NEGATIVE_TIMEOUT)
+            return None
+        await cache.aset(key, tuple(values))
+    return Firm.from_db('default', fields, values)
+
+
+def get_routed_firms(phone_numbers: Iterable[str]) -> Dict[str, Firm]:
+    """
+    Get the active firms for several display phone numbers at once.
+
+    Cached entries are fetched with a single get_many call and the misses
+    with a single query.
+
+    Args:
+        phone_numbers (Iterable[str]): The firms' display phone numbers
+
+    Returns:
+        Dict[str, Firm]: Firms keyed by phone number; unknown numbers are omitted
+    """
+    cache = routing_cache()
+    fields = routing_fields()
+    keys = {cache_key(number): number for number in set(phone_numbers)}
+    cached = cache.get_many(list(keys))
+    found = {keys[key]: values for key, values in cached.items()}
+    missing = [number for number in keys.values() if number not in found]
+    if missing:
+        phone_index = fields.index('phone_number')
+        rows = Firm.objects.filter(phone_number__in=missing, status=True).values_list(*fields)
+        loaded = {}
+        for values in rows:
+            loaded.setdefault(values[phone_index], tuple(values))
+        cache.set_many({cache_key(number): values for number, values in loaded.items()})
+        unknown = [number for number in missing if number not in loaded]
+        if unknown:
+            cache.set_many(
+                {cache_key(number): MISSING for number in unknown},
+                settings.FIRM_ROUTING_NEGATIVE_TIMEOUT,
+            )
+        found.update(loaded)
+    return {
+        number: Firm.from_db('default', fields, values)
+        for number, values in found.items()
+        if values != MISSING
+    }
+
+
+async def aget_routed_firms(phone_numbers: Iterable[str]) -> Dict[str, Firm]:
+    """
+    Async version of get_routed_firms.
+
+    Args:
+        phone_numbers (Iterable[str]): The firms' display phone numbers
+
+    Returns:
+        Dict[str, Firm]: Firms keyed by phone number; unknown numbers are omitted
+    """
+    cache = routing_cache()
+    fields = routing_fields()
+    keys = {cache_key(number): number for number in set(phone_numbers)}
+    cached = await cache.aget_many(list(keys))
+    found = {keys[key]: values for key, values in cached.items()}
+    missing = [number for number in keys.values() if number not in found]
+    if missing:
+        phone_index = fields.index('phone_number')
+        rows = Firm.objects.filter(phone_number__in=missing, status=True).values_list(*fields)
+        loaded = {}
+        async for values in rows:
+            loaded.setdefault(values[phone_index], tuple(values))
+        await cache.aset_many({cache_key(number): values for number, values in loaded.items()})
+        unknown = [number for number in missing if number not in loaded]
+        if unknown:
+            await cache.aset_many(
+                {cache_key(number): MISSING for number in unknown},
+                settings.FIRM_ROUTING_NEGATIVE_TIMEOUT,
+            )
+        found.update(loaded)
+    return {
+        number: Firm.from_db('default', fields, values)
+        for number, values in found.items()
+        if values != MISSING
+    }
+
+
+def invalidate_routes(*phone_numbers: str) -> None:
+    """
+    Drop cached routing entries, including negative ones.
+
+    Args:
+        *phone_numbers (str): The display phone numbers to drop
+    """
+    keys = [cache_key(number) for number in set(phone_numbers) if number]
+    if keys:
+        routing_cache().delete_many(keys)
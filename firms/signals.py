@@ -0,0 +1,44 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Firm, ChatUser
+from .routing import invalidate_routes
+from .state import conversation_states
+
+# Note: queryset.update() bypasses these signals; call invalidate_routes()
+# yourself after bulk updates to Firm.
+
+
+@receiver(pre_save, sender=Firm)
+def remember_previous_phone_number(sender, instance, **kwargs):
+    instance._previous_phone_number = None
+    if instance.pk:
+        instance._previous_phone_number = (
+            Firm.objects.filter(pk=instance.pk).values_list('phone_number', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Firm)
+def drop_routes_on_save(sender, instance, **kwargs):
+    # Covers flow edits, status toggles and phone number changes
+    invalidate_routes(instance.phone_number, getattr(instance, '_previous_phone_number', None))
+
+
+@receiver(post_delete, sender=Firm)
+def drop_routes_on_delete(sender, instance, **kwargs):
+    invalidate_routes(instance.phone_number)
+
+
+@receiver(pre_save, sender=ChatUser)
+def bump_state_version(sender, instance, **kwargs):
+    # Cached copies in other processes become stale; their next state save
+    # is refused instead of overwriting this one
+    if instance.pk:
+        instance.state_version += 1
+
+
+@receiver(post_save, sender=ChatUser)
+@receiver(post_delete, sender=ChatUser)
+def drop_cached_conversation_state(sender, instance, **kwargs):
+    # Edits made outside the webhook (e.g. the admin) must not be overwritten
+    conversation_states.evict(instance.firm_id, instance.phone_number)
@@ -0,0 +1,240 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+
+from .models import Firm, ChatUser
+
+StateKey = Tuple[int, str]
+
+# Columns a conversation turn changes
+STATE_FIELDS = ['current_step', 'last_message_received', 'last_active_at']
+
+
+class StaleConversationState(Exception):
+    """A chat user's row changed since it was cached; the batch must be retried."""
+
+
+class ConversationStateCache:
+    """
+    Keeps the ChatUser rows of active conversations in memory.
+
+    Entries are evicted least-recently-used once the cache holds max_size
+    conversations, or when they are older than ttl seconds. Changes are
+    applied to the cached objects first and persisted with one bulk UPDATE
+    of the state columns, so reads within a process always see the latest
+    step; callers evict the objects they changed if the batch fails before
+    the UPDATE commits. Other processes only see changes once their own
+    entry expires, but the UPDATE only writes rows whose state_version is
+    still the cached one: if deliveries for a conversation reach more than
+    one process, the save from a stale copy is refused instead of silently
+    overwriting the other process's step transition.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create_many(self, users: List[Tuple[Firm, str, str]]) -> Dict[StateKey, ChatUser]:
+        """
+        Get or create chat users, loading misses with a single query.
+
+        Args:
+            users (List[Tuple[Firm, str, str]]): (firm, phone_number, profile_name) tuples
+
+        Returns:
+            Dict[StateKey, ChatUser]: Chat users keyed by (firm id, phone number)
+        """
+        wanted = {(firm.pk, phone_number): (firm, profile_name) for firm, phone_number, profile_name in users}
+        found = self._cached(wanted)
+        missing = [key for key in wanted if key not in found]
+        if missing:
+            loaded = self._load(missing)
+            new_users = self._new_users(wanted, [key for key in missing if key not in loaded])
+            if new_users:
+                # Another worker may create the same user; the unique
+                # constraint turns that race into a no-op
+                ChatUser.objects.bulk_create(new_users, ignore_conflicts=True)
+                loaded.update(self._load([key for key in missing if key not in loaded]))
+            for key, chat_user in loaded.items():
+                chat_user.firm = wanted[key][0]
+            self._store(loaded)
+            found.update(loaded)
+        return found
+
+    async def aget_or_create_many(self, users: List[Tuple[Firm, str, str]]) -> Dict[StateKey, ChatUser]:
+        """
+        Async version of get_or_create_many.
+
+        Args:
+            users (List[Tuple[Firm, str, str]]): (firm, phone_number, profile_name) tuples
+
+        Returns:
+            Dict[StateKey, ChatUser]: Chat users keyed by (firm id, phone number)
+        """
+        wanted = {(firm.pk, phone_number): (firm, profile_name) for firm, phone_number, profile_name in users}
+        found = self._cached(wanted)
+        missing = [key for key in wanted if key not in found]
+        if missing:
+            loaded = await self._aload(missing)
+            new_users = self._new_users(wanted, [key for key in missing if key not in loaded])
+            if new_users:
+                await ChatUser.objects.abulk_create(new_users, ignore_conflicts=True)
+                loaded.update(await self._aload([key for key in missing if key not in loaded]))
+            for key, chat_user in loaded.items():
+                chat_user.firm = wanted[key][0]
+            self._store(loaded)
+            found.update(loaded)
+        return found
+
+    def _cached(self, wanted) -> Dict[StateKey, ChatUser]:
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in wanted:
+                entry = self._entries.get(key)
+                if entry is not None and now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[1]
+        return found
+
+    @staticmethod
+    def _new_users(wanted, keys: List[StateKey]) -> List[ChatUser]:
+        return [
+            ChatUser(
+                firm=wanted[key][0],
+                phone_number=key[1],
+                profile_name=wanted[key][1],
+                current_step=wanted[key][0].first_step or 'start',
+            )
+            for key in keys
+        ]
+
+    @staticmethod
+    def _queryset(keys):
+        return ChatUser.objects.filter(
+            firm_id__in={firm_id for firm_id, _ in keys},
+            phone_number__in={phone_number for _, phone_number in keys},
+        )
+
+    def _load(self, keys: List[StateKey]) -> Dict[StateKey, ChatUser]:
+        keys = set(keys)
+        return {
+            (chat_user.firm_id, chat_user.phone_number): chat_user
+            for chat_user in self._queryset(keys)
+            if (chat_user.firm_id, chat_user.phone_number) in keys
+        }
+
+    async def _aload(self, keys: List[StateKey]) -> Dict[StateKey, ChatUser]:
+        keys = set(keys)
+        return {
+            (chat_user.firm_id, chat_user.phone_number): chat_user
+            async for chat_user in self._queryset(keys)
+            if (chat_user.firm_id, chat_user.phone_number) in keys
+        }
+
+    def _store(self, chat_users: Dict[StateKey, ChatUser]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for key, chat_user in chat_users.items():
+                self._entries[key] = (now, chat_user)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def save_states(self, chat_users: Iterable[ChatUser], also: Optional[Callable[[], None]] = None) -> None:
+        """
+        Persist the state columns of changed chat users in one UPDATE.
+
+        Args:
+            chat_users (Iterable[ChatUser]): Chat users whose step changed
+            also (Optional[Callable[[], None]]): Writes that must commit or
+                roll back together with the states; called in the same
+                transaction, after the UPDATE
+
+        Raises:
+            StaleConversationState: If another process saved one of the
+                chat users since it was cached; nothing is written
+        """
+        chat_users = list(chat_users)
+        if not chat_users and also is None:
+            return
+        try:
+            with transaction.atomic():
+                if chat_users:
+                    self._update_states(chat_users)
+                if also is not None:
+                    also()
+        except Exception:
+            # Do not keep serving state the database never received
+            self.evict_many(chat_users)
+            raise
+        for chat_user in chat_users:
+            chat_user.state_version += 1
+
+    @staticmethod
+    def _update_states(chat_users: List[ChatUser]) -> None:
+        # Like bulk_update, one UPDATE with a CASE per column, but limited
+        # to rows still at the version they were read at
+        current = Q()
+        for chat_user in chat_users:
+            current |= Q(pk=chat_user.pk, state_version=chat_user.state_version)
+        columns = {}
+        for name in STATE_FIELDS:
+            field = ChatUser._meta.get_field(name)
+            columns[name] = Case(
+                *(When(pk=chat_user.pk, then=Value(getattr(chat_user, name), output_field=field)) for chat_user in chat_users),
+                output_field=field,
+            )
+        updated = ChatUser.objects.filter(current).update(state_version=F('state_version') + 1, **columns)
+        if updated != len(chat_users):
+            raise StaleConversationState(
+                f'{len(chat_users) - updated} of {len(chat_users)} chat users were saved by another process'
+            )
+
+    async def asave_states(self, chat_users: Iterable[ChatUser], also: Optional[Callable[[], None]] = None) -> None:
+        """
+        Async version of save_states.
+
+        The async ORM cannot run transactions, so the save runs in a thread
+        through save_states.
+
+        Args:
+            chat_users (Iterable[ChatUser]): Chat users whose step changed
+            also (Optional[Callable[[], None]]): Synchronous writes that must
+                commit or roll back together with the states
+
+        Raises:
+            StaleConversationState: If another process saved one of the
+                chat users since it was cached; nothing is written
+        """
+        await sync_to_async(self.save_states)(list(chat_users), also)
+
+    def evict(self, firm_id: int, phone_number: str) -> None:
+        with self._lock:
+            self._entries.pop((firm_id, phone_number), None)
+
+    def evict_many(self, chat_users: Iterable[ChatUser]) -> None:
+        with self._lock:
+            for chat_user in chat_users:
+                self._entries.pop((chat_user.firm_id, chat_user.phone_number), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+conversation_states = ConversationStateCache(
+    max_size=settings.CONVERSATION_STATE_CACHE_SIZE,
+    ttl=settings.CONVERSATION_STATE_CACHE_TTL,
+)
@@ -1,3 +1,333 @@
-from django.test import TestCase
+from unittest import mock
+import datetime
+import importlib
+import multiprocessing
+import re
 
-# Create your tests here.
+from django.apps import apps
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from .admin import FirmAdminForm
+from .flow import analyze_flow, compile_flow
+from .models import ChatUser, Firm, FirmHourlyStats, StepTransitionStats
+from .patterns import StepMatcher, find_slow_patterns
+from .rollups import RollupBuffer, mark_active, step_funnel
+from .routing import get_routed_firm, get_routed_firms, routing_cache
+from .state import ConversationStateCache, StaleConversationState
+
+
+def first_match(patterns, text):
+    # Routing as it was before flows were compiled: re.match on each
+    # pattern in order, invalid patterns compared for equality
+    for index, pattern in enumerate(patterns):
+        try:
+            if re.match(pattern, text):
+                return index
+        except re.error:
+            if pattern == text:
+                return index
+    return None
+
+
+class StepMatcherTests(SimpleTestCase):
+    PATTERNS = [
+        '^1$', 'yes', '^no$', r'(?i)^help', r'^\d{4,}$', r'^(a)\1$', 'x[', '^$', r'^(?:ab|cd)+$', 'ye', '.*',
+    ]
+    INPUTS = [
+        '', '1', '11', 'yes', 'yesterday', 'ye', 'no', 'nope', 'HELP me', 'Help', '1234', '123', 'aa', 'ab',
+        'x[', 'x', 'abcd', 'cdab', 'anything else',
+    ]
+
+    def test_matches_first_pattern_like_re_match(self):
+        for count in range(1, len(self.PATTERNS) + 1):
+            patterns = self.PATTERNS[:count]
+            matcher = StepMatcher(patterns)
+            for text in self.INPUTS:
+                with self.subTest(patterns=patterns, text=text):
+                    self.assertEqual(matcher.match(text), first_match(patterns, text))
+
+    def test_reversed_order_keeps_precedence(self):
+        patterns = list(reversed(self.PATTERNS))
+        matcher = StepMatcher(patterns)
+        for text in self.INPUTS:
+            with self.subTest(text=text):
+                self.assertEqual(matcher.match(text), first_match(patterns, text))
+
+    def test_no_match(self):
+        self.assertIsNone(StepMatcher(['^1$', '^2$']).match('3'))
+
+
+class CompiledFlowTests(SimpleTestCase):
+    FLOW = {
+        'steps': [
+            {
+                'id': 'start',
+                'message': 'Welcome',
+                'next': [{'pattern': '^1$', 'next': 'one'}, {'pattern': '.*', 'next': 'start'}],
+            },
+            {'id': 'one', 'message': 'One', 'next': 'start'},
+            {'id': 'start', 'message': 'Ignored duplicate', 'next': 'one'},
+        ]
+    }
+
+    def test_route(self):
+        compiled = compile_flow(self.FLOW)
+        self.assertEqual(compiled.route('start', ' 1 '), ('one', 'One'))
+        self.assertEqual(compiled.route('start', 'hello'), ('start', 'Welcome'))
+        self.assertEqual(compiled.route('one', 'anything'), ('start', 'Welcome'))
+        self.assertEqual(compiled.route('missing', '1'), (None, 'Invalid step in conversation flow.'))
+
+    def test_no_flow(self):
+        self.assertIsNone(compile_flow({}))
+
+
+class AnalyzeFlowTests(SimpleTestCase):
+    def test_valid_flow(self):
+        report = analyze_flow(CompiledFlowTests.FLOW, 'start')
+        self.assertEqual(report.errors, [])
+        self.assertEqual(len(report.warnings), 1)
+        self.assertIn('defined more than once', report.warnings[0])
+
+    def test_missing_steps_are_errors(self):
+        flow = {
+            'steps': [
+                {'id': 'start', 'message': 'Hi', 'next': [{'pattern': '^1$', 'next': 'gone'}]},
+                {'id': 'two', 'message': 'Two', 'next': 'nowhere'},
+            ]
+        }
+        report = analyze_flow(flow, 'begin')
+        self.assertEqual(len(report.errors), 3)
+        self.assertIn("First step 'begin' does not exist.", report.errors)
+
+    def test_unreachable_steps_and_shadowed_routes_are_warnings(self):
+        flow = {
+            'steps': [
+                {
+                    'id': 'start',
+                    'message': 'Hi',
+                    'next': [
+                        {'pattern': 'yes', 'next': 'start'},
+                        {'pattern': 'yes please', 'next': 'island'},
+                        {'pattern': '.*', 'next': 'start'},
+                        {'pattern': '^2$', 'next': 'island'},
+                    ],
+                },
+                {'id': 'island', 'message': 'Unreachable', 'next': 'start'},
+            ]
+        }
+        report = analyze_flow(flow, 'start')
+        self.assertEqual(report.errors, [])
+        self.assertEqual(len(report.warnings), 3)
+        self.assertIn("Step 'island' cannot be reached from 'start'.", report.warnings)
+
+
+class FindSlowPatternsTests(SimpleTestCase):
+    def test_flags_catastrophic_backtracking(self):
+        slow = find_slow_patterns(['^1$', r'^(a+)+$', r'^\d{4,}$', r'^(a|aa)*$'], budget=0.2, length=256)
+        self.assertEqual(slow, [r'^(a+)+$', r'^(a|aa)*$'])
+
+    def test_fast_patterns(self):
+        self.assertEqual(find_slow_patterns(['^1$', '.*', r'(?i)^help'], budget=0.2, length=256), [])
+
+    def test_probes_do_not_fork_the_caller(self):
+        with mock.patch('firms.patterns.multiprocessing.get_context', wraps=multiprocessing.get_context) as get_context:
+            self.assertEqual(find_slow_patterns(['^1$'], budget=0.2, length=16), [])
+        self.assertIn(get_context.call_args.args[0], ('forkserver', 'spawn'))
+
+
+class FirmAdminFormTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name='Admin firm', phone_number='100', first_step='start')
+
+    def form(self, flow):
+        return FirmAdminForm(
+            data={'name': self.firm.name, 'phone_number': '100', 'status': True, 'first_step': 'start',
+                  'flow': flow, 'flow_version': 0},
+            instance=self.firm,
+        )
+
+    def test_accepts_valid_flow(self):
+        form = self.form('{"steps": [{"id": "start", "message": "Hi", "next": "start"}]}')
+        self.assertTrue(form.is_valid(), form.errors)
+
+    def test_rejects_missing_step(self):
+        form = self.form('{"steps": [{"id": "start", "message": "Hi", "next": "gone"}]}')
+        self.assertFalse(form.is_valid())
+        self.assertIn('gone', str(form.errors['flow']))
+
+    def test_rejects_slow_pattern(self):
+        with self.settings(FLOW_PATTERN_TIME_BUDGET=0.2):
+            form = self.form(
+                '{"steps": [{"id": "start", "message": "Hi", "next": [{"pattern": "^(a+)+$", "next": "start"}]}]}'
+            )
+            self.assertFalse(form.is_valid())
+        self.assertIn('matching budget', str(form.errors['flow']))
+
+    def test_rejects_non_object_flow(self):
+        form = self.form('[1, 2]')
+        self.assertFalse(form.is_valid())
+        self.assertIn('JSON object', str(form.errors['flow']))
+
+
+class FirmRoutingCacheTests(TestCase):
+    def setUp(self):
+        routing_cache().clear()
+
+    def test_routes_are_cached(self):
+        firm = Firm.objects.create(name='Cached firm', phone_number='300')
+        self.assertEqual(get_routed_firm('300').pk, firm.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_routed_firm('300').pk, firm.pk)
+            self.assertEqual(list(get_routed_firms(['300'])), ['300'])
+
+    def test_cached_miss_is_cleared_when_the_firm_is_created(self):
+        self.assertIsNone(get_routed_firm('301'))
+        self.assertEqual(get_routed_firms(['301', '302']), {})
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_routed_firm('301'))
+        firm = Firm.objects.create(name='New firm', phone_number='301')
+        self.assertEqual(get_routed_firm('301').pk, firm.pk)
+        self.assertEqual(list(get_routed_firms(['301', '302'])), ['301'])
+
+    def test_changed_phone_number_stops_routing_to_the_old_number(self):
+        firm = Firm.objects.create(name='Moving firm', phone_number='303')
+        self.assertEqual(get_routed_firm('303').pk, firm.pk)
+        firm.phone_number = '304'
+        firm.save()
+        self.assertIsNone(get_routed_firm('303'))
+        self.assertEqual(get_routed_firm('304').pk, firm.pk)
+
+    def test_deactivated_and_deleted_firms_stop_routing(self):
+        firm = Firm.objects.create(name='Closing firm', phone_number='305')
+        self.assertIsNotNone(get_routed_firm('305'))
+        firm.status = False
+        firm.save()
+        self.assertIsNone(get_routed_firm('305'))
+        firm.status = True
+        firm.save()
+        self.assertIsNotNone(get_routed_firm('305'))
+        firm.delete()
+        self.assertIsNone(get_routed_firm('305'))
+
+
+class ConversationStateCacheTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name='State firm', phone_number='400', first_step='welcome')
+        self.cache = ConversationStateCache(max_size=10, ttl=60)
+
+    def get(self):
+        return self.cache.get_or_create_many([(self.firm, 'u', 'User')])[(self.firm.pk, 'u')]
+
+    def stored(self):
+        return ChatUser.objects.get(firm=self.firm, phone_number='u')
+
+    def test_read_after_write(self):
+        chat_user = self.get()
+        self.assertEqual(chat_user.current_step, 'welcome')
+        chat_user.current_step = 'next'
+        self.cache.save_states([chat_user])
+        with self.assertNumQueries(0):
+            self.assertIs(self.get(), chat_user)
+        self.assertEqual(self.stored().current_step, 'next')
+        # A second save from the same process is not mistaken for a stale one
+        chat_user.current_step = 'last'
+        self.cache.save_states([chat_user])
+        self.assertEqual(self.stored().current_step, 'last')
+        self.assertEqual(self.stored().state_version, 2)
+
+    def test_failed_save_is_evicted(self):
+        chat_user = self.get()
+        chat_user.current_step = 'next'
+        with self.assertRaises(RuntimeError):
+            self.cache.save_states([chat_user], also=mock.Mock(side_effect=RuntimeError))
+        self.assertEqual(self.stored().current_step, 'welcome')
+        reloaded = self.get()
+        self.assertIsNot(reloaded, chat_user)
+        self.assertEqual(reloaded.current_step, 'welcome')
+
+    def test_save_from_a_stale_copy_is_refused(self):
+        chat_user = self.get()
+        # Another process moves the conversation on
+        ChatUser.objects.filter(pk=chat_user.pk).update(current_step='elsewhere', state_version=F('state_version') + 1)
+        chat_user.current_step = 'next'
+        with self.assertRaises(StaleConversationState):
+            self.cache.save_states([chat_user])
+        self.assertEqual(self.stored().current_step, 'elsewhere')
+        self.assertEqual(self.get().current_step, 'elsewhere')
+
+    def test_model_saves_make_cached_copies_stale(self):
+        chat_user = self.get()
+        edited = self.stored()
+        edited.current_step = 'edited'
+        edited.save()
+        chat_user.current_step = 'next'
+        with self.assertRaises(StaleConversationState):
+            self.cache.save_states([chat_user])
+        self.assertEqual(self.stored().current_step, 'edited')
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name='Rollup firm', phone_number='300', first_step='start')
+        self.rollups = RollupBuffer(flush_interval=60)
+        # Recording starts the flush thread; these tests flush by hand
+        self.rollups._closed = True
+        self.hour = timezone.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=2)
+
+    def record(self, chat_user, moment):
+        new_user, first_this_hour = mark_active(chat_user, moment)
+        self.rollups.record_inbound(self.firm.pk, moment, new_user, first_this_hour)
+        return new_user, first_this_hour
+
+    def stats(self, hour):
+        return FirmHourlyStats.objects.values('messages_in', 'new_users', 'active_users').get(firm=self.firm, hour=hour)
+
+    def test_new_and_active_users(self):
+        chat_user = ChatUser.objects.create(firm=self.firm, phone_number='u', profile_name='U', current_step='start')
+        for minutes, expected in [(1, (True, True)), (2, (False, False)), (61, (False, True))]:
+            self.assertEqual(self.record(chat_user, self.hour + datetime.timedelta(minutes=minutes)), expected)
+        self.rollups.flush()
+        self.assertEqual(self.stats(self.hour), {'messages_in': 2, 'new_users': 1, 'active_users': 1})
+        self.assertEqual(
+            self.stats(self.hour + datetime.timedelta(hours=1)),
+            {'messages_in': 1, 'new_users': 0, 'active_users': 1},
+        )
+
+    def test_users_from_before_the_rollups_are_not_new(self):
+        ChatUser.objects.create(firm=self.firm, phone_number='old', profile_name='Old', current_step='two')
+        ChatUser.objects.filter(phone_number='old').update(created_at=self.hour - datetime.timedelta(days=30))
+        migration = importlib.import_module('firms.migrations.0010_backfill_chatuser_last_active_at')
+        migration.backfill_last_active_at(apps, None)
+        chat_user = ChatUser.objects.get(phone_number='old')
+        self.assertIsNotNone(chat_user.last_active_at)
+        self.record(chat_user, self.hour)
+        self.rollups.flush()
+        self.assertEqual(self.stats(self.hour), {'messages_in': 1, 'new_users': 0, 'active_users': 1})
+
+    def test_flush_adds_to_existing_rows(self):
+        for _ in range(2):
+            self.rollups.record_outbound(self.firm.pk, self.hour)
+            self.rollups.record_transition(self.firm.pk, 'start', 'two', self.hour)
+            self.rollups.flush()
+        self.assertEqual(FirmHourlyStats.objects.get(firm=self.firm, hour=self.hour).messages_out, 2)
+        self.assertEqual(StepTransitionStats.objects.get(firm=self.firm).count, 2)
+
+    def test_step_funnel(self):
+        self.firm.flow = {'steps': [{'id': 'start'}, {'id': 'two'}, {'id': 'three'}]}
+        for from_step, to_step, count in [('start', 'two', 6), ('start', 'start', 2), ('two', 'three', 3), ('old', 'two', 1)]:
+            for _ in range(count):
+                self.rollups.record_transition(self.firm.pk, from_step, to_step, self.hour)
+        self.rollups.flush()
+        funnel = {row['step']: row for row in step_funnel(self.firm, self.hour, new_users=10)}
+        self.assertEqual(list(funnel), ['start', 'two', 'three', 'old'])
+        self.assertEqual(
+            {key: funnel['start'][key] for key in ('entered', 'continued', 'dropped', 'repeats')},
+            {'entered': 10, 'continued': 6, 'dropped': 4, 'repeats': 2},
+        )
+        self.assertEqual(funnel['start']['drop_rate'], 0.4)
+        self.assertEqual(funnel['two']['entered'], 7)
+        self.assertEqual(funnel['two']['dropped'], 4)
+        self.assertEqual(funnel['three']['dropped'], 3)
+        self.assertEqual(funnel['start']['next'], [('two', 6)])
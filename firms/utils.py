@@ -1,10 +1,15 @@
 from .models import Firm, ChatUser
-from typing import Optional, Tuple
-import re
+from .flow import aget_compiled_flow, get_compiled_flow
+from .routing import aget_routed_firm, aget_routed_firms, get_routed_firm, get_routed_firms
+from .state import conversation_states
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 def get_firm_by_phone(phone_number: str) -> Optional[Firm]:
     """
     Get a firm by its phone number.
+
+    Lookups go through the firm routing cache, so the firm's flow is
+    deferred and only loaded if its compiled flow is not cached yet.
     
     Args:
         phone_number (str): The phone number to search for
@@ -12,10 +17,19 @@ def get_firm_by_phone(phone_number: str) -> Optional[Firm]:
     Returns:
         Optional[Firm]: The firm if found, None otherwise
     """
-    try:
-        return Firm.objects.get(phone_number=phone_number, status=True)
-    except Firm.DoesNotExist:
-        return None
+    return get_routed_firm(phone_number)
+
+def get_firms_by_phone(phone_numbers: Iterable[str]) -> Dict[str, Firm]:
+    """
+    Get the firms for several phone numbers in one round trip.
+    
+    Args:
+        phone_numbers (Iterable[str]): The phone numbers to search for
+        
+    Returns:
+        Dict[str, Firm]: Firms keyed by phone number; unknown numbers are omitted
+    """
+    return get_routed_firms(phone_numbers)
 
 def get_next_message(firm: Firm, current_step: str, user_input: str) -> Tuple[str, str]:
     """
@@ -29,41 +43,10 @@ def get_next_message(firm: Firm, current_step: str, user_input: str) -> Tuple[st
     Returns:
         Tuple[str, str]: A tuple containing (next_step_id, message_to_send)
     """
-    flow = firm.flow
-    if not flow or 'steps' not in flow:
+    compiled = get_compiled_flow(firm)
+    if compiled is None:
         return None, "No flow configured for this firm."
-    
-    # Find the current step in the flow
-    current_step_data = next(
-        (step for step in flow['steps'] if step['id'] == current_step),
-        None
-    )
-    
-    if not current_step_data:
-        return None, "Invalid step in conversation flow."
-    
-    # Handle the next step logic
-    next_step = current_step_data.get('next')
-    
-    # If next is a string, it's a direct next step
-    if isinstance(next_step, str):
-        return next_step, get_message_for_step(flow, next_step)
-    
-    # If next is a list, it's a pattern-based routing
-    if isinstance(next_step, list):
-        for pattern_data in next_step:
-            pattern = pattern_data.get('pattern', '')
-            try:
-                if re.match(pattern, user_input.strip()):
-                    next_step_id = pattern_data.get('next')
-                    return next_step_id, get_message_for_step(flow, next_step_id)
-            except re.error:
-                # If pattern is invalid, try direct string matching
-                if pattern == user_input.strip():
-                    next_step_id = pattern_data.get('next')
-                    return next_step_id, get_message_for_step(flow, next_step_id)
-    
-    return None, "No valid next step found in the flow."
+    return compiled.route(current_step, user_input)
 
 def get_message_for_step(flow: dict, step_id: str) -> str:
     """
@@ -102,4 +85,114 @@ def get_or_create_chat_user(firm: Firm, phone_number: str, profile_name: str) ->
             'current_step': firm.first_step or 'start'
         }
     )
-    return chat_user 
\ No newline at end of file
+    return chat_user
+
+def get_or_create_chat_users(users: List[Tuple[Firm, str, str]]) -> Dict[Tuple[int, str], ChatUser]:
+    """
+    Get or create chat users for several (firm, phone number) pairs.
+    
+    Active conversations are served from the in-process conversation state
+    cache; the rest are fetched with a single query and users seen for the
+    first time are created with a single bulk insert.
+    
+    Args:
+        users (List[Tuple[Firm, str, str]]): (firm, phone_number, profile_name) tuples
+        
+    Returns:
+        Dict[Tuple[int, str], ChatUser]: Chat users keyed by (firm id, phone number)
+    """
+    if not users:
+        return {}
+    return conversation_states.get_or_create_many(users)
+
+def save_chat_user_states(chat_users: Iterable[ChatUser], also: Optional[Callable[[], None]] = None) -> None:
+    """
+    Persist the current step and last message of chat users in one UPDATE.
+    
+    Args:
+        chat_users (Iterable[ChatUser]): Chat users returned by get_or_create_chat_users
+        also (Optional[Callable[[], None]]): Writes to commit in the same transaction
+    
+    Raises:
+        StaleConversationState: If another process saved one of the chat
+            users first; the caller should reload them and try again
+    """
+    conversation_states.save_states(chat_users, also)
+
+def discard_chat_user_states(chat_users: Iterable[ChatUser]) -> None:
+    """
+    Drop chat users from the conversation state cache, so changes made to
+    them that were never saved are not served to later messages.
+    
+    Args:
+        chat_users (Iterable[ChatUser]): Chat users returned by get_or_create_chat_users
+    """
+    conversation_states.evict_many(chat_users)
+
+# Async versions of the helpers above, for the ASGI views. They use the async
+# ORM and cache interfaces and never touch deferred fields synchronously.
+
+async def aget_firm_by_phone(phone_number: str) -> Optional[Firm]:
+    """
+    Async version of get_firm_by_phone.
+    
+    Args:
+        phone_number (str): The phone number to search for
+        
+    Returns:
+        Optional[Firm]: The firm if found, None otherwise
+    """
+    return await aget_routed_firm(phone_number)
+
+async def aget_firms_by_phone(phone_numbers: Iterable[str]) -> Dict[str, Firm]:
+    """
+    Async version of get_firms_by_phone.
+    
+    Args:
+        phone_numbers (Iterable[str]): The phone numbers to search for
+        
+    Returns:
+        Dict[str, Firm]: Firms keyed by phone number; unknown numbers are omitted
+    """
+    return await aget_routed_firms(phone_numbers)
+
+async def aget_next_message(firm: Firm, current_step: str, user_input: str) -> Tuple[str, str]:
+    """
+    Async version of get_next_message.
+    
+    Args:
+        firm (Firm): The firm object
+        current_step (str): The current step ID
+        user_input (str): The user's input message
+        
+    Returns:
+        Tuple[str, str]: A tuple containing (next_step_id, message_to_send)
+    """
+    compiled = await aget_compiled_flow(firm)
+    if compiled is None:
+        return None, "No flow configured for this firm."
+    return compiled.route(current_step, user_input)
+
+async def aget_or_create_chat_users(users: List[Tuple[Firm, str, str]]) -> Dict[Tuple[int, str], ChatUser]:
+    """
+    Async version of get_or_create_chat_users.
+    
+    Args:
+        users (List[Tuple[Firm, str, str]]): (firm, phone_number, profile_name) tuples
+        
+    Returns:
+        Dict[Tuple[int, str], ChatUser]: Chat users keyed by (firm id, phone number)
+    """
+    if not users:
+        return {}
+    return await conversation_states.aget_or_create_many(users)
+
+async def asave_chat_user_states(chat_users: Iterable[ChatUser], also: Optional[Callable[[], None]] = None) -> None:
+    """
+    Async version of save_chat_user_states.
+    
+    Args:
+        chat_users (Iterable[ChatUser]): Chat users returned by aget_or_create_chat_users
+        also (Optional[Callable[[], None]]): Synchronous writes to commit in the same transaction
+    """
+    await conversation_states.asave_states(chat_users, also)
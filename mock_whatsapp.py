@@ -1,65 +1,451 @@
 from flask import Flask, request, jsonify, render_template_string, redirect, url_for, flash
+from werkzeug.serving import make_server
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
 import logging
+import math
+import random
+import re
 import requests
 import os
+import socket
+import sqlite3
+import string
+import struct
+import sys
+import threading
+import time
+import uuid
 from datetime import datetime
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+try:
+    import httpx
+except ImportError:  # optional; the simulator falls back to requests in threads
+    httpx = None
+
 app = Flask(__name__)
 app.secret_key = 'mock_secret_key'
 logging.basicConfig(level=logging.INFO)
 
 WEBHOOK_URL = 'http://localhost:8000/chatbridge/webhook/'
+# Legacy one-file-per-conversation layout, imported into the store on start
 CHAT_DIR = 'mock_chats'
+STORE_PATH = os.environ.get('MOCK_WHATSAPP_DB', 'mock_chats.sqlite3')
+NUMBERS_PER_PAGE = 50
+MESSAGES_PER_PAGE = 50
+
+# Called with (user number, message, arrival time) for every message the
+# bot sends through /v1/messages; set by the headless simulator
+reply_listener = None
+
+_local = threading.local()
+_store_lock = threading.Lock()
+_store_ready = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    firm TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (user, firm)
+);
+CREATE INDEX IF NOT EXISTS conversations_user_idx ON conversations (user, updated_at);
+CREATE INDEX IF NOT EXISTS conversations_updated_idx ON conversations (updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id INTEGER NOT NULL REFERENCES conversations (id),
+    direction TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_conversation_idx ON messages (conversation_id, id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# One SQLite connection per thread; WAL lets the UI read while replies are written.
+# The store is created on first use, so importing this module opens nothing
+def get_db():
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(STORE_PATH, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        _local.db = db
+        init_store(db)
+    return db
+
+def init_store(db):
+    global _store_ready
+    if _store_ready:
+        return
+    with _store_lock:
+        if _store_ready:
+            return
+        db.executescript(SCHEMA)
+        import_chat_files(db)
+        _store_ready = True
+
+# Import conversations from the legacy mock_chats directory, once
+def import_chat_files(db):
+    if not os.path.isdir(CHAT_DIR):
+        return
+    if db.execute("SELECT 1 FROM meta WHERE key = 'imported_chat_dir'").fetchone():
+        return
+    imported = 0
+    db.execute('BEGIN')
+    try:
+        for name in sorted(os.listdir(CHAT_DIR)):
+            if not (name.endswith('.txt') and '__' in name):
+                continue
+            user, firm = name[:-4].split('__', 1)
+            conversation_id = _conversation_id(db, user, firm, os.path.getmtime(os.path.join(CHAT_DIR, name)))
+            with open(os.path.join(CHAT_DIR, name)) as f:
+                for line in f:
+                    direction, _, rest = line.rstrip('\n').partition(': ')
+                    if direction not in ('SENT', 'RECEIVED'):
+                        continue
+                    body, _, timestamp = rest.rpartition(' [')
+                    db.execute(
+                        'INSERT INTO messages (conversation_id, direction, body, created_at) VALUES (?, ?, ?, ?)',
+                        (conversation_id, direction, body, timestamp.rstrip(']')),
+                    )
+            imported += 1
+        db.execute("INSERT INTO meta (key, value) VALUES ('imported_chat_dir', ?)", (str(imported),))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    logging.info(f'Imported {imported} conversations from {CHAT_DIR}/ into {STORE_PATH}')
+
+def _conversation_id(db, user_number, firm_number, updated_at=None):
+    db.execute(
+        'INSERT OR IGNORE INTO conversations (user, firm, updated_at) VALUES (?, ?, ?)',
+        (user_number, firm_number, updated_at or time.time()),
+    )
+    return db.execute(
+        'SELECT id FROM conversations WHERE user = ? AND firm = ?', (user_number, firm_number)
+    ).fetchone()['id']
 
-# Ensure chat directory exists
-def ensure_chat_dir():
-    if not os.path.exists(CHAT_DIR):
-        os.makedirs(CHAT_DIR)
-
-# List all phone numbers (files)
-def list_numbers():
-    ensure_chat_dir()
-    numbers = []
-    for f in os.listdir(CHAT_DIR):
-        if f.endswith('.txt') and '__' in f:
-            user, firm = f[:-4].split('__', 1)
-            numbers.append({'user': user, 'firm': firm})
-    return numbers
-
-# Create a new number (file)
+# List conversations, most recently active first, one page at a time
+def list_numbers(page=1, per_page=NUMBERS_PER_PAGE):
+    rows = get_db().execute(
+        'SELECT user, firm FROM conversations ORDER BY updated_at DESC LIMIT ? OFFSET ?',
+        (per_page + 1, (page - 1) * per_page),
+    ).fetchall()
+    numbers = [{'user': row['user'], 'firm': row['firm']} for row in rows[:per_page]]
+    return numbers, len(rows) > per_page
+
+# Create a new conversation
 def create_number(user_number, firm_number):
-    ensure_chat_dir()
-    path = os.path.join(CHAT_DIR, f'{user_number}__{firm_number}.txt')
-    if not os.path.exists(path):
-        with open(path, 'w') as f:
-            f.write('')
+    _conversation_id(get_db(), user_number, firm_number)
 
-# Append a message to a chat file
+# Append a message to a conversation
 def append_message(user_number, firm_number, message, sent=True):
-    ensure_chat_dir()
-    path = os.path.join(CHAT_DIR, f'{user_number}__{firm_number}.txt')
+    db = get_db()
     direction = 'SENT' if sent else 'RECEIVED'
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(path, 'a') as f:
-        f.write(f'{direction}: {message} [{timestamp}]\n')
-
-# Get chat history for a number
-def get_chat_history(user_number, firm_number):
-    ensure_chat_dir()
-    path = os.path.join(CHAT_DIR, f'{user_number}__{firm_number}.txt')
-    if not os.path.exists(path):
-        return []
-    with open(path, 'r') as f:
-        return f.readlines()
-
-# Find firm number for a user number (for /v1/messages)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        conversation_id = _conversation_id(db, user_number, firm_number)
+        db.execute(
+            'INSERT INTO messages (conversation_id, direction, body, created_at) VALUES (?, ?, ?, ?)',
+            (conversation_id, direction, message, timestamp),
+        )
+        db.execute('UPDATE conversations SET updated_at = ? WHERE id = ?', (time.time(), conversation_id))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+# Get the latest messages of a conversation, optionally before a message id.
+# Returns the messages oldest first and the id to pass as `before` for the
+# previous page, if there is one.
+def get_chat_history(user_number, firm_number, limit=MESSAGES_PER_PAGE, before=None):
+    db = get_db()
+    row = db.execute('SELECT id FROM conversations WHERE user = ? AND firm = ?', (user_number, firm_number)).fetchone()
+    if row is None:
+        return [], None
+    rows = db.execute(
+        'SELECT id, direction, body, created_at FROM messages '
+        'WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+        (row['id'], before or sys.maxsize, limit + 1),
+    ).fetchall()
+    older = rows[limit - 1]['id'] if len(rows) > limit else None
+    return [dict(message) for message in reversed(rows[:limit])], older
+
+# Find the firm number for a user number (for /v1/messages): the
+# conversation the user was last active in
 def find_firm_number(user_number):
-    ensure_chat_dir()
-    for f in os.listdir(CHAT_DIR):
-        if f.endswith('.txt') and f.startswith(f'{user_number}__'):
-            return f[:-4].split('__', 1)[1]
+    row = get_db().execute(
+        'SELECT firm FROM conversations WHERE user = ? ORDER BY updated_at DESC LIMIT 1', (user_number,)
+    ).fetchone()
+    return row['firm'] if row else None
+
+# Build the webhook payload WhatsApp sends for a user's text message
+def webhook_payload(user_number, firm_number, message, profile_name='Mock User'):
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "id": "WABA_ID_123",
+                "changes": [
+                    {
+                        "value": {
+                            "messaging_product": "whatsapp",
+                            "metadata": {
+                                "display_phone_number": firm_number,
+                                "phone_number_id": "123456789012345"
+                            },
+                            "contacts": [
+                                {
+                                    "profile": {
+                                        "name": profile_name
+                                    },
+                                    "wa_id": user_number
+                                }
+                            ],
+                            "messages": [
+                                {
+                                    "from": user_number,
+                                    "id": f"wamid.{uuid.uuid4().hex}",
+                                    "timestamp": str(int(datetime.now().timestamp())),
+                                    "type": "text",
+                                    "text": {
+                                        "body": message
+                                    }
+                                }
+                            ]
+                        },
+                        "field": "messages"
+                    }
+                ]
+            }
+        ]
+    }
+
+# ---------------------------------------------------------------------------
+# Fault injection on /v1/messages
+#
+# Profiles are set per firm number through /admin/faults/<firm number>
+# (PUT a profile, DELETE to clear, GET /admin/faults to list them with the
+# faults injected so far) or loaded with --faults FILE ({firm: profile}).
+# The profile of firm '*' applies to firms without their own. Example:
+#
+#   {"latency_ms": {"distribution": "lognormal", "median": 120, "sigma": 0.6, "max": 5000},
+#    "error_rate": {"429": 0.05, "503": 0.02}, "retry_after": 1,
+#    "reset_rate": 0.01, "rate_limit": {"requests": 20, "window": 1}}
+#
+# latency_ms is a number for a fixed latency, or a distribution: fixed (ms),
+# uniform (min, max), exponential (mean) or lognormal (median, sigma), each
+# optionally capped by max. Latency is added to every request, then the
+# connection is reset, the firm's rate-limit window is checked (429 with
+# Retry-After once exceeded) and an error status may be returned.
+# ---------------------------------------------------------------------------
+
+LATENCY_PARAMETERS = {
+    'fixed': ('ms',),
+    'uniform': ('min', 'max'),
+    'exponential': ('mean',),
+    'lognormal': ('median', 'sigma'),
+}
+PROFILE_FIELDS = ('latency_ms', 'error_rate', 'retry_after', 'reset_rate', 'rate_limit')
+# Error codes of the WhatsApp Cloud API for the injected statuses
+PROVIDER_ERROR_CODES = {429: 130429}
+RESET = 'reset'
+
+_faults = {}
+_fault_counts = {}
+# firm number -> [window start, requests in the window]
+_rate_windows = {}
+_faults_lock = threading.Lock()
+# user number -> firm number of the conversation last sent to the webhook
+_user_firms = {}
+
+def _number(value, name, high=None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or (high is not None and value > high):
+        limit = f' and {high}' if high is not None else ''
+        raise ValueError(f'{name} must be a number between 0{limit}')
+    return value
+
+# Validate a fault profile and fill in the defaults; raises ValueError
+def parse_fault_profile(data):
+    if not isinstance(data, dict):
+        raise ValueError('A fault profile must be a JSON object')
+    unknown = set(data) - set(PROFILE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    latency = data.get('latency_ms', 0)
+    if not isinstance(latency, dict):
+        latency = {'distribution': 'fixed', 'ms': latency}
+    distribution = latency.get('distribution', 'fixed')
+    if distribution not in LATENCY_PARAMETERS:
+        raise ValueError(f"latency_ms.distribution must be one of: {', '.join(LATENCY_PARAMETERS)}")
+    parsed_latency = {'distribution': distribution}
+    for parameter in LATENCY_PARAMETERS[distribution] + (('max',) if 'max' in latency and distribution != 'uniform' else ()):
+        parsed_latency[parameter] = _number(latency.get(parameter), f'latency_ms.{parameter}')
+    if distribution == 'uniform' and parsed_latency['min'] > parsed_latency['max']:
+        raise ValueError('latency_ms.min must not exceed latency_ms.max')
+
+    error_rate = {}
+    for status, rate in (data.get('error_rate') or {}).items():
+        if not str(status).isdigit() or not (int(status) == 429 or 500 <= int(status) <= 599):
+            raise ValueError(f'error_rate statuses must be 429 or 5xx, not {status}')
+        error_rate[int(status)] = _number(rate, f'error_rate.{status}', 1)
+    if sum(error_rate.values()) > 1:
+        raise ValueError('error_rate must add up to at most 1')
+
+    rate_limit = data.get('rate_limit')
+    if rate_limit is not None:
+        if not isinstance(rate_limit, dict):
+            raise ValueError('rate_limit must be an object with requests and window')
+        requests_allowed = rate_limit.get('requests')
+        if isinstance(requests_allowed, bool) or not isinstance(requests_allowed, int) or requests_allowed < 1:
+            raise ValueError('rate_limit.requests must be a positive integer')
+        window = _number(rate_limit.get('window'), 'rate_limit.window')
+        if not window:
+            raise ValueError('rate_limit.window must be positive')
+        rate_limit = {'requests': requests_allowed, 'window': window}
+
+    return {
+        'latency_ms': parsed_latency,
+        'error_rate': error_rate,
+        'retry_after': _number(data['retry_after'], 'retry_after') if data.get('retry_after') is not None else None,
+        'reset_rate': _number(data.get('reset_rate', 0), 'reset_rate', 1),
+        'rate_limit': rate_limit,
+    }
+
+def set_fault_profile(firm_number, data):
+    profile = parse_fault_profile(data)
+    with _faults_lock:
+        _faults[firm_number] = profile
+        _fault_counts.pop(firm_number, None)
+        _rate_windows.pop(firm_number, None)
+    return profile
+
+def clear_fault_profile(firm_number=None):
+    with _faults_lock:
+        if firm_number is None:
+            _faults.clear()
+            _fault_counts.clear()
+            _rate_windows.clear()
+            return True
+        _rate_windows.pop(firm_number, None)
+        return _faults.pop(firm_number, None) is not None
+
+def fault_snapshot():
+    with _faults_lock:
+        return {
+            'profiles': {firm: dict(profile, error_rate={str(status): rate for status, rate in profile['error_rate'].items()})
+                         for firm, profile in _faults.items()},
+            'injected': {firm: dict(counts) for firm, counts in _fault_counts.items()},
+        }
+
+# Load fault profiles from a JSON file of {firm number: profile}
+def load_fault_profiles(path):
+    with open(path) as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, dict):
+        raise SystemExit(f'{path} must hold a JSON object of firm number -> fault profile')
+    for firm_number, profile in profiles.items():
+        try:
+            set_fault_profile(firm_number, profile)
+        except ValueError as e:
+            raise SystemExit(f'{path}: fault profile for {firm_number}: {e}')
+
+def sample_latency(latency):
+    distribution = latency['distribution']
+    if distribution == 'fixed':
+        delay = latency['ms']
+    elif distribution == 'uniform':
+        delay = random.uniform(latency['min'], latency['max'])
+    elif distribution == 'exponential':
+        delay = random.expovariate(1 / latency['mean']) if latency['mean'] else 0
+    else:
+        delay = random.lognormvariate(math.log(latency['median']), latency['sigma']) if latency['median'] else 0
+    if 'max' in latency:
+        delay = min(delay, latency['max'])
+    return delay / 1000
+
+def _count_fault(firm_number, kind):
+    with _faults_lock:
+        counts = _fault_counts.setdefault(firm_number, Counter())
+        counts[kind] += 1
+
+# Seconds until the firm's rate-limit window frees up, or None if the
+# request fits in the current window
+def _rate_limited(firm_number, rate_limit):
+    now = time.monotonic()
+    with _faults_lock:
+        window = _rate_windows.get(firm_number)
+        if window is None or now - window[0] >= rate_limit['window']:
+            window = _rate_windows[firm_number] = [now, 0]
+        window[1] += 1
+        if window[1] <= rate_limit['requests']:
+            return None
+        return rate_limit['window'] - (now - window[0])
+
+# Apply the firm's fault profile to a /v1/messages request. Returns None to
+# accept it, RESET to drop the connection, or (status, headers) for an error.
+def inject_fault(firm_number):
+    key = firm_number or '*'
+    with _faults_lock:
+        profile = _faults.get(key) or _faults.get('*')
+    if profile is None:
+        return None
+    delay = sample_latency(profile['latency_ms'])
+    if delay:
+        time.sleep(delay)
+    if profile['reset_rate'] and random.random() < profile['reset_rate']:
+        _count_fault(key, 'reset')
+        return RESET
+    if profile['rate_limit']:
+        retry_after = _rate_limited(key, profile['rate_limit'])
+        if retry_after is not None:
+            _count_fault(key, 'rate_limited')
+            return 429, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+    roll = random.random()
+    for status, rate in profile['error_rate'].items():
+        if roll < rate:
+            _count_fault(key, str(status))
+            headers = {'Retry-After': str(profile['retry_after'])} if status == 429 and profile['retry_after'] is not None else {}
+            return status, headers
+        roll -= rate
     return None
 
+# Abort the connection: the sender sees a reset instead of a response. The
+# returned response's body raises ConnectionResetError, which the development
+# server handles as a dropped connection, so nothing is written to the socket
+def reset_connection():
+    sock = request.environ.get('werkzeug.socket')
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def dropped():
+        raise ConnectionResetError('Connection reset by fault injection')
+        yield
+
+    return app.response_class(dropped())
+
+# The provider API is not told the firm; replies are attributed to the firm
+# the user last wrote to
+def remember_firm(user_number, firm_number):
+    _user_firms[user_number] = firm_number
+
 # HTML template for the chat UI
 HTML_CHAT = '''
 <!doctype html>
@@ -251,6 +637,20 @@ HTML_CHAT = '''
         box-shadow: 0 4px 16px rgba(7,94,84,0.16);
         transform: translateY(-2px) scale(1.04);
     }
+    .sidebar .pager {
+        width: 85%;
+        display: flex;
+        justify-content: space-between;
+        margin-bottom: 12px;
+    }
+    .sidebar .pager a, .chat-box .older {
+        color: #075e54;
+        font-weight: 500;
+    }
+    .chat-box .older {
+        align-self: center;
+        margin-bottom: 8px;
+    }
     ul { margin: 18px 0 0 0; padding: 0 32px; }
     li { color: #d32f2f; font-size: 1rem; margin-bottom: 4px; }
     @media (max-width: 900px) {
@@ -270,6 +670,12 @@ HTML_CHAT = '''
         {% for n in numbers %}
             <div class="number{% if n.user == selected_user and n.firm == selected_firm %} selected{% endif %}" onclick="window.location='/?user={{n.user}}&firm={{n.firm}}'">{{n.user}} ({{n.firm}})</div>
         {% endfor %}
+        {% if page > 1 or has_more %}
+        <div class="pager">
+            {% if page > 1 %}<a href="/?page={{page - 1}}&user={{selected_user}}&firm={{selected_firm}}">&laquo; Newer</a>{% endif %}
+            {% if has_more %}<a href="/?page={{page + 1}}&user={{selected_user}}&firm={{selected_firm}}">Older &raquo;</a>{% endif %}
+        </div>
+        {% endif %}
         <form class="add-form" method="post" action="/add-number">
             <input type="text" name="new_user_number" placeholder="Enter user number" required>
             <input type="text" name="new_firm_number" placeholder="Enter firm number (display_phone_number)" required>
@@ -278,11 +684,12 @@ HTML_CHAT = '''
     </div>
     <div class="chat-area">
         <div class="chat-box" id="chat-box">
+            {% if older %}
+                <a class="older" href="/?user={{selected_user}}&firm={{selected_firm}}&page={{page}}&before={{older}}">Load older messages</a>
+            {% endif %}
             {% if chat %}
                 {% for line in chat %}
-                    {% set direction = 'sent' if line.startswith('SENT:') else 'received' %}
-                    {% set msg = line.split(':', 1)[1].rsplit('[', 1)[0].strip() if ':' in line and '[' in line else line %}
-                    <div class="chat-line {{direction}}">{{msg}}</div>
+                    <div class="chat-line {{ 'sent' if line.direction == 'SENT' else 'received' }}" title="{{line.created_at}}">{{line.body}}</div>
                 {% endfor %}
             {% else %}
                 <div style="color:#aaa;">No chat yet.</div>
@@ -322,11 +729,17 @@ HTML_CHAT = '''
 
 @app.route('/', methods=['GET'])
 def chat_ui():
-    numbers = list_numbers()
+    page = max(request.args.get('page', 1, type=int), 1)
+    numbers, has_more = list_numbers(page)
     selected_user = request.args.get('user') or (numbers[0]['user'] if numbers else None)
     selected_firm = request.args.get('firm') or (numbers[0]['firm'] if numbers else None)
-    chat = get_chat_history(selected_user, selected_firm) if selected_user and selected_firm else []
-    return render_template_string(HTML_CHAT, numbers=numbers, selected_user=selected_user, selected_firm=selected_firm, chat=chat)
+    chat, older = [], None
+    if selected_user and selected_firm:
+        chat, older = get_chat_history(selected_user, selected_firm, before=request.args.get('before', type=int))
+    return render_template_string(
+        HTML_CHAT, numbers=numbers, page=page, has_more=has_more, selected_user=selected_user,
+        selected_firm=selected_firm, chat=chat, older=older,
+    )
 
 @app.route('/add-number', methods=['POST'])
 def add_number():
@@ -346,46 +759,9 @@ def send_message():
         flash('User number, firm number, and message required!')
         return redirect(url_for('chat_ui', user=user_number, firm=firm_number))
     append_message(user_number, firm_number, message, sent=True)
+    remember_firm(user_number, firm_number)
     # Send to webhook as if user sent it
-    payload = {
-        "object": "whatsapp_business_account",
-        "entry": [
-            {
-                "id": "WABA_ID_123",
-                "changes": [
-                    {
-                        "value": {
-                            "messaging_product": "whatsapp",
-                            "metadata": {
-                                "display_phone_number": firm_number,
-                                "phone_number_id": "123456789012345"
-                            },
-                            "contacts": [
-                                {
-                                    "profile": {
-                                        "name": "Mock User"
-                                    },
-                                    "wa_id": user_number
-                                }
-                            ],
-                            "messages": [
-                                {
-                                    "from": user_number,
-                                    "id": "wamid.mocked-id",
-                                    "timestamp": str(int(datetime.now().timestamp())),
-                                    "type": "text",
-                                    "text": {
-                                        "body": message
-                                    }
-                                }
-                            ]
-                        },
-                        "field": "messages"
-                    }
-                ]
-            }
-        ]
-    }
+    payload = webhook_payload(user_number, firm_number, message)
     try:
         resp = requests.post(WEBHOOK_URL, json=payload)
         if resp.status_code == 200:
@@ -402,9 +778,25 @@ def api_send_message():
     app.logger.info(f"Received message send request: {data}")
     user_number = data.get('to')
     message = data.get('message')
-    firm_number = find_firm_number(user_number)
-    if user_number and message and firm_number:
-        append_message(user_number, firm_number, message, sent=False)
+    # Replies are only stored for conversations in the store
+    stored_firm = find_firm_number(user_number)
+    fault = inject_fault(_user_firms.get(user_number) or stored_firm)
+    if fault == RESET:
+        return reset_connection()
+    if fault is not None:
+        status, headers = fault
+        app.logger.info(f"Injected {status} for message to {user_number}")
+        return jsonify({
+            "error": {
+                "message": "Rate limit hit" if status == 429 else "Something went wrong",
+                "type": "OAuthException",
+                "code": PROVIDER_ERROR_CODES.get(status, 131000),
+            }
+        }), status, headers
+    if reply_listener is not None and user_number:
+        reply_listener(user_number, message, time.perf_counter())
+    if user_number and message and stored_firm:
+        append_message(user_number, stored_firm, message, sent=False)
     # Return a mock WhatsApp API response
     return jsonify({
         "messages": [
@@ -415,5 +807,383 @@ def api_send_message():
         ]
     }), 200
 
+@app.route('/admin/faults', methods=['GET', 'DELETE'])
+def admin_faults():
+    if request.method == 'DELETE':
+        clear_fault_profile()
+    return jsonify(fault_snapshot())
+
+@app.route('/admin/faults/<firm_number>', methods=['GET', 'PUT', 'DELETE'])
+def admin_firm_faults(firm_number):
+    if request.method == 'PUT':
+        try:
+            profile = set_fault_profile(firm_number, request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        app.logger.info(f'Fault profile for {firm_number}: {profile}')
+    elif request.method == 'DELETE':
+        if not clear_fault_profile(firm_number):
+            return jsonify({'error': f'No fault profile for {firm_number}'}), 404
+        return jsonify({'status': 'cleared'})
+    profile = fault_snapshot()['profiles'].get(firm_number)
+    if profile is None:
+        return jsonify({'error': f'No fault profile for {firm_number}'}), 404
+    return jsonify(profile)
+
+# ---------------------------------------------------------------------------
+# Headless simulator: virtual users walking a firm's flow
+#
+#   python mock_whatsapp.py simulate --firm 15550001111 --flow firms.json --users 200
+#
+# The flow file is the flow JSON of the dashboard's flow editor, or the
+# output of `manage.py dumpdata firms.Firm` (the firm is picked by --firm).
+# Bot replies are received on /v1/messages as usual, so the backend's
+# WHATSAPP_API_URL must point at --host/--port.
+# ---------------------------------------------------------------------------
+
+# Input tried on every step besides the inputs generated from its patterns
+FILLER_INPUT = 'hello'
+SAMPLE_ALPHABET = string.ascii_letters + string.digits
+CATEGORY_SAMPLES = {
+    sre_parse.CATEGORY_DIGIT: string.digits,
+    sre_parse.CATEGORY_NOT_DIGIT: string.ascii_letters,
+    sre_parse.CATEGORY_WORD: SAMPLE_ALPHABET,
+    sre_parse.CATEGORY_NOT_WORD: ' -.!?',
+    sre_parse.CATEGORY_SPACE: ' ',
+    sre_parse.CATEGORY_NOT_SPACE: SAMPLE_ALPHABET,
+}
+REPEAT_OPS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)}
+GROUP_OPS = {sre_parse.SUBPATTERN, getattr(sre_parse, 'ATOMIC_GROUP', None)}
+
+def _in_class_item(op, av, char):
+    if op is sre_parse.LITERAL:
+        return ord(char) == av
+    if op is sre_parse.RANGE:
+        return av[0] <= ord(char) <= av[1]
+    if op is sre_parse.CATEGORY:
+        return char in CATEGORY_SAMPLES.get(av, '')
+    return False
+
+def _sample_class(items, rng):
+    if items and items[0][0] is sre_parse.NEGATE:
+        allowed = [
+            char for char in SAMPLE_ALPHABET + ' -.!?'
+            if not any(_in_class_item(op, av, char) for op, av in items[1:])
+        ]
+        return rng.choice(allowed) if allowed else '~'
+    op, av = rng.choice(items)
+    if op is sre_parse.LITERAL:
+        return chr(av)
+    if op is sre_parse.RANGE:
+        return chr(rng.randint(av[0], min(av[1], av[0] + 25)))
+    return rng.choice(CATEGORY_SAMPLES.get(av, SAMPLE_ALPHABET))
+
+def _sample_parsed(parsed, rng, groups):
+    out = []
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            out.append(chr(av))
+        elif op is sre_parse.NOT_LITERAL:
+            out.append(rng.choice([char for char in SAMPLE_ALPHABET if ord(char) != av]))
+        elif op is sre_parse.ANY:
+            out.append(rng.choice(SAMPLE_ALPHABET))
+        elif op is sre_parse.IN:
+            out.append(_sample_class(av, rng))
+        elif op in REPEAT_OPS:
+            low, high, sub = av
+            for _ in range(rng.randint(low, min(high, low + 2))):
+                out.append(_sample_parsed(sub, rng, groups))
+        elif op in GROUP_OPS:
+            sub = av if op is not sre_parse.SUBPATTERN else av[-1]
+            text = _sample_parsed(sub, rng, groups)
+            if op is sre_parse.SUBPATTERN and av[0]:
+                groups[av[0]] = text
+            out.append(text)
+        elif op is sre_parse.BRANCH:
+            out.append(_sample_parsed(rng.choice(av[1]), rng, groups))
+        elif op is sre_parse.GROUPREF:
+            out.append(groups.get(av, ''))
+        elif op is sre_parse.GROUPREF_EXISTS:
+            group, yes, no = av
+            branch = yes if group in groups else no
+            if branch is not None:
+                out.append(_sample_parsed(branch, rng, groups))
+        # Anchors and lookarounds add no text; candidates are checked afterwards
+    return ''.join(out)
+
+# Generate a text the pattern may match (not guaranteed: check with re.match)
+def sample_input(pattern, rng):
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        # Invalid patterns are matched by equality
+        return pattern
+    return _sample_parsed(parsed, rng, {})
+
+# The step a text leads to from a list of (pattern, next step) routes, the
+# way the backend routes it: the first pattern that matches wins
+def route_input(routes, text):
+    for pattern, next_step in routes:
+        try:
+            matched = re.match(pattern, text) is not None
+        except re.error:
+            matched = text == pattern
+        if matched:
+            return next_step
+    return None
+
+# Work out, for every step, inputs that advance the conversation and the
+# step each leads to
+def plan_inputs(flow, rng, samples_per_route=3):
+    steps = {}
+    for step in flow.get('steps', []):
+        steps.setdefault(step['id'], step)
+    plan = {}
+    for step_id, step in steps.items():
+        next_step = step.get('next')
+        if isinstance(next_step, str):
+            plan[step_id] = [(FILLER_INPUT, next_step)]
+            continue
+        routes = [(route.get('pattern', ''), route.get('next')) for route in next_step or []]
+        options = {}
+        candidates = [FILLER_INPUT] + [
+            sample_input(pattern, rng) for pattern, _ in routes for _ in range(samples_per_route)
+        ]
+        for text in candidates:
+            # The backend strips the input before routing
+            text = text.strip()
+            target = route_input(routes, text) if text else None
+            if target:
+                options.setdefault(text, target)
+        plan[step_id] = list(options.items())
+    return plan, {step_id: step.get('message', '') for step_id, step in steps.items()}
+
+# Read a flow and its first step from a flow JSON file or a dumpdata fixture
+def load_flow(path, firm_number):
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        firms = [item.get('fields', {}) for item in data if item.get('model') == 'firms.firm']
+        matching = [fields for fields in firms if fields.get('phone_number') == firm_number]
+        if not matching:
+            raise SystemExit(f'No firm with phone number {firm_number} in {path}')
+        data = matching[0]
+    if 'flow' in data:
+        return data['flow'] or {}, data.get('first_step') or None
+    return data, None
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# Latency summary in milliseconds
+def summarize(durations):
+    ordered = sorted(durations)
+    summary = {'count': len(ordered)}
+    if ordered:
+        summary['mean'] = round(sum(ordered) / len(ordered) * 1000, 2)
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99)):
+            summary[name] = round(percentile(ordered, fraction) * 1000, 2)
+        summary['max'] = round(ordered[-1] * 1000, 2)
+    return summary
+
+class Simulation:
+    """
+    N virtual users, each an asyncio task walking the flow of one firm.
+
+    A user sends one message at a time through the webhook and waits for
+    the bot's reply before its next turn, so a reply arriving on
+    /v1/messages for that user belongs to the user's outstanding turn.
+    The round trip is measured from just before the webhook request to
+    the reply's arrival.
+    """
+
+    def __init__(self, flow, firm_number, first_step, users, turns, webhook_url,
+                 think_time=0.0, ramp_up=0.0, reply_timeout=10.0, record=False, seed=None):
+        self.rng = random.Random(seed)
+        self.plan, self.messages = plan_inputs(flow, self.rng)
+        self.firm_number = firm_number
+        self.first_step = first_step
+        self.users = users
+        self.turns = turns
+        self.webhook_url = webhook_url
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.reply_timeout = reply_timeout
+        self.record = record
+        # Unique per run (WhatsApp numbers are up to 15 digits), so every
+        # virtual user starts a new conversation at the first step
+        self.number_prefix = f'99{self.rng.randrange(10 ** 5):05d}'
+        self.round_trips = []
+        self.acks = []
+        self.counts = Counter()
+        self.pending = {}
+        self.loop = None
+        self.client = None
+
+    # Called on the reply server's threads
+    def listener(self, user_number, message, received):
+        self.loop.call_soon_threadsafe(self._on_reply, user_number, message, received)
+
+    def _on_reply(self, user_number, message, received):
+        future = self.pending.get(user_number)
+        if future is None or future.done():
+            # No turn waiting: a late reply after a timeout, or an extra message
+            self.counts['unsolicited_replies'] += 1
+            return
+        future.set_result((message, received))
+
+    async def post_webhook(self, payload):
+        if self.client is not None:
+            response = await self.client.post(self.webhook_url, json=payload)
+            return response.status_code
+        response = await asyncio.to_thread(requests.post, self.webhook_url, json=payload, timeout=30)
+        return response.status_code
+
+    async def run_user(self, index):
+        user_number = f'{self.number_prefix}{index:06d}'
+        remember_firm(user_number, self.firm_number)
+        await asyncio.sleep(self.ramp_up * index / self.users)
+        step = self.first_step
+        for _ in range(self.turns):
+            options = self.plan.get(step)
+            if not options:
+                self.counts['finished'] += 1
+                return
+            text, next_step = self.rng.choice(options)
+            if self.record:
+                await asyncio.to_thread(append_message, user_number, self.firm_number, text, True)
+            future = self.loop.create_future()
+            self.pending[user_number] = future
+            self.counts['turns'] += 1
+            try:
+                sent = time.perf_counter()
+                try:
+                    status = await self.post_webhook(webhook_payload(user_number, self.firm_number, text, f'Sim {index}'))
+                except Exception as e:
+                    self.counts['webhook_errors'] += 1
+                    logging.warning(f'Webhook request for {user_number} failed: {e}')
+                    return
+                self.acks.append(time.perf_counter() - sent)
+                if status != 200:
+                    # Not accepted (e.g. 503 when the backend queue is full); try again next turn
+                    self.counts[f'webhook_{status}'] += 1
+                    continue
+                try:
+                    message, received = await asyncio.wait_for(future, self.reply_timeout)
+                except asyncio.TimeoutError:
+                    # The conversation state is unknown from here on
+                    self.counts['timeouts'] += 1
+                    return
+            finally:
+                self.pending.pop(user_number, None)
+            self.round_trips.append(received - sent)
+            self.counts['replies'] += 1
+            if message != self.messages.get(next_step):
+                self.counts['unexpected_replies'] += 1
+            step = next_step
+            if self.think_time:
+                await asyncio.sleep(self.rng.uniform(0, self.think_time))
+        self.counts['turn_limit'] += 1
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        if httpx is not None:
+            self.client = httpx.AsyncClient(
+                timeout=30,
+                limits=httpx.Limits(max_connections=self.users, max_keepalive_connections=self.users),
+            )
+        else:
+            # One blocking request per thread; size the pool for every user
+            self.loop.set_default_executor(ThreadPoolExecutor(max_workers=min(self.users, 256)))
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.run_user(index) for index in range(self.users)))
+        finally:
+            if self.client is not None:
+                await self.client.aclose()
+        return self.report(time.perf_counter() - started)
+
+    def report(self, elapsed):
+        return {
+            'firm': self.firm_number,
+            'users': self.users,
+            'elapsed_seconds': round(elapsed, 3),
+            'replies_per_second': round(self.counts['replies'] / elapsed, 2) if elapsed else 0.0,
+            'counts': dict(self.counts),
+            'round_trip_ms': summarize(self.round_trips),
+            'webhook_ack_ms': summarize(self.acks),
+        }
+
+def print_report(report):
+    print(f"Simulated {report['users']} users against firm {report['firm']} in {report['elapsed_seconds']}s "
+          f"({report['replies_per_second']} replies/s)")
+    for name, count in sorted(report['counts'].items()):
+        print(f'  {name:<20} {count}')
+    for title, key in (('Round trip', 'round_trip_ms'), ('Webhook ack', 'webhook_ack_ms')):
+        summary = report[key]
+        values = ' '.join(f'{name}={value}' for name, value in summary.items() if name != 'count')
+        print(f"{title} (ms, n={summary['count']}): {values or '-'}")
+
+def simulate(args):
+    global reply_listener
+    flow, first_step = load_flow(args.flow, args.firm)
+    simulation = Simulation(
+        flow, args.firm, args.first_step or first_step or 'start', args.users, args.turns, args.webhook_url,
+        think_time=args.think_time, ramp_up=args.ramp_up, reply_timeout=args.reply_timeout,
+        record=args.record, seed=args.seed,
+    )
+    if not simulation.plan.get(simulation.first_step):
+        raise SystemExit(f'No input leads anywhere from the first step {simulation.first_step!r}')
+    # Per-message logging would dominate a load run
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app.logger.setLevel(logging.WARNING)
+    server = make_server(args.host, args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='mock-whatsapp', daemon=True).start()
+    reply_listener = simulation.listener
+    try:
+        report = asyncio.run(simulation.run())
+    finally:
+        reply_listener = None
+        server.shutdown()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--faults', default=argparse.SUPPRESS, help='JSON file of firm number -> fault profile for /v1/messages')
+    parser = argparse.ArgumentParser(description='Mock WhatsApp Business API with a chat UI.', parents=[common])
+    commands = parser.add_subparsers(dest='command')
+    sim = commands.add_parser(
+        'simulate', parents=[common], help='Run concurrent virtual users through a firm\'s flow, without the UI',
+    )
+    sim.add_argument('--firm', required=True, help='The firm\'s display phone number')
+    sim.add_argument('--flow', required=True, help='Flow JSON file, or a `dumpdata firms.Firm` fixture')
+    sim.add_argument('--first-step', help='Step new users start at (default: the firm\'s, or "start")')
+    sim.add_argument('--users', type=int, default=10, help='Concurrent virtual users')
+    sim.add_argument('--turns', type=int, default=10, help='Messages per user at most')
+    sim.add_argument('--think-time', type=float, default=0.0, help='Maximum random pause between turns, in seconds')
+    sim.add_argument('--ramp-up', type=float, default=0.0, help='Seconds over which users are started')
+    sim.add_argument('--reply-timeout', type=float, default=10.0, help='Seconds to wait for each reply')
+    sim.add_argument('--webhook-url', default=WEBHOOK_URL)
+    sim.add_argument('--host', default='127.0.0.1', help='Address to receive replies on')
+    sim.add_argument('--port', type=int, default=5005, help='Port to receive replies on')
+    sim.add_argument('--record', action='store_true', help='Store the conversations for the chat UI')
+    sim.add_argument('--seed', type=int, help='Random seed, for repeatable runs')
+    sim.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+    if getattr(args, 'faults', None):
+        load_fault_profiles(args.faults)
+    if args.command == 'simulate':
+        if args.users < 1:
+            parser.error('--users must be at least 1')
+        simulate(args)
+        return
+    app.run(port=5005, debug=True)
+
 if __name__ == '__main__':
-    app.run(port=5005, debug=True) 
\ No newline at end of file
+    main()